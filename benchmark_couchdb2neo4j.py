@@ -0,0 +1,1578 @@
+#!/usr/bin/env python
+
+# Benchmarks for the stages of couchdb2neo4j_with_tags.py. They run against a
+# synthetic OSDF corpus generated in memory, so no CouchDB or Neo4j instance is
+# needed, e.g.:
+#
+# ./benchmark_couchdb2neo4j.py parse --page_sizes 1000,10000,50000
+# ./benchmark_couchdb2neo4j.py normalize --n_docs 200000 --workers 2,4
+# ./benchmark_couchdb2neo4j.py check_normalize
+# ./benchmark_couchdb2neo4j.py nodes --n_docs 500000
+# ./benchmark_couchdb2neo4j.py store --n_docs 100000 --cache_sizes 1000,100000
+# ./benchmark_couchdb2neo4j.py lineage --n_docs 100000
+# ./benchmark_couchdb2neo4j.py rules --n_docs 100000
+# ./benchmark_couchdb2neo4j.py generate --n_docs 100000 --workers 2,4
+# ./benchmark_couchdb2neo4j.py srs --n_files 20000 --pool_size 50
+# ./benchmark_couchdb2neo4j.py traverse --n_docs 100000
+# ./benchmark_couchdb2neo4j.py props --n_docs 100000
+# ./benchmark_couchdb2neo4j.py pipeline --n_docs 100000 --commit_us 20
+# ./benchmark_couchdb2neo4j.py uniqueness --n_docs 100000
+# ./benchmark_couchdb2neo4j.py insert --n_docs 100000 --workers 2,4 --commit_us 20
+# ./benchmark_couchdb2neo4j.py csv --n_docs 100000
+# ./benchmark_couchdb2neo4j.py adaptive --n_docs 100000 --target_seconds 0.1
+#
+# The link_ids benchmark needs an empty Neo4j instance, which it loads and
+# then empties again. It has not been run yet, so --link_by_internal_id stays
+# experimental (and off by default) until its results are in, e.g.:
+#
+# docker run --rm --publish=7475:7474 --publish=7688:7687 --env=NEO4J_AUTH=none neo4j:3.4.10
+# ./benchmark_couchdb2neo4j.py link_ids --http_port 7475 --bolt_port 7688 --n_docs 100000
+
+import argparse,gc,gzip,json,multiprocessing,os,pprint,random,sys,tempfile,time,tracemalloc
+import couchdb2neo4j_with_tags as c2n
+
+# Build a synthetic set of CouchDB _all_docs rows (with include_docs=true) that
+# follows the OSDF lineage: each subject has two visits, each with one sample
+# and a full set of 16S, WGS and ~omics preps and files below it, plus one
+# pooled 16S trimmed set and one WGS coassembly per subject. A few rows that
+# the loader skips (design doc, _hist doc, unknown node type) are added too.
+# There are 46 rows per subject.
+def _synthetic_rows(n_subjects, seed=0):
+    rnd = random.Random(seed)
+    rows = []
+    def new_id():
+        return '%032x' % rnd.getrandbits(128)
+    def add(node_type, linkage, meta, doc_id=None):
+        doc_id = doc_id or new_id()
+        rows.append({'id': doc_id, 'key': doc_id, 'value': {'rev': '1-abc'},
+                     'doc': {'_id': doc_id, '_rev': '1-abc', 'node_type': node_type, 'linkage': linkage,
+                             'meta': meta, 'acl': {'read': ['all'], 'write': ['ihmp']}, 'ns': 'ihmp', 'ver': 1}})
+        return doc_id
+    def url(ext):
+        return ['http://downloads.hmpdacc.org/data/%s.%s' % (new_id(), ext), 'fasp://aspera.hmpdacc.org/data/%s.%s' % (new_id(), ext)]
+    study_name = 'Human microbiome project WGS production phase I.'
+    project = add('project', {}, {'name': 'iHMP', 'description': 'x', 'mixs': {'lat_lon': '', 'biome': 'terrestrial biome'}, 'tags': ['hmp']})
+    study = add('study', {'part_of': [project]}, {'name': study_name, 'subtype': 'prediabetes', 'center': 'Stanford', 'contact': ['Bob', 'bob@x.org'], 'description': 'a study', 'tags': []})
+    body_sites = ['feces', 'nasal', 'stool', 'buccal mucosa', 'wall_of_vagina']
+    for s in range(n_subjects):
+        subj = add('subject', {'participates_in': [study]}, {'rand_subject_id': 'S%d' % s, 'gender': rnd.choice(['male', 'female']), 'race': 'caucasian', 'tags': ['subject_tag:%d' % (s % 7)], 'subset_of': ''})
+        add('subject_attr', {'associated_with': [subj]}, {'study': 'prediabetes', 'abx': rnd.choice(['yes', 'no', 'unknown/not reported']), 'ethnicity': '', 'age': rnd.randint(20, 70), 'acute_dis': 'no'})
+        raws16, wgsraws = [], []
+        for v in range(2):
+            visit = add('visit', {'by': [subj]}, {'visit_id': 'V%d_%d' % (s, v), 'visit_number': v + 1, 'interval': 30, 'date': '', 'tags': []})
+            add('visit_attr', {'associated_with': [visit]}, {'study': 'prediabetes', 'abdominal_pain': 'no', 'weight_change': '2', 'dinner': {'tod': '18:00'}, 'comment': ' '})
+            sample = add('sample', {'collected_during': [visit]}, {'name': 'SMP%d_%d' % (s, v), 'body_site': rnd.choice(body_sites), 'fma_body_site': 'FMA:64183',
+                              'mixs': {'biome': 'terrestrial', 'body_product': 'feces', 'collection_date': '', 'env_package': 'human-gut', 'feature': 'N/A', 'geo_loc_name': 'US', 'lat_lon': '37 N 122 W', 'material': 'feces'},
+                              'supersite': 'gut', 'tags': ['sample_type:stool']})
+            add('sample_attr', {'associated_with': [sample]}, {'study': 'prediabetes', 'yogurt': 'yes', 'abx': 'no'})
+            srs = 'SRS%06d' % rnd.randint(0, 999999)
+            prep16 = add('16s_dna_prep', {'prepared_from': [sample]}, {'comment': 'prep', 'lib_layout': 'fragment', 'lib_selection': 'PCR', 'ncbi_taxon_id': '408170', 'prep_id': 'P%d' % v, 'sequencing_center': 'JCVI', 'sequencing_contact': 'x@y', 'srs_id': srs, 'storage_duration': 0, 'tags': [srs],
+                              'mimarks': {'adapters': 'x', 'biome': 'gut', 'pcr_primers': 'FWD:GTGCCAGCMGCCGCGGTAA', 'target_gene': '16S rRNA', 'lat_lon': '', 'investigation_type': 'mimarks-survey'}})
+            raw16 = add('16s_raw_seq_set', {'sequenced_from': [prep16]}, {'checksums': {'md5': new_id()}, 'exp_length': 0, 'format': 'fastq', 'format_doc': 'http://x', 'seq_model': 'Illumina MiSeq', 'size': rnd.randint(1000, 10**9), 'study': 'prediabetes', 'subtype': '16s', 'urls': url('fastq'), 'tags': [srs]})
+            raws16.append((raw16, srs))
+            trimmed = add('16s_trimmed_seq_set', {'computed_from': [raw16]}, {'checksums': {'md5': new_id()}, 'format': 'fasta', 'format_doc': 'x', 'size': 12345, 'study': 'prediabetes', 'subtype': '16s', 'urls': url('fsa'), 'tags': []})
+            add('abundance_matrix', {'computed_from': [trimmed]}, {'checksums': {'md5': new_id()}, 'format': 'biom', 'format_doc': 'x', 'matrix_type': '16s_community', 'size': 10, 'study': 'prediabetes', 'urls': url('biom'), 'tags': []})
+            wprep = add('wgs_dna_prep', {'prepared_from': [sample]}, {'comment': 'w', 'lib_layout': 'paired', 'lib_selection': 'random', 'ncbi_taxon_id': '408170', 'prep_id': 'W%d' % v, 'sequencing_center': 'BI', 'sequencing_contact': 'x@y', 'storage_duration': 1, 'tags': [srs], 'mims': {'annot_source': '', 'assembly': 'x', 'lib_const_meth': 'y'}})
+            wraw = add('wgs_raw_seq_set', {'sequenced_from': [wprep]}, {'checksums': {'md5': new_id()}, 'exp_length': 100, 'format': 'fastq', 'format_doc': 'x', 'seq_model': 'Illumina HiSeq 2000', 'size': 999, 'study': study_name, 'urls': url('fastq'), 'tags': [srs, 'wgs']})
+            wgsraws.append((wraw, srs))
+            asm = add('wgs_assembled_seq_set', {'computed_from': [wraw]}, {'assembly_name': srs, 'checksums': {'md5': new_id()}, 'format': 'fasta', 'size': 1, 'study': study_name, 'urls': url('fa'), 'tags': [srs]})
+            ann = add('annotation', {'computed_from': [asm]}, {'annotation_pipeline': 'x', 'checksums': {'md5': new_id()}, 'format': 'gff3', 'orf_process': 'y', 'size': 2, 'study': study_name, 'subtype': 'hmgi2', 'urls': url('gff'), 'tags': []})
+            add('clustered_seq_set', {'computed_from': [ann]}, {'abbrev': 'HMGC', 'checksums': {'md5': new_id()}, 'clustering_process': 'x', 'format': 'peptide', 'size': 3, 'study': study_name, 'urls': url('fa'), 'tags': []})
+            add('alignment', {'computed_from': [wraw]}, {'checksums': {'md5': new_id()}, 'format': 'bam', 'size': 3, 'study': study_name, 'urls': url('bam'), 'tags': []})
+            mprep = add('microb_assay_prep', {'prepared_from': [sample]}, {'comment': 'm', 'prep_id': 'M%d' % v, 'pride_id': 'x', 'center': 'PNNL', 'contact': 'a@b', 'experiment_type': 'PRIDE:0000429', 'study': 'prediabetes', 'tags': []})
+            hprep = add('host_assay_prep', {'prepared_from': [sample]}, {'comment': 'h', 'prep_id': 'H%d' % v, 'center': 'Stanford', 'contact': 'a@b', 'experiment_type': 'x', 'study': 'prediabetes', 'tags': []})
+            add('proteome', {'derived_from': [mprep]}, {'checksums': {'md5': new_id()}, 'format': 'mzml', 'size': 5, 'study': 'prediabetes', 'subtype': 'microbiome', 'urls': url('mzml'), 'tags': []})
+            add('metabolome', {'derived_from': [mprep]}, {'checksums': {'md5': new_id()}, 'format': 'raw', 'size': 6, 'study': 'prediabetes', 'subtype': 'host', 'urls': url('raw'), 'tags': []})
+            add('lipidome', {'derived_from': [hprep]}, {'checksums': {'md5': new_id()}, 'format': '', 'size': 7, 'study': 'prediabetes', 'subtype': 'host', 'urls': url('raw'), 'tags': []})
+            add('cytokine', {'derived_from': [hprep]}, {'checksums': {'md5': new_id()}, 'format': 'tsv', 'size': 8, 'study': 'prediabetes', 'subtype': 'host', 'urls': url('tsv'), 'tags': []})
+            add('abundance_matrix', {'computed_from': [wraw]}, {'checksums': {'md5': new_id()}, 'format': 'tsv', 'matrix_type': 'wgs_community', 'size': 10, 'study': 'prediabetes', 'urls': url('tsv'), 'tags': []})
+        # pooled 16S trimmed set and coassembly across the subject's samples
+        add('16s_trimmed_seq_set', {'computed_from': [r for r, _ in raws16]}, {'checksums': {'md5': new_id()}, 'format': 'fasta', 'size': 1, 'study': 'prediabetes', 'subtype': '16s', 'urls': url('fsa'), 'tags': [raws16[0][1]]})
+        add('wgs_assembled_seq_set', {'computed_from': [r for r, _ in wgsraws]}, {'assembly_name': 'coasm', 'checksums': {'md5': new_id()}, 'format': 'fasta', 'size': 1, 'study': study_name, 'subtype': 'wgs_coassembly', 'name': 'co', 'urls': url('fa'), 'tags': []})
+    add('abundance_matrix', {'computed_from': [study]}, {'checksums': {'md5': new_id()}, 'format': 'tsv', 'matrix_type': 'host_transcriptome', 'size': 10, 'study': 'prediabetes', 'urls': url('tsv'), 'tags': []})
+    add('bogus_type', {}, {'x': 1})
+    add('sample', {'collected_during': []}, {}, doc_id=new_id() + '_hist')
+    rows.append({'id': '_design/osdf', 'key': '_design/osdf', 'value': {'rev': '1'}, 'doc': {'_id': '_design/osdf', 'views': {}}})
+    return rows
+
+# Return a synthetic corpus of at least n_rows rows.
+def _synthetic_rows_at_least(n_rows, seed=0):
+    rows = _synthetic_rows(n_rows // 46 + 1, seed)
+    return rows[:n_rows] if len(rows) > n_rows else rows
+
+# Run fn() n times and return the fastest wall-clock time.
+def _best_time(fn, n=3):
+    best = None
+    for i in range(n):
+        stime = time.time()
+        fn()
+        elapsed = time.time() - stime
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+# Run fn() under tracemalloc and return its peak allocation in MB.
+def _peak_mb(fn):
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1048576.0
+
+# The per-document cleanup that couchdb2neo4j_with_tags.py used to do inline in
+# its main loop, kept as the baseline (and reference output) for _normalize_doc.
+def _legacy_delete_keys_from_dict(doc_dict):
+    delete_us = []
+
+    for key,val in doc_dict.items():
+        if not val or not key:
+            delete_us.append(key)
+
+        # Unfortunately... have to check for keys comprised of blank spaces
+        if len(key.replace(' ','')) == 0:
+            delete_us.append(key)
+
+    for empty in delete_us:
+        del doc_dict[empty]
+
+    return doc_dict
+
+def _legacy_clean_doc(doc):
+    # Assume we don't want design documents, since they're likely to be
+    # already stored elsewhere (e.g. in version control)
+    if doc['id'].startswith("_design"):
+        return None
+    elif doc['id'].endswith("_hist"):
+        return None
+
+    # Clean up the document a bit. We don't need everything stored in
+    # CouchDB for this instance.
+    if 'value' in doc:
+        del doc['value']
+    if 'key' in doc:
+        del doc['key']
+    if 'seq' in doc:
+        del doc['seq']
+    if 'changes' in doc:
+        del doc['changes']
+    if '_id' in doc['doc']:
+        del doc['doc']['_id']
+    if '_rev' in doc['doc']:
+        del doc['doc']['_rev']
+    if 'acl' in doc['doc']:
+        del doc['doc']['acl']
+    if 'ns' in doc['doc']:
+        del doc['doc']['ns']
+    if 'subset_of' in doc['doc']['linkage']:
+        del doc['doc']['linkage']['subset_of']
+
+    # Clean up all these empty values
+    doc['doc'] = _legacy_delete_keys_from_dict(doc['doc'])
+    if 'meta' in doc['doc']:
+
+        # Private nodes should have some mock URL data in them
+        if 'urls' in doc['doc']['meta']:
+            if len(doc['doc']['meta']['urls'])==1 and doc['doc']['meta']['urls'][0]== "":
+                doc['doc']['meta']['urls'][0] = 'Private:Private Data ({0})'.format(doc['id'])
+
+        doc['doc']['meta'] = _legacy_delete_keys_from_dict(doc['doc']['meta'])
+
+        if 'mixs' in doc['doc']['meta']:
+            doc['doc']['meta']['mixs'] = _legacy_delete_keys_from_dict(doc['doc']['meta']['mixs'])
+
+        if 'mimarks' in doc['doc']['meta']:
+            doc['doc']['meta']['mimarks'] = _legacy_delete_keys_from_dict(doc['doc']['meta']['mimarks'])
+
+    # At this point we should have purged the document of all properties
+    # that have no value attached to them.
+
+    # Now move meta values a step outward and make them a base property instead of nested
+    if 'meta' in doc['doc']:
+
+        for key,val in doc['doc']['meta'].items():
+
+            if isinstance(val,dict): # if a nested dict, extract
+
+                for ke,va in doc['doc']['meta'][key].items():
+
+                    if isinstance(va,dict):
+
+                        for k,v in doc['doc']['meta'][key][ke].items():
+
+                            if k and v:
+                                if ke in c2n.keys_to_keep:
+                                    doc['doc']["{}_{}".format(ke,k)] = v
+                                else:
+                                    doc['doc'][k] = v
+
+                    else:
+                        if ke and va:
+                            doc['doc'][ke] = va
+
+            else:
+                if key and val:
+                    doc['doc'][key] = val
+
+        del doc['doc']['meta']
+
+    doc['doc']['id'] = doc['id'] # move everything into 'doc' key
+
+    # Fix the old syntax to make sure it reads 'attribute' and not just 'attr'
+    if doc['doc']['node_type'].endswith("_attr"):
+        doc['doc']['node_type'] = "{0}ibute".format(doc['doc']['node_type'])
+
+    return doc
+
+# Compare parsing an _all_docs page in full with json.loads against the
+# incremental row parser, for each page size. The page body is fed in
+# READ_CHUNK_SIZE pieces as it would arrive from the network. Peak memory is
+# measured both with each row dropped once it has been seen and with every row
+# kept, as the loader's node store does.
+def bench_parse(args):
+    page_sizes = [int(x) for x in args.page_sizes.split(',')]
+    rows = _synthetic_rows_at_least(max(page_sizes))
+
+    print("{0:>10} {1:>8} {2:>8} {3:>10} {4:>14} {5:>16} {6:>16}".format(
+        'page_size', 'MB', 'parser', 'seconds', 'first row (s)', 'peak MB (drop)', 'peak MB (keep)'))
+
+    for page_size in page_sizes:
+        body = json.dumps({'total_rows': len(rows), 'offset': 0, 'rows': rows[:page_size]}).encode('utf-8')
+
+        def chunks():
+            for start in range(0, len(body), c2n.READ_CHUNK_SIZE):
+                yield body[start:start + c2n.READ_CHUNK_SIZE]
+
+        def whole_page():
+            content = b"".join(chunks())
+            return json.loads(content.decode('utf-8'))['rows']
+
+        def streaming():
+            return c2n._iter_json_rows(chunks(), 'rows')
+
+        parsers = [('loads', whole_page), ('stream', streaming)]
+
+        if list(whole_page()) != list(streaming()):
+            sys.stderr.write("parsers disagree at page_size " + str(page_size) + "\n")
+            sys.exit(1)
+
+        for name, parse in parsers:
+            first_row = {}
+
+            def consume(keep):
+                stime = time.time()
+                kept = []
+                n_rows = 0
+                for r in parse():
+                    if n_rows == 0:
+                        first_row['time'] = time.time() - stime
+                    n_rows += 1
+                    if keep:
+                        kept.append(r)
+                return kept
+
+            elapsed = _best_time(lambda: consume(True), args.repeat)
+            print("{0:>10} {1:>8.1f} {2:>8} {3:>10.3f} {4:>14.4f} {5:>16.1f} {6:>16.1f}".format(
+                page_size, len(body) / 1048576.0, name, elapsed, first_row['time'],
+                _peak_mb(lambda: consume(False)), _peak_mb(lambda: consume(True))))
+
+# A few rows with the corner cases of the document cleanup that the synthetic
+# corpus lacks: blank keys at each level, three-level meta nesting (with and
+# without a keys_to_keep prefix), empty private URLs, meta keys that shadow
+# top-level fields and a linkage holding nothing but subset_of.
+def _normalize_corner_cases():
+    rows = []
+    for i in range(10):
+        doc_id = '%032x' % (i + 1)
+        rows.append({'id': doc_id, 'key': doc_id, 'value': {'rev': '1-abc'}, 'doc': {
+            '_id': doc_id, '_rev': '1-abc', 'node_type': 'visit_attr', ' ': 'blank', 'ver': 0,
+            'linkage': {'associated_with': ['v%d' % i], 'subset_of': ['x']},
+            'meta': {'urls': [''], '  ': 'blank', 'ver': 2, 'tags': [], 'id': 'shadowed',
+                     'mixs': {' ': 'blank', 'biome': 'gut', 'lat_lon': '', 'nested': {'a': 1, 'b': ''}},
+                     'walking': {'freq': {'days': 3, 'hours': 0}, ' ': 'kept'},
+                     'diet': {'meals': {'breakfast': 'yes', '': 'no'}, 'snacks': None}}}})
+        rows.append({'id': doc_id + 'b', 'doc': {'_id': doc_id + 'b', 'node_type': 'study', 'acl': {}, 'ns': 'ihmp',
+                                                 'linkage': {'subset_of': ['y']}, 'meta': {'name': 'n', 'urls': ['', '']}}})
+    return rows
+
+# Assert that _normalize_doc turns each of rows into the same document as the
+# original inline cleanup code, with the same key order.
+def _assert_normalize_matches_legacy(rows):
+    for row in rows:
+        legacy = _legacy_clean_doc(json.loads(json.dumps(row)))
+        normalized = c2n._normalize_doc(json.loads(json.dumps(row)))
+        if legacy is None:
+            assert normalized is None, "row {0} should have been dropped".format(row['id'])
+        else:
+            expected = json.dumps({'id': legacy['id'], 'doc': legacy['doc']})
+            assert json.dumps(normalized) == expected, "row {0} differs from the original cleanup".format(row['id'])
+
+# Check, with asserts, that _normalize_doc matches the original inline cleanup
+# on a small synthetic corpus plus the corner cases, and that the ways the
+# loader runs it (_normalize_rows, the --normalize_workers pool above and below
+# NORMALIZE_POOL_MIN_DOCS, and the --from_dump parser, plain and gzipped, in
+# one piece and in several) all give the same documents in the same order.
+def check_normalize(args):
+    rows = _synthetic_rows(args.n_subjects) + _normalize_corner_cases()
+    _assert_normalize_matches_legacy(rows)
+
+    expected = json.dumps(c2n._normalize_rows(json.loads(json.dumps(rows))))
+    deletion = {'id': 'gone', 'deleted': True}
+    assert c2n._normalize_rows([deletion]) == [deletion]
+
+    min_docs = c2n.NORMALIZE_POOL_MIN_DOCS
+    try:
+        for c2n.NORMALIZE_POOL_MIN_DOCS in [min_docs, 0]:
+            pooled = list(c2n._normalize_in_pool(json.loads(json.dumps(rows)), 2, 7))
+            assert json.dumps(pooled) == expected, "--normalize_workers output differs (NORMALIZE_POOL_MIN_DOCS = {0})".format(c2n.NORMALIZE_POOL_MIN_DOCS)
+    finally:
+        c2n.NORMALIZE_POOL_MIN_DOCS = min_docs
+
+    chunk_bytes = c2n.DUMP_CHUNK_BYTES
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        dump_path = os.path.join(tmp_dir, 'dump.json')
+        with open(dump_path, 'w') as dfile:
+            dfile.write('{"results":[\n')
+            for i, r in enumerate(rows):
+                dfile.write(json.dumps(dict(r, seq=i + 1)) + ',\n')
+            dfile.write('{"seq": %d, "id": "gone", "deleted": true}\n],\n"last_seq":%d}\n' % (len(rows) + 1, len(rows) + 1))
+        with open(dump_path, 'rb') as dfile, gzip.open(dump_path + '.gz', 'wb') as gfile:
+            gfile.write(dfile.read())
+        for path in [dump_path, dump_path + '.gz']:
+            for c2n.DUMP_CHUNK_BYTES in [chunk_bytes, 50000]:
+                state = {}
+                docs = list(c2n._docs_from_dump(path, 2, state))
+                assert docs[-1] == deletion, "--from_dump lost the deletion"
+                assert json.dumps(docs[:-1]) == expected, "--from_dump output of {0} differs (DUMP_CHUNK_BYTES = {1})".format(path, c2n.DUMP_CHUNK_BYTES)
+                assert state['last_seq'] == len(rows) + 1
+    finally:
+        c2n.DUMP_CHUNK_BYTES = chunk_bytes
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, name))
+        os.rmdir(tmp_dir)
+
+    print("_normalize_doc matches the original cleanup on {0} rows".format(len(rows)))
+
+# Compare the documents/second of the original inline cleanup code with
+# _normalize_doc, run inline and in process pools of various sizes, after
+# checking that they produce identical documents (with identical key order.)
+# Each timed run starts from a fresh copy of the rows, since both versions
+# modify them, and drops each input row once it has been read, as the loader
+# does (otherwise the garbage collector's cost is dominated by the inputs.)
+def bench_normalize(args):
+    rows = _synthetic_rows_at_least(args.n_docs) + _normalize_corner_cases()
+    n_rows = len(rows)
+    rows_json = json.dumps(rows)
+    del rows
+
+    def fresh_rows():
+        rs = json.loads(rows_json)
+        rs.reverse()
+        def drain():
+            while rs:
+                yield rs.pop()
+        return drain()
+
+    def legacy(rs):
+        cleaned = []
+        for r in rs:
+            r = _legacy_clean_doc(r)
+            if r is not None:
+                cleaned.append({'id': r['id'], 'doc': r['doc']})
+        return cleaned
+
+    def normalize(rs):
+        return c2n._normalize_rows(rs)
+
+    def normalize_pool(n_workers):
+        def run(rs):
+            return list(c2n._normalize_in_pool(rs, n_workers, args.page_size))
+        return run
+
+    _assert_normalize_matches_legacy(json.loads(rows_json))
+
+    versions = [('inline cleanup (original)', legacy), ('_normalize_doc', normalize)]
+    for n_workers in [int(x) for x in args.workers.split(',') if int(x) > 1]:
+        versions.append(('_normalize_doc, {0} processes'.format(n_workers), normalize_pool(n_workers)))
+
+    print("{0:>32} {1:>10} {2:>12} {3:>10}".format('version', 'seconds', 'docs/second', 'speedup'))
+    base = None
+    for name, fn in versions:
+        best = None
+        for i in range(args.repeat):
+            rs = fresh_rows()
+            stime = time.time()
+            fn(rs)
+            elapsed = time.time() - stime
+            if best is None or elapsed < best:
+                best = elapsed
+        if base is None:
+            base = best
+        print("{0:>32} {1:>10.3f} {2:>12.0f} {3:>9.2f}x".format(name, best, n_rows / best, base / best))
+
+# Return the given field (e.g. VmRSS, VmHWM) of /proc/self/status in MB.
+def _proc_status_mb(field):
+    with open('/proc/self/status') as sfile:
+        for line in sfile:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024.0
+
+# Add a normalized row to the dict of nodes as the loader used to, keeping the
+# whole row (a dict of dicts) for every document.
+def _legacy_add_doc_to_nodes(nodes, doc):
+    node_type = doc['doc']['node_type']
+    if node_type in nodes:
+        node_key = doc['id']
+        if node_type.endswith("attribute"):
+            if len(doc['doc']['linkage']['associated_with']) > 0:
+                node_key = doc['doc']['linkage']['associated_with'][0]
+            else:
+                return
+        nodes[node_type][node_key] = doc
+
+# Load an NDJSON file of rows into a dict of nodes (in a process of its own)
+# and send back the growth in resident set size, both at its peak and once the
+# loading is done.
+def _load_nodes_rss(rows_path, compact, results):
+    rss_start = _proc_status_mb('VmRSS')
+    nodes = dict((t, {}) for t in c2n.NODE_TYPES)
+    stime = time.time()
+    with open(rows_path) as rfile:
+        for line in rfile:
+            doc = c2n._normalize_doc(json.loads(line))
+            if doc is None:
+                continue
+            if compact:
+                c2n._add_doc_to_nodes(nodes, doc, {})
+            else:
+                _legacy_add_doc_to_nodes(nodes, doc)
+    elapsed = time.time() - stime
+    gc.collect()
+    results.put((_proc_status_mb('VmHWM') - rss_start, _proc_status_mb('VmRSS') - rss_start, elapsed))
+
+# Write the synthetic corpus to an NDJSON file (in a process of its own, so that
+# the memory used to generate it is not counted) and send back its length.
+def _write_rows(n_docs, rows_path, results):
+    rows = _synthetic_rows_at_least(n_docs)
+    with open(rows_path, 'w') as rfile:
+        for r in rows:
+            rfile.write(json.dumps(r) + "\n")
+    results.put(len(rows))
+
+# Run fn(*args, results) in a new process and return what it sends back.
+def _run_in_process(fn, *args):
+    results = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=fn, args=args + (results,))
+    proc.start()
+    result = results.get()
+    proc.join()
+    return result
+
+# Compare the memory used by the dict of nodes when every row is kept as
+# loaded (the original node store) and when documents are kept as compact
+# _NodeRecords. Each version loads the synthetic corpus from a file in a
+# fresh process, and the growth of that process' resident set is reported.
+def bench_nodes(args):
+    rows_fd, rows_path = tempfile.mkstemp(suffix='.json')
+    os.close(rows_fd)
+    try:
+        _run_in_process(_write_rows, args.n_docs, rows_path)
+        print("{0:>20} {1:>14} {2:>14} {3:>10}".format('node store', 'peak RSS MB', 'final RSS MB', 'seconds'))
+        base = None
+        for name, compact in [('dict rows (original)', False), ('_NodeRecord', True)]:
+            peak, final, elapsed = _run_in_process(_load_nodes_rss, rows_path, compact)
+            print("{0:>20} {1:>14.1f} {2:>14.1f} {3:>10.2f}".format(name, peak, final, elapsed))
+            if base is None:
+                base = peak
+        print("peak RSS reduction: {0:.2f}x".format(base / peak))
+    finally:
+        os.remove(rows_path)
+
+# The per-node-type _build_*_doc functions that couchdb2neo4j_with_tags.py used
+# before its UPSTREAM_RULES table, kept as the baseline (and reference output)
+# for _build_file_doc.
+def _legacy_build_16s_raw_seq_set_doc(all_nodes_dict,node):
+
+    doc = {}
+    doc['main'] = node
+
+    # If this is a pooled sample, build a different object that represents that state
+    if type(doc['main']['linkage']['sequenced_from']) is list and len(set(doc['main']['linkage']['sequenced_from'])) > 1:
+        doc['prep'] = c2n._multi_find_upstream_node(all_nodes_dict['16s_dna_prep'],'16s_dna_prep',doc['main']['linkage']['sequenced_from'])
+        return c2n._multi_collect_sample_through_project(all_nodes_dict,doc)
+
+    else:
+        doc['prep'] = c2n._find_upstream_node(all_nodes_dict['16s_dna_prep'],'16s_dna_prep',doc['main']['linkage']['sequenced_from'])
+        return c2n._collect_sample_through_project(all_nodes_dict,doc)
+
+def _legacy_build_16s_trimmed_seq_set_doc(all_nodes_dict,node):
+
+    doc = {}
+    doc['main'] = node
+
+    if type(doc['main']['linkage']['computed_from']) is list and len(set(doc['main']['linkage']['computed_from'])) > 1:
+        doc['16s_raw_seq_set'] = c2n._multi_find_upstream_node(all_nodes_dict['16s_raw_seq_set'],'16s_raw_seq_set',doc['main']['linkage']['computed_from'])
+        doc['prep'] = []
+        for x in range(0,len(doc['16s_raw_seq_set'])):
+            doc['prep'] += c2n._multi_find_upstream_node(all_nodes_dict['16s_dna_prep'],'16s_dna_prep',doc['16s_raw_seq_set'][x]['linkage']['sequenced_from'])
+        doc['prep'] = list({v['id']:v for v in doc['prep']}.values()) # uniquifying
+        doc['prep'] = c2n._isolate_relevant_prep_edge(doc)
+
+        if type(doc['prep']) is list:
+            return c2n._multi_collect_sample_through_project(all_nodes_dict,doc)
+
+    else:
+        doc['16s_raw_seq_set'] = c2n._find_upstream_node(all_nodes_dict['16s_raw_seq_set'],'16s_raw_seq_set',doc['main']['linkage']['computed_from'])
+        doc['prep'] = c2n._find_upstream_node(all_nodes_dict['16s_dna_prep'],'16s_dna_prep',doc['16s_raw_seq_set']['linkage']['sequenced_from'])
+
+    return c2n._collect_sample_through_project(all_nodes_dict,doc)
+
+def _legacy_build_abundance_matrix_doc(all_nodes_dict,node):
+
+    doc = {}
+
+    doc['main'] = node
+
+    # Notice that this IF precedes a second set of ELSE/IF statements, that is because
+    # if this is an abundance_matrix derived from an abundance_matrix, we still build the
+    # upstream structure in the same manner either way.
+    which_upstream,upstream = c2n._resolve_upstream_node(all_nodes_dict,doc['main'],doc['main']['linkage']['computed_from'],['abundance_matrix'] + c2n.ABUNDANCE_MATRIX_SOURCE_TYPES)
+    if which_upstream == 'abundance_matrix':
+        doc['abundance_matrix'] = upstream
+        # We now need to reset the link to be the other abundance_matrix
+        which_upstream,upstream = c2n._resolve_upstream_node(all_nodes_dict,doc['abundance_matrix'],doc['abundance_matrix']['linkage']['computed_from'],c2n.ABUNDANCE_MATRIX_SOURCE_TYPES)
+    if upstream is None:
+        return None
+
+    # process the middle pathway
+    if which_upstream == '16s_trimmed_seq_set':
+        doc['16s_trimmed_seq_set'] = upstream
+        doc['16s_raw_seq_set'] = c2n._find_upstream_node(all_nodes_dict['16s_raw_seq_set'],'16s_raw_seq_set',doc['16s_trimmed_seq_set']['linkage']['computed_from'])
+        doc['prep'] = c2n._find_upstream_node(all_nodes_dict['16s_dna_prep'],'16s_dna_prep',doc['16s_raw_seq_set']['linkage']['sequenced_from'])
+
+    elif which_upstream == 'viral_seq_set':
+        doc['viral_seq_set'] = upstream
+        doc['wgs_raw_seq_set'] = c2n._find_upstream_node(all_nodes_dict['wgs_raw_seq_set'],'wgs_raw_seq_set',doc['viral_seq_set']['linkage']['computed_from'])
+        doc['prep'] = c2n._find_upstream_node(all_nodes_dict['wgs_dna_prep'],'wgs_dna_prep',doc['wgs_raw_seq_set']['linkage']['sequenced_from'])
+
+    # process the left pathway
+    elif which_upstream in c2n.RAW_SEQ_SET_TYPES:
+        doc[which_upstream] = upstream
+        which_prep,doc['prep'] = c2n._resolve_upstream_node(all_nodes_dict,upstream,upstream['linkage']['sequenced_from'],c2n.SEQ_PREP_TYPES)
+        if doc['prep'] is None:
+            return None
+
+    # process the right pathway
+    elif which_upstream in c2n.OMES_TYPES:
+        doc[which_upstream] = upstream
+        which_prep,doc['prep'] = c2n._resolve_upstream_node(all_nodes_dict,upstream,upstream['linkage']['derived_from'],c2n.ASSAY_PREP_TYPES)
+        if doc['prep'] is None:
+            return None
+
+    else:
+        # create dummy prep for abundance matrix computed_from a study
+        doc['prep'] = {}
+
+    return c2n._collect_sample_through_project(all_nodes_dict,doc)
+
+def _legacy_build_omes_doc(all_nodes_dict,node):
+
+    doc = {}
+
+    doc['main'] = node
+
+    # can be microb or host
+    which_prep,doc['prep'] = c2n._resolve_upstream_node(all_nodes_dict,doc['main'],doc['main']['linkage']['derived_from'],c2n.ASSAY_PREP_TYPES)
+    if doc['prep'] is None:
+        return None
+
+    return c2n._collect_sample_through_project(all_nodes_dict,doc)
+
+def _legacy_build_wgs_transcriptomics_doc(all_nodes_dict,node):
+
+    doc = {}
+
+    doc['main'] = node
+
+    # can be wgs_dna or host_seq
+    which_prep,doc['prep'] = c2n._resolve_upstream_node(all_nodes_dict,doc['main'],doc['main']['linkage']['sequenced_from'],c2n.SEQ_PREP_TYPES)
+    if doc['prep'] is None:
+        return None
+
+    return c2n._collect_sample_through_project(all_nodes_dict,doc)
+
+def _legacy_build_wgs_assembled_or_viral_seq_set_doc(all_nodes_dict,node):
+
+    doc = {}
+
+    doc['main'] = node
+
+    # Assuming that WGS/HOST upstream nodes are never mixed, can identify using
+    # the first link which types the upstream and prep nodes are.
+    which_upstream,upstream = c2n._resolve_upstream_node(all_nodes_dict,doc['main'],doc['main']['linkage']['computed_from'],c2n.WGS_RAW_SEQ_SET_TYPES)
+    if upstream is None:
+        return None
+    doc[which_upstream] = upstream
+
+    which_prep,prep = c2n._resolve_upstream_node(all_nodes_dict,upstream,upstream['linkage']['sequenced_from'],c2n.SEQ_PREP_TYPES)
+    if prep is None:
+        return None
+
+    if type(doc['main']['linkage']['computed_from']) is list and len(set(doc['main']['linkage']['computed_from'])) > 1:
+        doc[which_upstream] = c2n._multi_find_upstream_node(all_nodes_dict[which_upstream],which_upstream,doc['main']['linkage']['computed_from'])
+        doc['prep'] = []
+        for x in range(0,len(doc[which_upstream])):
+            doc['prep'] += c2n._multi_find_upstream_node(all_nodes_dict[which_prep],which_prep,doc[which_upstream][x]['linkage']['sequenced_from'])
+        doc['prep'] = list({v['id']:v for v in doc['prep']}.values()) # uniquifying
+        doc['prep'] = c2n._isolate_relevant_prep_edge(doc)
+        if type(doc['prep']) is list:
+            return c2n._multi_collect_sample_through_project(all_nodes_dict,doc)
+
+    else:
+        doc['prep'] = prep
+
+    return c2n._collect_sample_through_project(all_nodes_dict,doc)
+
+def _legacy_build_annotation_doc(all_nodes_dict,node):
+
+    doc = {}
+
+    doc['main'] = node
+
+    which_upstream,upstream = c2n._resolve_upstream_node(all_nodes_dict,doc['main'],doc['main']['linkage']['computed_from'],c2n.ASSEMBLY_TYPES)
+    if upstream is None:
+        return None
+    doc[which_upstream] = upstream
+
+    which_upstream,upstream = c2n._resolve_upstream_node(all_nodes_dict,upstream,upstream['linkage']['computed_from'],c2n.WGS_RAW_SEQ_SET_TYPES)
+    if upstream is None:
+        return None
+    doc[which_upstream] = upstream
+
+    which_prep,doc['prep'] = c2n._resolve_upstream_node(all_nodes_dict,upstream,upstream['linkage']['sequenced_from'],c2n.SEQ_PREP_TYPES)
+    if doc['prep'] is None:
+        return None
+
+    return c2n._collect_sample_through_project(all_nodes_dict,doc)
+
+def _legacy_build_alignment_or_host_variant_call_doc(all_nodes_dict,node):
+
+    doc = {}
+
+    doc['main'] = node
+
+    which_upstream,upstream = c2n._resolve_upstream_node(all_nodes_dict,doc['main'],doc['main']['linkage']['computed_from'],['wgs_assembled_seq_set'] + c2n.WGS_RAW_SEQ_SET_TYPES)
+    if which_upstream == 'wgs_assembled_seq_set':
+        doc[which_upstream] = upstream
+        which_upstream,upstream = c2n._resolve_upstream_node(all_nodes_dict,upstream,upstream['linkage']['computed_from'],c2n.WGS_RAW_SEQ_SET_TYPES)
+    if upstream is None:
+        return None
+    doc[which_upstream] = upstream
+
+    which_prep,doc['prep'] = c2n._resolve_upstream_node(all_nodes_dict,upstream,upstream['linkage']['sequenced_from'],c2n.SEQ_PREP_TYPES)
+    if doc['prep'] is None:
+        return None
+
+    return c2n._collect_sample_through_project(all_nodes_dict,doc)
+
+def _legacy_build_clustered_seq_set_doc(all_nodes_dict,node):
+
+    doc = {}
+
+    doc['main'] = node
+
+    which_upstream,doc['annotation'] = c2n._resolve_upstream_node(all_nodes_dict,doc['main'],doc['main']['linkage']['computed_from'],['annotation'])
+    if doc['annotation'] is None:
+        return None
+
+    which_upstream,upstream = c2n._resolve_upstream_node(all_nodes_dict,doc['annotation'],doc['annotation']['linkage']['computed_from'],c2n.ASSEMBLY_TYPES)
+    if upstream is None:
+        return None
+    doc[which_upstream] = upstream
+
+    which_upstream,upstream = c2n._resolve_upstream_node(all_nodes_dict,upstream,upstream['linkage']['computed_from'],c2n.WGS_RAW_SEQ_SET_TYPES)
+    if upstream is None:
+        return None
+    doc[which_upstream] = upstream
+
+    which_prep,doc['prep'] = c2n._resolve_upstream_node(all_nodes_dict,upstream,upstream['linkage']['sequenced_from'],c2n.SEQ_PREP_TYPES)
+    if doc['prep'] is None:
+        return None
+
+    return c2n._collect_sample_through_project(all_nodes_dict,doc)
+
+# The legacy _build_*_doc function for each File node type in the synthetic
+# corpus (following the dispatch in couchdb2neo4j_with_tags.py's main loop.)
+_LEGACY_FILE_DOC_BUILDERS = {
+    '16s_raw_seq_set': _legacy_build_16s_raw_seq_set_doc,
+    '16s_trimmed_seq_set': _legacy_build_16s_trimmed_seq_set_doc,
+    'abundance_matrix': _legacy_build_abundance_matrix_doc,
+    'proteome': _legacy_build_omes_doc,
+    'metabolome': _legacy_build_omes_doc,
+    'lipidome': _legacy_build_omes_doc,
+    'cytokine': _legacy_build_omes_doc,
+    'wgs_raw_seq_set': _legacy_build_wgs_transcriptomics_doc,
+    'wgs_assembled_seq_set': _legacy_build_wgs_assembled_or_viral_seq_set_doc,
+    'annotation': _legacy_build_annotation_doc,
+    'clustered_seq_set': _legacy_build_clustered_seq_set_doc,
+    'alignment': _legacy_build_alignment_or_host_variant_call_doc,
+}
+
+# Load an NDJSON file of rows into a dict of nodes, kept either in memory or
+# (if store_path is given) in a _DiskNodeStore, then build the upstream doc of
+# every File node, in a process of its own. Sends back the load and build
+# times, the growth in resident set size at its peak, and the cache hit rate.
+def _load_and_build(rows_path, store_path, cache_size, traverse_cache_size, results):
+    rss_start = _proc_status_mb('VmRSS')
+    store = None
+    nodes = dict((t, {}) for t in c2n.NODE_TYPES)
+    if store_path is not None:
+        store = c2n._DiskNodeStore(store_path, cache_size)
+        nodes = dict((t, store.table(t)) for t in c2n.NODE_TYPES)
+        c2n.NODE_TYPE_INDEX = store.table(c2n.NODE_TYPE_INDEX_TABLE)
+        c2n.LINEAGE = store.table(c2n.LINEAGE_TABLE)
+    c2n.TRAVERSE_CACHE_SIZE = traverse_cache_size
+
+    stime = time.time()
+    with open(rows_path) as rfile:
+        for line in rfile:
+            doc = c2n._normalize_doc(json.loads(line))
+            if doc is not None:
+                c2n._add_doc_to_nodes(nodes, doc, {})
+    load_time = time.time() - stime
+    c2n._build_lineage_index(nodes, store)
+    c2n._build_srs_prep_index(nodes)
+
+    # _generate_cypher reads the command-line options of couchdb2neo4j_with_tags.py
+    c2n.args = argparse.Namespace(check_sample_file_uniqueness=False)
+    stime = time.time()
+    file_keys = list(c2n._file_node_keys(nodes))
+    c2n._generate_file_cypher(nodes, file_keys)
+    build_time = time.time() - stime
+
+    hit_pct = None
+    if store is not None:
+        hit_pct = 100.0 * store.n_cache_hits / max(store.n_reads, 1)
+        store.close()
+    results.put((load_time, build_time, len(file_keys), _proc_status_mb('VmHWM') - rss_start, hit_pct, len(c2n.TRAVERSE_CACHE)))
+
+# Compare keeping the dict of nodes in memory with keeping it in a
+# _DiskNodeStore (with LRU caches of various sizes), timing the load of the
+# synthetic corpus and the generation of the nodes and links of all File
+# nodes, and measuring the peak RSS of the whole run. The _traverse_document
+# cache is on, capped at the node store's cache size as the loader does; the
+# smallest store is also run with the cache unbounded, for comparison. Each
+# version runs in a fresh process.
+def bench_store(args):
+    rows_fd, rows_path = tempfile.mkstemp(suffix='.json')
+    os.close(rows_fd)
+    store_dir = tempfile.mkdtemp()
+    try:
+        _run_in_process(_write_rows, args.n_docs, rows_path)
+        store_path = os.path.join(store_dir, 'nodes.sqlite')
+        cache_sizes = [int(x) for x in args.cache_sizes.split(',')]
+        versions = [('in memory', None, c2n.NODE_CACHE_SIZE, c2n.NODE_CACHE_SIZE)]
+        for cache_size in cache_sizes:
+            versions.append(('sqlite, cache={0}'.format(cache_size), store_path, cache_size, cache_size))
+        versions.append(('sqlite, cache={0}, no cap'.format(min(cache_sizes)), store_path, min(cache_sizes), None))
+
+        print("{0:>28} {1:>10} {2:>10} {3:>12} {4:>12} {5:>10} {6:>14}".format('node store', 'load (s)', 'build (s)', 'files built/s', 'peak RSS MB', 'cache hits', 'traverse cache'))
+        for name, store_path, cache_size, traverse_cache_size in versions:
+            load_time, build_time, n_files, peak, hit_pct, n_cached = _run_in_process(_load_and_build, rows_path, store_path, cache_size, traverse_cache_size)
+            hits = '' if hit_pct is None else '{0:.1f}%'.format(hit_pct)
+            print("{0:>28} {1:>10.2f} {2:>10.2f} {3:>12.0f} {4:>12.1f} {5:>10} {6:>14}".format(name, load_time, build_time, n_files / build_time, peak, hits, n_cached))
+    finally:
+        os.remove(rows_path)
+        os.rmdir(store_dir)
+
+# Build the upstream doc of every File node in the dict of nodes of a type in
+# builders (a dict of node type -> _build_*_doc function, by default
+# _build_file_doc for every type in the synthetic corpus) and return them (as
+# strings, for comparison, if as_text is set.)
+def _build_file_docs(nodes, as_text=False, builders=None):
+    if builders is None:
+        builders = dict((t, c2n._build_file_doc) for t in _LEGACY_FILE_DOC_BUILDERS)
+    docs = []
+    for node_type, build in sorted(builders.items()):
+        for node_id in nodes[node_type]:
+            doc = build(nodes, nodes[node_type][node_id])
+            docs.append(repr(doc) if as_text else doc)
+    return docs
+
+# Compare building the upstream docs of all File nodes by walking each file's
+# lineage up to the project with building them from the LINEAGE index (and
+# the time taken to build the index), after checking that the docs built
+# both ways are identical.
+def bench_lineage(args):
+    nodes = dict((t, {}) for t in c2n.NODE_TYPES)
+    for r in _synthetic_rows_at_least(args.n_docs):
+        doc = c2n._normalize_doc(r)
+        if doc is not None:
+            c2n._add_doc_to_nodes(nodes, doc, {})
+
+    c2n._build_srs_prep_index(nodes)
+
+    c2n.LINEAGE.clear()
+    walked = _build_file_docs(nodes, True)
+    walk_time = _best_time(lambda: _build_file_docs(nodes), args.repeat)
+
+    def build_index():
+        c2n.LINEAGE.clear()
+        c2n._build_lineage_index(nodes)
+    index_time = _best_time(build_index, args.repeat)
+
+    if _build_file_docs(nodes, True) != walked:
+        sys.stderr.write("docs built with the lineage index differ from the walked ones\n")
+        sys.exit(1)
+    indexed_time = _best_time(lambda: _build_file_docs(nodes), args.repeat)
+
+    print("{0:>24} {1:>10}".format('stage', 'seconds'))
+    print("{0:>24} {1:>10.3f}".format('walk each lineage', walk_time))
+    print("{0:>24} {1:>10.3f}".format('build lineage index', index_time))
+    print("{0:>24} {1:>10.3f}".format('use lineage index', indexed_time))
+    print("speedup (including the index): {0:.2f}x".format(walk_time / (index_time + indexed_time)))
+
+# Compare building the upstream docs of all File nodes with the original
+# hand-written _build_*_doc functions and with _build_file_doc (which follows
+# the UPSTREAM_RULES table), after checking that both build identical docs.
+# The LINEAGE index is built first, as in the main loop.
+def bench_rules(args):
+    nodes = dict((t, {}) for t in c2n.NODE_TYPES)
+    for r in _synthetic_rows_at_least(args.n_docs):
+        doc = c2n._normalize_doc(r)
+        if doc is not None:
+            c2n._add_doc_to_nodes(nodes, doc, {})
+    c2n.LINEAGE.clear()
+    c2n._build_lineage_index(nodes)
+    c2n._build_srs_prep_index(nodes)
+
+    if _build_file_docs(nodes, True, _LEGACY_FILE_DOC_BUILDERS) != _build_file_docs(nodes, True):
+        sys.stderr.write("docs built with _build_file_doc differ from the ones built by the original functions\n")
+        sys.exit(1)
+    legacy_time = _best_time(lambda: _build_file_docs(nodes, False, _LEGACY_FILE_DOC_BUILDERS), args.repeat)
+    rules_time = _best_time(lambda: _build_file_docs(nodes), args.repeat)
+
+    n_docs = len(_build_file_docs(nodes))
+    print("{0:>24} {1:>10} {2:>12}".format('builder', 'seconds', 'docs/s'))
+    print("{0:>24} {1:>10.3f} {2:>12.0f}".format('_build_*_doc (original)', legacy_time, n_docs / legacy_time))
+    print("{0:>24} {1:>10.3f} {2:>12.0f}".format('_build_file_doc', rules_time, n_docs / rules_time))
+    print("speedup: {0:.2f}x".format(legacy_time / rules_time))
+
+# The nodes, links and tags generated so far, as a string for comparison.
+def _generated_text():
+    return repr((c2n.NODES, [c2n.NODE_LINKS[t]['links'] for t in sorted(c2n.NODE_LINKS)], c2n.TAGS, c2n.NODES_BY_TYPE, c2n.PROPS_BY_TYPE))
+
+# Compare building the nodes, links and tags of all File nodes in the main
+# process with building them in pools of forked workers (_generate_in_pool),
+# after checking that each pool generates the same nodes, links and tags, in
+# the same order.
+def bench_generate(args):
+    nodes = dict((t, {}) for t in c2n.NODE_TYPES)
+    for r in _synthetic_rows_at_least(args.n_docs):
+        doc = c2n._normalize_doc(r)
+        if doc is not None:
+            c2n._add_doc_to_nodes(nodes, doc, {})
+    c2n.LINEAGE.clear()
+    c2n._build_lineage_index(nodes)
+    c2n._build_srs_prep_index(nodes)
+    # _generate_cypher reads the command-line options of couchdb2neo4j_with_tags.py
+    c2n.args = argparse.Namespace(check_sample_file_uniqueness=False)
+    file_keys = list(c2n._file_node_keys(nodes))
+
+    def serial():
+        c2n._reset_generated()
+        c2n._generate_file_cypher(nodes, file_keys)
+    serial()
+    expected = _generated_text()
+    times = [('serial', _best_time(serial, args.repeat))]
+
+    for n_workers in [int(x) for x in args.workers.split(',')]:
+        def pooled():
+            c2n._reset_generated()
+            c2n._generate_in_pool(nodes, file_keys, n_workers)
+        pooled()
+        if _generated_text() != expected:
+            sys.stderr.write("nodes and links generated by {0} workers differ from the serial ones\n".format(n_workers))
+            sys.exit(1)
+        times.append(('{0} workers'.format(n_workers), _best_time(pooled, args.repeat)))
+
+    print("{0} File nodes, {1} CPU(s)".format(len(file_keys), multiprocessing.cpu_count()))
+    print("{0:>12} {1:>10} {2:>10}".format('generate', 'seconds', 'speedup'))
+    for name, elapsed in times:
+        print("{0:>12} {1:>10.3f} {2:>9.2f}x".format(name, elapsed, times[0][1] / elapsed))
+
+# The original search of each candidate prep, kept as the baseline (and
+# reference output) for _isolate_relevant_prep_edge's SRS_PREP_INDEX lookup.
+def _legacy_isolate_relevant_prep_edge(doc):
+    srs_tag = ""
+
+    # grab the SRS ID from the tags attached to the file
+    if 'tags' in doc['main']:
+        for tag in doc['main']['tags']:
+            if tag.startswith('SRS'):
+                srs_tag = tag
+
+    if srs_tag == "": # if found nothing in tags, check elsewhere
+        if 'meta' in doc['main']:
+            if 'assembly_name' in doc['main']['meta']:
+                srs_tag = doc['main']['meta']['assembly_name']
+
+    if srs_tag == "": # if found nothing in tags, check elsewhere
+        if 'assembly_name' in doc['main']:
+            srs_tag = doc['main']['assembly_name']
+
+    # iterate over all the prep edges til you find the one
+    for prep_edge in doc['prep']: # HMP I has 'srs_id'
+        if 'srs_id' in prep_edge:
+            if prep_edge['srs_id'] == srs_tag:
+                return prep_edge
+        elif 'tags' in prep_edge: # HMP II cases where SRS ID is in a tag
+            for tag in prep_edge['tags']:
+                if tag == srs_tag:
+                    return prep_edge
+        elif 'meta' in prep_edge:
+            if 'srs_id' in prep_edge['meta']:
+                if prep_edge['meta']['srs_id'] == srs_tag:
+                    return prep_edge
+            elif 'tags' in prep_edge['meta']:
+                for tag in prep_edge['meta']['tags']:
+                    if tag == srs_tag:
+                        return prep_edge
+
+    return doc['prep']
+
+# Compare isolating the prep of files pooled from pool_size preps (16S and
+# WGS preps of the synthetic corpus, i.e., both HMP I and HMP II layouts) by
+# searching each candidate prep and by looking the file's SRS id up in
+# SRS_PREP_INDEX, after checking that both find the same preps. One file in
+# ten has an SRS id that none of its candidate preps has.
+def bench_srs(args):
+    nodes = dict((t, {}) for t in c2n.NODE_TYPES)
+    for r in _synthetic_rows_at_least(args.n_docs):
+        doc = c2n._normalize_doc(r)
+        if doc is not None:
+            c2n._add_doc_to_nodes(nodes, doc, {})
+
+    rnd = random.Random(0)
+    preps = list(nodes['16s_dna_prep'].values()) + list(nodes['wgs_dna_prep'].values())
+    docs = []
+    for i in range(args.n_files):
+        pool = rnd.sample(preps, args.pool_size)
+        srs_tag = 'SRS_NONE'
+        if i % 10 != 0:
+            field, srs_ids = c2n._prep_srs_ids(rnd.choice(pool))
+            srs_tag = srs_ids[0]
+        main = c2n._NodeRecord([('id', 'f%d' % i), ('node_type', '16s_trimmed_seq_set'), ('subtype', 'trimmed_16s'), ('tags', ['trimmed', srs_tag])])
+        docs.append({'main': main, 'prep': pool})
+
+    def isolate_all(isolate):
+        return [isolate(doc) for doc in docs]
+
+    legacy = isolate_all(_legacy_isolate_relevant_prep_edge)
+    legacy_time = _best_time(lambda: isolate_all(_legacy_isolate_relevant_prep_edge), args.repeat)
+
+    def build_index():
+        c2n.SRS_PREP_INDEX.clear()
+        c2n._build_srs_prep_index(nodes)
+    index_time = _best_time(build_index, args.repeat)
+
+    if isolate_all(c2n._isolate_relevant_prep_edge) != legacy:
+        sys.stderr.write("preps isolated with SRS_PREP_INDEX differ from the ones found by searching\n")
+        sys.exit(1)
+    indexed_time = _best_time(lambda: isolate_all(c2n._isolate_relevant_prep_edge), args.repeat)
+
+    print("{0} files pooled from {1} preps each".format(args.n_files, args.pool_size))
+    print("{0:>24} {1:>10}".format('stage', 'seconds'))
+    print("{0:>24} {1:>10.3f}".format('search each prep', legacy_time))
+    print("{0:>24} {1:>10.3f}".format('build SRS index', index_time))
+    print("{0:>24} {1:>10.3f}".format('use SRS index', indexed_time))
+    print("speedup (excluding the index): {0:.2f}x".format(legacy_time / indexed_time))
+    print("prep fields matched: " + ", ".join("{0}={1}".format(f, c) for f, c in sorted(c2n.SRS_MATCH_COUNTS.items())))
+
+# Compare building the nodes, links and tags of all File nodes with and
+# without the _traverse_document cache, after checking that both generate
+# the same nodes, links and tags. The cache is emptied before each run.
+def bench_traverse(args):
+    nodes = dict((t, {}) for t in c2n.NODE_TYPES)
+    for r in _synthetic_rows_at_least(args.n_docs):
+        doc = c2n._normalize_doc(r)
+        if doc is not None:
+            c2n._add_doc_to_nodes(nodes, doc, {})
+    c2n.LINEAGE.clear()
+    c2n._build_lineage_index(nodes)
+    c2n._build_srs_prep_index(nodes)
+    # _generate_cypher reads the command-line options of couchdb2neo4j_with_tags.py
+    c2n.args = argparse.Namespace(check_sample_file_uniqueness=False)
+    file_keys = list(c2n._file_node_keys(nodes))
+    cached_nodes = c2n.TRAVERSE_CACHED_NODES
+
+    def generate():
+        c2n._reset_generated()
+        c2n.TRAVERSE_CACHE.clear()
+        c2n._generate_file_cypher(nodes, file_keys)
+
+    results = []
+    for name, node_types in [('uncached', ()), ('cached', cached_nodes)]:
+        c2n.TRAVERSE_CACHED_NODES = node_types
+        generate()
+        results.append((name, _generated_text(), _best_time(generate, args.repeat)))
+    c2n.TRAVERSE_CACHED_NODES = cached_nodes
+    if results[0][1] != results[1][1]:
+        sys.stderr.write("nodes and links generated with the traversal cache differ from the uncached ones\n")
+        sys.exit(1)
+
+    print("{0} File nodes".format(len(file_keys)))
+    print("{0:>12} {1:>10} {2:>12}".format('traverse', 'seconds', 'files/s'))
+    for name, text, elapsed in results:
+        print("{0:>12} {1:>10.3f} {2:>12.0f}".format(name, elapsed, len(file_keys) / elapsed))
+    print("speedup: {0:.2f}x".format(results[0][2] / results[1][2]))
+    c2n._print_traverse_cache_stats()
+
+# Stand-in for a py2neo Graph that drops everything it is sent.
+class _NullGraph(object):
+    def begin(self):
+        return self
+    def run(self, cypher, params=None):
+        pass
+    def commit(self):
+        pass
+
+# The original _do_cypher_insert, for properties kept as lists of
+# {'key': k, 'value': v} dicts, kept as the baseline for _PropRecords.
+def _legacy_do_cypher_insert(cy, insert_cypher, obj_list, batch_size):
+    sig_to_objs = {}
+    if '<PROPS>' in insert_cypher:
+        for obj in obj_list:
+            sig = "||".join(sorted([p['key'] for p in obj['_props']]))
+            c2n._add_to_group(sig_to_objs, obj, sig)
+    else:
+        sig_to_objs[''] = obj_list
+    for sig in sorted(sig_to_objs.keys()):
+        o_list = sig_to_objs[sig]
+        props_cypher = ", ".join(["`" + p + "`: o.`" + p + "`" for p in sig.split("||")])
+        ins_cypher = insert_cypher.replace('<PROPS>', props_cypher)
+        new_o_list = []
+        for obj in o_list:
+            new_obj = {}
+            for k in obj:
+                if k == '_props':
+                    for p in obj['_props']:
+                        new_obj[p['key']] = p['value']
+                else:
+                    new_obj[k] = obj[k]
+            new_o_list.append(new_obj)
+        for start in range(0, len(o_list), batch_size):
+            tx = cy.begin()
+            tx.run(ins_cypher, {'objects': new_o_list[start:start + batch_size]})
+            tx.commit()
+
+# Return the result of fn() and the number of memory blocks it left allocated.
+def _retained_blocks(fn):
+    gc.collect()
+    gc.disable()
+    before = sys.getallocatedblocks()
+    result = fn()
+    after = sys.getallocatedblocks()
+    gc.enable()
+    return result, after - before
+
+# Compare the properties of the generated nodes and links as lists of
+# {'key': k, 'value': v} dicts with _PropRecords: the memory blocks they
+# hold, and the time and peak allocation of turning them into the objects
+# sent to Neo4j. Records shared by several links (those of preps) are
+# shared in both versions.
+def bench_props(args):
+    nodes = dict((t, {}) for t in c2n.NODE_TYPES)
+    for r in _synthetic_rows_at_least(args.n_docs):
+        doc = c2n._normalize_doc(r)
+        if doc is not None:
+            c2n._add_doc_to_nodes(nodes, doc, {})
+    c2n.LINEAGE.clear()
+    c2n._build_lineage_index(nodes)
+    c2n._build_srs_prep_index(nodes)
+    # _generate_cypher and _do_cypher_insert read the command-line options of couchdb2neo4j_with_tags.py
+    c2n.args = argparse.Namespace(check_sample_file_uniqueness=False, batch_size=args.batch_size, insert_workers=1)
+    c2n._reset_generated()
+    c2n._generate_file_cypher(nodes, list(c2n._file_node_keys(nodes)))
+
+    inserts = []
+    for node_type in sorted(c2n.NODES):
+        cypher = "UNWIND $objects as o MERGE (n:" + node_type + "{ <PROPS> })"
+        inserts.append((cypher, c2n.NODES[node_type]))
+    for link_type in sorted(c2n.NODE_LINKS):
+        if '<PROPS>' in c2n.NODE_LINKS[link_type]['cypher']:
+            inserts.append((c2n.NODE_LINKS[link_type]['cypher'], c2n.NODE_LINKS[link_type]['links']))
+    records = {}
+    for cypher, obj_list in inserts:
+        for obj in obj_list:
+            records[id(obj['_props'])] = obj['_props']
+
+    def as_lists():
+        return dict((k, [{'key': pk, 'value': pv} for pk, pv in rec.items()]) for k, rec in records.items())
+    def as_records():
+        return dict((k, c2n._PropRecord(rec.items())) for k, rec in records.items())
+    legacy_props, legacy_blocks = _retained_blocks(as_lists)
+    new_props, new_blocks = _retained_blocks(as_records)
+    # the dict of copies itself is counted in both
+    legacy_inserts = [(cypher, [dict(obj, _props=legacy_props[id(obj['_props'])]) for obj in obj_list]) for cypher, obj_list in inserts]
+    new_inserts = [(cypher, [dict(obj, _props=new_props[id(obj['_props'])]) for obj in obj_list]) for cypher, obj_list in inserts]
+
+    cy = _NullGraph()
+    def legacy_insert():
+        for cypher, obj_list in legacy_inserts:
+            _legacy_do_cypher_insert(cy, cypher, obj_list, args.batch_size)
+    def new_insert():
+        for cypher, obj_list in new_inserts:
+            c2n._do_cypher_insert(cy, cypher, obj_list, 'objects')
+    legacy_time = _best_time(legacy_insert, args.repeat)
+    new_time = _best_time(new_insert, args.repeat)
+    legacy_peak = _peak_mb(legacy_insert)
+    new_peak = _peak_mb(new_insert)
+
+    n_objs = sum(len(obj_list) for cypher, obj_list in inserts)
+    print("{0} objects with properties, {1} distinct property sets".format(n_objs, len(records)))
+    print("{0:>20} {1:>14} {2:>14} {3:>16}".format('properties', 'blocks held', 'insert (s)', 'insert peak MB'))
+    print("{0:>20} {1:>14} {2:>14.3f} {3:>16.1f}".format('key/value dicts', legacy_blocks, legacy_time, legacy_peak))
+    print("{0:>20} {1:>14} {2:>14.3f} {3:>16.1f}".format('_PropRecord', new_blocks, new_time, new_peak))
+    print("speedup: {0:.2f}x".format(legacy_time / new_time))
+
+# Stand-in for a py2neo Graph whose commits take commit_us microseconds per
+# object (sleeping, so that other threads can run meanwhile.)
+class _SlowGraph(_NullGraph):
+    def __init__(self, commit_us):
+        self.commit_us = commit_us
+    def run(self, cypher, params=None):
+        if params is not None:
+            time.sleep(len(params['objects']) * self.commit_us / 1000000.0)
+
+# Compare building all nodes and links and then inserting them with
+# --pipeline, which commits batches from a separate thread while the rest
+# are being built, against a Neo4j stand-in with a fixed commit time per
+# object: total time, and the peak allocation of the whole stage.
+def bench_pipeline(args):
+    nodes = dict((t, {}) for t in c2n.NODE_TYPES)
+    for r in _synthetic_rows_at_least(args.n_docs):
+        doc = c2n._normalize_doc(r)
+        if doc is not None:
+            c2n._add_doc_to_nodes(nodes, doc, {})
+    c2n.LINEAGE.clear()
+    c2n._build_lineage_index(nodes)
+    c2n._build_srs_prep_index(nodes)
+    # _generate_cypher and _do_cypher_insert read the command-line options of couchdb2neo4j_with_tags.py
+    c2n.args = argparse.Namespace(check_sample_file_uniqueness=False, batch_size=args.batch_size, insert_workers=1)
+    file_keys = list(c2n._file_node_keys(nodes))
+    cy = _SlowGraph(args.commit_us)
+
+    def sequential():
+        c2n._reset_generated()
+        c2n.TRAVERSE_CACHE.clear()
+        c2n._generate_file_cypher(nodes, file_keys)
+        for node_type in c2n.NODE_INSERT_ORDER:
+            c2n._insert_nodes(cy, node_type)
+        for link_type in c2n.LINK_INSERT_ORDER:
+            c2n._insert_links(cy, link_type)
+    def pipelined():
+        c2n._reset_generated()
+        c2n.TRAVERSE_CACHE.clear()
+        pipeline = c2n._InsertPipeline(cy, args.batch_size, args.queue_size)
+        c2n._generate_file_cypher(nodes, file_keys, pipeline)
+        pipeline.finish()
+
+    results = []
+    for name, fn in [('sequential', sequential), ('pipelined', pipelined)]:
+        results.append((name, _best_time(fn, args.repeat), _peak_mb(fn)))
+
+    print("{0} File nodes, {1} us per committed object, batch size {2}".format(len(file_keys), args.commit_us, args.batch_size))
+    print("{0:>12} {1:>10} {2:>10}".format('insert', 'seconds', 'peak MB'))
+    for name, elapsed, peak in results:
+        print("{0:>12} {1:>10.3f} {2:>10.1f}".format(name, elapsed, peak))
+    print("speedup: {0:.2f}x".format(results[0][1] / results[1][1]))
+
+# The original --check_sample_file_uniqueness check of one sample-file link,
+# which kept the pformatted property list of each link in unique_links.
+def _legacy_check_sample_file_link(unique_links, lkey, props):
+    prop_list = sorted((k, v) for k, v in props.items() if k != 'id')
+    pp = pprint.PrettyPrinter(indent=2)
+    props_str = pp.pformat(prop_list)
+    if lkey in unique_links:
+        props_d = unique_links[lkey]
+        if props_str in props_d:
+            return 1
+        props_d[props_str] = True
+    else:
+        unique_links[lkey] = { props_str: True }
+    return 0
+
+# Compare the original and the hash-based --check_sample_file_uniqueness
+# checks over the sample-file links of the synthetic corpus, with every
+# --dup_every'th link repeated, after checking that both find the same
+# number of duplicates.
+def bench_uniqueness(args):
+    nodes = dict((t, {}) for t in c2n.NODE_TYPES)
+    for r in _synthetic_rows_at_least(args.n_docs):
+        doc = c2n._normalize_doc(r)
+        if doc is not None:
+            c2n._add_doc_to_nodes(nodes, doc, {})
+    c2n.LINEAGE.clear()
+    c2n._build_lineage_index(nodes)
+    c2n._build_srs_prep_index(nodes)
+    # _generate_cypher reads the command-line options of couchdb2neo4j_with_tags.py
+    c2n.args = argparse.Namespace(check_sample_file_uniqueness=False)
+    c2n._reset_generated()
+    c2n._generate_file_cypher(nodes, list(c2n._file_node_keys(nodes)))
+    links = []
+    for link in c2n.NODE_LINKS['sample-file']['links']:
+        links.append((":".join([link['sample_id'], link['file_id']]), link['_props']))
+    links.extend(links[::args.dup_every])
+
+    counts = {}
+    def legacy():
+        unique_links = {}
+        counts['legacy'] = sum(_legacy_check_sample_file_link(unique_links, lkey, props) for lkey, props in links)
+    def hashed():
+        c2n.SAMPLE_FILE_PROPS.clear()
+        c2n.SAMPLE_FILE_DUPLICATES.clear()
+        for lkey, props in links:
+            c2n._check_sample_file_link(lkey, c2n._link_props_hash(props))
+        counts['hashed'] = c2n.SAMPLE_FILE_DUPLICATES.get('identical', 0)
+    legacy_time = _best_time(legacy, args.repeat)
+    hashed_time = _best_time(hashed, args.repeat)
+    if counts['legacy'] != counts['hashed']:
+        sys.stderr.write("found {0} duplicates with pprint and {1} with hashes\n".format(counts['legacy'], counts['hashed']))
+        sys.exit(1)
+
+    print("{0} sample-file links, {1} duplicates".format(len(links), counts['hashed']))
+    print("{0:>10} {1:>10} {2:>12}".format('check', 'seconds', 'links/s'))
+    print("{0:>10} {1:>10.3f} {2:>12.0f}".format('pprint', legacy_time, len(links) / legacy_time))
+    print("{0:>10} {1:>10.3f} {2:>12.0f}".format('hash', hashed_time, len(links) / hashed_time))
+    print("speedup: {0:.2f}x".format(legacy_time / hashed_time))
+
+# Compare inserting all nodes and links one batch at a time with
+# --insert_workers, against a Neo4j stand-in with a fixed commit time per
+# object (which, like a server, can serve several transactions at once.)
+# Also shows how evenly the links of each type are split between workers.
+def bench_insert(args):
+    nodes = dict((t, {}) for t in c2n.NODE_TYPES)
+    for r in _synthetic_rows_at_least(args.n_docs):
+        doc = c2n._normalize_doc(r)
+        if doc is not None:
+            c2n._add_doc_to_nodes(nodes, doc, {})
+    c2n.LINEAGE.clear()
+    c2n._build_lineage_index(nodes)
+    c2n._build_srs_prep_index(nodes)
+    # _generate_cypher and _do_cypher_insert read the command-line options of couchdb2neo4j_with_tags.py
+    c2n.args = argparse.Namespace(check_sample_file_uniqueness=False, batch_size=args.batch_size, insert_workers=1)
+    c2n._reset_generated()
+    c2n._generate_file_cypher(nodes, list(c2n._file_node_keys(nodes)))
+    cy = _SlowGraph(args.commit_us)
+    n_workers_list = [int(x) for x in args.workers.split(',')]
+
+    def insert_all():
+        for node_type in c2n.NODE_INSERT_ORDER:
+            c2n._insert_nodes(cy, node_type)
+        for link_type in c2n.LINK_INSERT_ORDER:
+            c2n._insert_links(cy, link_type)
+
+    times = []
+    for n_workers in [1] + n_workers_list:
+        c2n.args.insert_workers = n_workers
+        times.append((n_workers, _best_time(insert_all, args.repeat)))
+
+    n_objs = sum(len(c2n.NODES[t]) for t in c2n.NODES) + sum(len(c2n.NODE_LINKS[t]['links']) for t in c2n.NODE_LINKS)
+    print("{0} nodes and links, {1} us per committed object, batch size {2}".format(n_objs, args.commit_us, args.batch_size))
+    print("{0:>8} {1:>10} {2:>10}".format('workers', 'seconds', 'speedup'))
+    for n_workers, elapsed in times:
+        print("{0:>8} {1:>10.3f} {2:>9.2f}x".format(n_workers, elapsed, times[0][1] / elapsed))
+    print("links per worker with {0} workers:".format(n_workers_list[-1]))
+    for link_type in c2n.LINK_INSERT_ORDER:
+        links = c2n.NODE_LINKS[link_type]
+        partitions = c2n._partition_links(links['links'], links['ends'], n_workers_list[-1], links.get('shared_ends', ()))
+        print("  {0}: {1}".format(link_type, ", ".join(str(len(p)) for p in partitions)))
+
+class _LatencyGraph(_NullGraph):
+    """
+    A Neo4j stand-in whose commit time has a fixed part (overhead_ms) and a
+    part per object and property (prop_us) that grows as batches get larger
+    than knee objects, like a transaction whose state no longer fits in the
+    page cache.
+    """
+    def __init__(self, overhead_ms, prop_us, knee):
+        self.overhead_ms = overhead_ms
+        self.prop_us = prop_us
+        self.knee = knee
+    def run(self, cypher, params=None):
+        if params is not None:
+            objs = params['objects']
+            per_obj = len(objs[0]) * self.prop_us / 1000000.0
+            time.sleep(self.overhead_ms / 1000.0 + len(objs) * per_obj * (1.0 + float(len(objs)) / self.knee))
+
+# Compare fixed batch sizes against batch sizes adapted toward a target commit
+# time (--target_commit_seconds), against a Neo4j stand-in whose commits cost
+# more per object for objects with more properties and for larger batches.
+def bench_adaptive(args):
+    nodes = dict((t, {}) for t in c2n.NODE_TYPES)
+    for r in _synthetic_rows_at_least(args.n_docs):
+        doc = c2n._normalize_doc(r)
+        if doc is not None:
+            c2n._add_doc_to_nodes(nodes, doc, {})
+    c2n.LINEAGE.clear()
+    c2n._build_lineage_index(nodes)
+    c2n._build_srs_prep_index(nodes)
+    # _generate_cypher and _do_cypher_insert read the command-line options of couchdb2neo4j_with_tags.py
+    c2n.args = argparse.Namespace(check_sample_file_uniqueness=False, batch_size=args.batch_size, insert_workers=1)
+    c2n._reset_generated()
+    c2n._generate_file_cypher(nodes, list(c2n._file_node_keys(nodes)))
+    cy = _LatencyGraph(args.overhead_ms, args.prop_us, args.knee)
+    stages = [(t, c2n._insert_nodes) for t in c2n.NODE_INSERT_ORDER] + [(t, c2n._insert_links) for t in c2n.LINK_INSERT_ORDER]
+
+    # seconds per insert stage
+    def insert_all():
+        times = []
+        for obj_type, insert in stages:
+            stime = time.time()
+            insert(cy, obj_type)
+            times.append(time.time() - stime)
+        return times
+
+    results = []
+    c2n.BATCH_SIZER = None
+    for batch_size in [int(x) for x in args.batch_sizes.split(',')]:
+        c2n.args.batch_size = batch_size
+        results.append((str(batch_size), insert_all()))
+    c2n.args.batch_size = args.batch_size
+    c2n.BATCH_SIZER = c2n._BatchSizer(args.batch_size, args.target_seconds)
+    results.append(('adaptive', insert_all()))
+    c2n.BATCH_SIZER = None
+
+    print("{0} ms per commit, {1} us per committed property, knee at {2} objects, adaptive target {3} second(s) from batch size {4}".format(args.overhead_ms, args.prop_us, args.knee, args.target_seconds, args.batch_size))
+    print("{0:>16}".format('stage') + "".join("{0:>10}".format(name) for name, times in results))
+    for i in range(0, len(stages)):
+        print("{0:>16}".format(stages[i][0]) + "".join("{0:>10.3f}".format(times[i]) for name, times in results))
+    print("{0:>16}".format('total') + "".join("{0:>10.3f}".format(sum(times)) for name, times in results))
+
+# Return the single value of a Cypher query that returns one row with column n.
+def _cypher_count(cy, query):
+    for record in cy.run(query):
+        return record['n']
+    return 0
+
+# Exit unless the Neo4j database is empty, as the benchmarks that load it
+# delete all of its nodes afterwards.
+def _check_empty_db(cy):
+    if _cypher_count(cy, "MATCH (n) RETURN count(n) AS n") > 0:
+        sys.stderr.write("the Neo4j database is not empty\n")
+        sys.exit(1)
+
+# Compare inserting the has_tag (file-tag) links, the largest set of links,
+# with a MATCH of each end by its id property against --link_by_internal_id,
+# into a live, empty Neo4j instance that holds the nodes of the synthetic
+# corpus. The links are deleted after each run, and the nodes at the end.
+# --link_by_internal_id is experimental until this has been run on a server.
+def bench_link_ids(args):
+    cy = c2n.Graph(host=args.neo4j_host, password=args.neo4j_password, bolt_port=args.bolt_port, http_port=args.http_port)
+    _check_empty_db(cy)
+    neo4j_ver = ".".join([str(x) for x in cy.database.kernel_version])
+    for node, prop in c2n.CONSTRAINT_INDEXES:
+        c2n._build_constraint_index(node, prop, cy)
+
+    nodes = dict((t, {}) for t in c2n.NODE_TYPES)
+    for r in _synthetic_rows_at_least(args.n_docs):
+        doc = c2n._normalize_doc(r)
+        if doc is not None:
+            c2n._add_doc_to_nodes(nodes, doc, {})
+    c2n.LINEAGE.clear()
+    c2n._build_lineage_index(nodes)
+    c2n._build_srs_prep_index(nodes)
+    # _generate_cypher and _do_cypher_insert read the command-line options of couchdb2neo4j_with_tags.py
+    c2n.args = argparse.Namespace(check_sample_file_uniqueness=False, batch_size=args.batch_size, insert_workers=1)
+    c2n._reset_generated()
+    c2n._generate_file_cypher(nodes, list(c2n._file_node_keys(nodes)))
+
+    # the node inserts return the internal ids used by the second run
+    c2n.INTERNAL_IDS = dict((node_type + " nodes", {}) for node_type in c2n.NODE_INSERT_ORDER)
+    for node_type in c2n.NODE_INSERT_ORDER:
+        c2n._insert_nodes(cy, node_type)
+
+    results = []
+    for name, internal_ids in [('MATCH by id', None), ('internal id', c2n.INTERNAL_IDS)]:
+        c2n.INTERNAL_IDS = internal_ids
+        stime = time.time()
+        c2n._insert_links(cy, 'file-tag')
+        elapsed = time.time() - stime
+        n_rels = _cypher_count(cy, "MATCH ()-[r:has_tag]->() RETURN count(r) AS n")
+        results.append((name, elapsed, n_rels))
+        while _cypher_count(cy, "MATCH ()-[r:has_tag]->() WITH r LIMIT 10000 DELETE r RETURN count(*) AS n") > 0:
+            pass
+    c2n.INTERNAL_IDS = None
+    while _cypher_count(cy, "MATCH (n) WITH n LIMIT 10000 DETACH DELETE n RETURN count(*) AS n") > 0:
+        pass
+    if results[0][2] != results[1][2]:
+        sys.stderr.write("the two runs inserted different numbers of has_tag links\n")
+        sys.exit(1)
+
+    n_links = len(c2n.NODE_LINKS['file-tag']['links'])
+    print("Neo4j {0}, {1} has_tag links, batch size {2}".format(neo4j_ver, n_links, args.batch_size))
+    print("{0:>12} {1:>10} {2:>10} {3:>14}".format('links by', 'seconds', 'links/s', 'relationships'))
+    for name, elapsed, n_rels in results:
+        print("{0:>12} {1:>10.3f} {2:>10.0f} {3:>14}".format(name, elapsed, n_links / elapsed, n_rels))
+    print("speedup: {0:.2f}x".format(results[0][1] / results[1][1]))
+
+# Time writing all nodes and links as neo4j-admin import CSV files
+# (--csv_dir), next to the client side alone of inserting them through
+# Cypher (into a stand-in graph that discards them.)
+def bench_csv(args):
+    nodes = dict((t, {}) for t in c2n.NODE_TYPES)
+    for r in _synthetic_rows_at_least(args.n_docs):
+        doc = c2n._normalize_doc(r)
+        if doc is not None:
+            c2n._add_doc_to_nodes(nodes, doc, {})
+    c2n.LINEAGE.clear()
+    c2n._build_lineage_index(nodes)
+    c2n._build_srs_prep_index(nodes)
+    # _generate_cypher and _do_cypher_insert read the command-line options of couchdb2neo4j_with_tags.py
+    c2n.args = argparse.Namespace(check_sample_file_uniqueness=False, batch_size=args.batch_size, insert_workers=1)
+    c2n.CSV_IMPORT = True
+    c2n._reset_generated()
+    c2n._generate_file_cypher(nodes, list(c2n._file_node_keys(nodes)))
+    c2n.CSV_IMPORT = False
+    n_objs = sum(len(c2n.NODES[t]) for t in c2n.NODES) + sum(len(c2n.NODE_LINKS[t]['links']) for t in c2n.NODE_LINKS)
+
+    cy = _NullGraph()
+    def insert_all():
+        for node_type in c2n.NODE_INSERT_ORDER:
+            c2n._insert_nodes(cy, node_type)
+        for link_type in c2n.LINK_INSERT_ORDER:
+            c2n._insert_links(cy, link_type)
+    insert_time = _best_time(insert_all, args.repeat)
+
+    csv_dir = tempfile.mkdtemp()
+    try:
+        csv_time = _best_time(lambda: c2n._write_import_csvs(csv_dir), args.repeat)
+        csv_files = os.listdir(csv_dir)
+        csv_mb = sum(os.path.getsize(os.path.join(csv_dir, f)) for f in csv_files) / 1048576.0
+    finally:
+        for f in os.listdir(csv_dir):
+            os.remove(os.path.join(csv_dir, f))
+        os.rmdir(csv_dir)
+
+    print("{0} nodes and links, {1} files ({2:.1f} MB) of CSV".format(n_objs, len(csv_files), csv_mb))
+    print("{0:>24} {1:>10} {2:>12}".format('output', 'seconds', 'objects/s'))
+    print("{0:>24} {1:>10.3f} {2:>12.0f}".format('Cypher (client side)', insert_time, n_objs / insert_time))
+    print("{0:>24} {1:>10.3f} {2:>12.0f}".format('neo4j-admin import CSV', csv_time, n_objs / csv_time))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for couchdb2neo4j_with_tags.py on a synthetic OSDF corpus.')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    parse_parser = subparsers.add_parser('parse', help='Whole-page json.loads vs. incremental parsing of _all_docs pages.')
+    parse_parser.add_argument('--page_sizes', type=str, default='1000,10000,50000', help='Comma-separated list of page sizes (documents per page) to compare.')
+    parse_parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs per page size (the fastest is reported).')
+    parse_parser.set_defaults(func=bench_parse)
+
+    normalize_parser = subparsers.add_parser('normalize', help='Original inline document cleanup vs. _normalize_doc, inline and in a process pool.')
+    normalize_parser.add_argument('--n_docs', type=int, default=200000, help='Number of synthetic documents to normalize.')
+    normalize_parser.add_argument('--workers', type=str, default='2,4', help='Comma-separated list of process pool sizes to time.')
+    normalize_parser.add_argument('--page_size', type=int, default=1000, help='Documents per page handed to each pool process.')
+    normalize_parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs per version (the fastest is reported).')
+    normalize_parser.set_defaults(func=bench_normalize)
+
+    check_normalize_parser = subparsers.add_parser('check_normalize', help='Assert that _normalize_doc, inline, in a process pool and in the --from_dump parser, matches the original inline cleanup.')
+    check_normalize_parser.add_argument('--n_subjects', type=int, default=20, help='Number of subjects in the synthetic corpus (46 rows each).')
+    check_normalize_parser.set_defaults(func=check_normalize)
+
+    nodes_parser = subparsers.add_parser('nodes', help='Resident memory of the dict of nodes: full rows vs. _NodeRecords.')
+    nodes_parser.add_argument('--n_docs', type=int, default=500000, help='Number of synthetic documents to load.')
+    nodes_parser.set_defaults(func=bench_nodes)
+
+    store_parser = subparsers.add_parser('store', help='In-memory vs. sqlite3-backed (--node_store) dict of nodes.')
+    store_parser.add_argument('--n_docs', type=int, default=200000, help='Number of synthetic documents to load.')
+    store_parser.add_argument('--cache_sizes', type=str, default='1000,100000', help='Comma-separated list of LRU cache sizes (records) to time.')
+    store_parser.set_defaults(func=bench_store)
+
+    lineage_parser = subparsers.add_parser('lineage', help='Walking each file\'s lineage vs. the prep lineage index.')
+    lineage_parser.add_argument('--n_docs', type=int, default=100000, help='Number of synthetic documents to load.')
+    lineage_parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs per stage (the fastest is reported).')
+    lineage_parser.set_defaults(func=bench_lineage)
+
+    rules_parser = subparsers.add_parser('rules', help='Hand-written _build_*_doc functions vs. the UPSTREAM_RULES engine.')
+    rules_parser.add_argument('--n_docs', type=int, default=100000, help='Number of synthetic documents to load.')
+    rules_parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs per builder (the fastest is reported).')
+    rules_parser.set_defaults(func=bench_rules)
+
+    generate_parser = subparsers.add_parser('generate', help='Building the Neo4j nodes and links of all File nodes serially vs. with --generate_workers.')
+    generate_parser.add_argument('--n_docs', type=int, default=100000, help='Number of synthetic documents to load.')
+    generate_parser.add_argument('--workers', type=str, default='2,4', help='Comma-separated list of worker counts to time.')
+    generate_parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs per version (the fastest is reported).')
+    generate_parser.set_defaults(func=bench_generate)
+
+    srs_parser = subparsers.add_parser('srs', help='Searching the candidate preps of pooled files vs. the SRS id -> prep index.')
+    srs_parser.add_argument('--n_docs', type=int, default=100000, help='Number of synthetic documents to load.')
+    srs_parser.add_argument('--n_files', type=int, default=20000, help='Number of pooled files to isolate the prep of.')
+    srs_parser.add_argument('--pool_size', type=int, default=50, help='Number of candidate preps per pooled file.')
+    srs_parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs per version (the fastest is reported).')
+    srs_parser.set_defaults(func=bench_srs)
+
+    traverse_parser = subparsers.add_parser('traverse', help='Flattening each file\'s upstream nodes with and without the _traverse_document cache.')
+    traverse_parser.add_argument('--n_docs', type=int, default=100000, help='Number of synthetic documents to load.')
+    traverse_parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs per version (the fastest is reported).')
+    traverse_parser.set_defaults(func=bench_traverse)
+
+    props_parser = subparsers.add_parser('props', help='Node and link properties as lists of key/value dicts vs. _PropRecords.')
+    props_parser.add_argument('--n_docs', type=int, default=100000, help='Number of synthetic documents to load.')
+    props_parser.add_argument('--batch_size', type=int, default=1000, help='Number of objects per (discarded) Cypher query.')
+    props_parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs per version (the fastest is reported).')
+    props_parser.set_defaults(func=bench_props)
+
+    pipeline_parser = subparsers.add_parser('pipeline', help='Building all nodes and links before inserting them vs. --pipeline.')
+    pipeline_parser.add_argument('--n_docs', type=int, default=100000, help='Number of synthetic documents to load.')
+    pipeline_parser.add_argument('--commit_us', type=float, default=20, help='Simulated Neo4j commit time per node or link, in microseconds.')
+    pipeline_parser.add_argument('--batch_size', type=int, default=5000, help='Number of nodes or links per commit.')
+    pipeline_parser.add_argument('--queue_size', type=int, default=c2n.PIPELINE_QUEUE_SIZE, help='Number of batches that may wait to be committed.')
+    pipeline_parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs per version (the fastest is reported).')
+    pipeline_parser.set_defaults(func=bench_pipeline)
+
+    uniqueness_parser = subparsers.add_parser('uniqueness', help='pprint vs. hash-based --check_sample_file_uniqueness.')
+    uniqueness_parser.add_argument('--n_docs', type=int, default=100000, help='Number of synthetic documents to load.')
+    uniqueness_parser.add_argument('--dup_every', type=int, default=10, help='Repeat every nth sample-file link.')
+    uniqueness_parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs per version (the fastest is reported).')
+    uniqueness_parser.set_defaults(func=bench_uniqueness)
+
+    insert_parser = subparsers.add_parser('insert', help='Committing one batch at a time vs. with --insert_workers.')
+    insert_parser.add_argument('--n_docs', type=int, default=100000, help='Number of synthetic documents to load.')
+    insert_parser.add_argument('--workers', type=str, default='2,4', help='Comma-separated list of worker counts to time.')
+    insert_parser.add_argument('--commit_us', type=float, default=20, help='Simulated Neo4j commit time per node or link, in microseconds.')
+    insert_parser.add_argument('--batch_size', type=int, default=5000, help='Number of nodes or links per commit.')
+    insert_parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs per version (the fastest is reported).')
+    insert_parser.set_defaults(func=bench_insert)
+
+    csv_parser = subparsers.add_parser('csv', help='Writing neo4j-admin import CSV files (--csv_dir) vs. the client side of Cypher inserts.')
+    csv_parser.add_argument('--n_docs', type=int, default=100000, help='Number of synthetic documents to load.')
+    csv_parser.add_argument('--batch_size', type=int, default=5000, help='Number of nodes or links per Cypher commit.')
+    csv_parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs per version (the fastest is reported).')
+    csv_parser.set_defaults(func=bench_csv)
+
+    adaptive_parser = subparsers.add_parser('adaptive', help='Fixed batch sizes vs. batch sizes adapted toward a target commit time (--target_commit_seconds).')
+    adaptive_parser.add_argument('--n_docs', type=int, default=100000, help='Number of synthetic documents to load.')
+    adaptive_parser.add_argument('--batch_sizes', type=str, default='500,5000,50000', help='Comma-separated list of fixed batch sizes to time.')
+    adaptive_parser.add_argument('--batch_size', type=int, default=5000, help='Batch size the adaptive batches start from.')
+    adaptive_parser.add_argument('--target_seconds', type=float, default=0.1, help='Target commit time of the adaptive batches, in seconds.')
+    adaptive_parser.add_argument('--overhead_ms', type=float, default=20, help='Simulated Neo4j time per commit, in milliseconds.')
+    adaptive_parser.add_argument('--prop_us', type=float, default=1, help='Simulated Neo4j commit time per property of each node or link, in microseconds.')
+    adaptive_parser.add_argument('--knee', type=int, default=20000, help='Batch size at which the simulated commit time per object has doubled.')
+    adaptive_parser.set_defaults(func=bench_adaptive)
+
+    link_ids_parser = subparsers.add_parser('link_ids', help='Inserting has_tag links by MATCHing the id property of their nodes vs. by internal node id (--link_by_internal_id, experimental), into a live, empty Neo4j instance.')
+    link_ids_parser.add_argument('--n_docs', type=int, default=100000, help='Number of synthetic documents to load.')
+    link_ids_parser.add_argument('--batch_size', type=int, default=5000, help='Number of nodes or links per commit.')
+    link_ids_parser.add_argument('--neo4j_host', type=str, default='localhost', help='The Neo4j server hostname.')
+    link_ids_parser.add_argument('--neo4j_password', type=str, default=None, help='The password for Neo4j.')
+    link_ids_parser.add_argument('--http_port', type=int, default=7474, help='The port for the exposed HTTP location.')
+    link_ids_parser.add_argument('--bolt_port', type=int, default=7687, help='The port for the exposed bolt location.')
+    link_ids_parser.set_defaults(func=bench_link_ids)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,18 @@
 # Author: James Matsumura
 # Contact: jmatsumura@som.umaryland.edu
 
-import argparse,os,subprocess,errno,datetime
+import argparse,os,subprocess,errno,datetime,sys
+
+# Run a step of the build and, if it fails, stop the transient Neo4j (when one
+# is running) and exit before a tarball of an incomplete database is built.
+def _check_call(command, step, neo4j=None, **kwargs):
+    status = subprocess.call(command, **kwargs)
+    if status != 0:
+        sys.stderr.write("{0} failed with exit code {1}, not building a tarball\n".format(step, status))
+        if neo4j is not None:
+            neo4j.kill()
+            subprocess.call("docker rm -f transient_neo4j".split())
+        sys.exit(1)
 
 def main():
 
@@ -18,6 +29,7 @@ def main():
     parser.add_argument('--batch_size', '-bs', type=int, help='How many Cypher transactions to commit in each batch via py2neo.')
     parser.add_argument('--db', '-d', type=str, help='URL:PORT for CouchDB of OSDF.')
     parser.add_argument('--loader_script', '-ls', type=str, help='Location of couchdb2neo4j_with_tags.py or other loader script.')
+    parser.add_argument('--bulk_import', '-bi', action='store_true', help='Have the loader script write neo4j-admin import CSV files (--csv_dir) and create the database from them offline, instead of loading it through the running Neo4j.')
     args = parser.parse_args()
 
     try: # Build a tmp directory to mount the transient Neo4j database
@@ -26,6 +38,17 @@ def main():
         if exception.errno != errno.EEXIST:
             raise
 
+    if args.bulk_import: # Write the CSV files and create the database from them with no server running
+        # The CSV files go in out_dir, so that the one volume holding the database
+        # (out_dir at /data) also has them, at /data/import. The paths in
+        # import.args are relative, so neo4j-admin is run from there.
+        csv_dir = "{0}/import".format(args.out_dir)
+        write_csvs = "{0} --db {1} --csv_dir {2}".format(args.loader_script,args.db,csv_dir)
+        _check_call(write_csvs.split(), "Writing the import CSV files")
+
+        import_database = "docker run --rm --volume={0}:/data --workdir=/data/import neo4j:{1} neo4j-admin import --f import.args".format(args.out_dir,args.neo4j_version)
+        _check_call(import_database.split(), "neo4j-admin import")
+
     start_neo4j_docker = "docker run --name transient_neo4j --publish={0}:7474 --publish={1}:7687 --env=NEO4J_AUTH=none --volume={2}:/data neo4j:{3}".format(args.http,args.bolt,args.out_dir,args.neo4j_version)
     neo4j = subprocess.Popen(start_neo4j_docker.split(),stdout=subprocess.PIPE)
 
@@ -34,8 +57,15 @@ def main():
         if '7474' in line: 
             break
 
-    load_database = "{0} --http_port {1} --bolt_port {2} --batch_size {3} --db {4}".format(args.loader_script,args.http,args.bolt,args.batch_size,args.db)
-    subprocess.call(load_database.split())
+    if args.bulk_import: # Only the constraints and indexes are left to create
+        with open("{0}/post_import.cypher".format(csv_dir)) as post_import:
+            _check_call("docker exec -i transient_neo4j cypher-shell".split(), "Creating the constraints and indexes", neo4j, stdin=post_import)
+
+        remove_csvs = "rm -rf {0}".format(csv_dir)
+        _check_call(remove_csvs.split(), "Removing the import CSV files", neo4j)
+    else:
+        load_database = "{0} --http_port {1} --bolt_port {2} --batch_size {3} --db {4}".format(args.loader_script,args.http,args.bolt,args.batch_size,args.db)
+        _check_call(load_database.split(), "Loading the database", neo4j)
     neo4j.kill()
 
     stop_neo4j_docker = "docker rm -f transient_neo4j"
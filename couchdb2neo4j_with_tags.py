@@ -22,21 +22,42 @@
 #
 #-*-coding: utf-8-*-
 
-import argparse,gzip,json,os,requests,sys,time
+import argparse,codecs,collections,csv,gzip,hashlib,heapq,itertools,json,mmap,multiprocessing,os,pickle,requests,sqlite3,struct,sys,threading,time,zlib
 from py2neo import Graph
 from accs_for_couchdb2neo4j import fma_free_body_site_dict, study_name_dict, file_format_dict, node_type_mapping
 from accs_for_couchdb2neo4j import file_nodes, meta_to_keep, meta_null_vals, keys_to_keep, ignore
 import pprint
 import re
 from six import string_types
+from six.moves import queue
 
 # nodes without upstream SRS#
 NO_UPSTREAM_SRS = {}
+# SRS id -> {prep id: field of the prep the SRS id is in} (see _build_srs_prep_index)
+SRS_PREP_INDEX = {}
+# field of the prep -> number of files whose prep was isolated through it
+SRS_MATCH_COUNTS = {}
 # unique tag terms
 TAGS = {}
 UNIQUE_LINKS = {}
+# --check_sample_file_uniqueness: sample:file link key -> hash of the link
+# properties (or set of hashes, for links with different properties), and
+# counts of the duplicate links found
+SAMPLE_FILE_PROPS = {}
+SAMPLE_FILE_DUPLICATES = {}
+# in a --generate_workers process, the (link key, properties hash) of each
+# sample-file link, in order, for the parent to check instead (None = check
+# them as they are generated)
+SAMPLE_FILE_CHECKS = None
 # node ids of inserted nodes
 NODE_IDS = {}
+# node id -> node type, for all loaded nodes except attributes
+NODE_TYPE_INDEX = {}
+# upstream nodes that were missing or of an unexpected type
+UPSTREAM_PROBLEMS = []
+# prep id -> (sample, visit, subject, study, project) nodes, with the attribute
+# data already appended (see _build_lineage_index)
+LINEAGE = {}
 # nodes to insert, grouped by type (e.g. 'file', 'tag', etc.)
 NODES = { 'file': [] , 'sample': [], 'subject': [], 'tag': [] }
 
@@ -45,14 +66,30 @@ SUBJ_SAMPLE_CYPHER = "UNWIND $objects as o MATCH (n1:subject{id: o.subject_id}),
 FILE_TAG_CYPHER = "UNWIND $objects as o MATCH (n1:file{id: o.file_id}),(n2:tag{term: o.term}) MERGE (n2)<-[:has_tag]-(n1)"
 # "<PROPS>" indicates where the specific properties will be substituted in
 SAMPLE_FILE_CYPHER = "UNWIND $objects as o MATCH (n2:sample{id: o.sample_id}),(n3:file{id: o.file_id}) MERGE (n2)<-[d:derived_from{ <PROPS> }]-(n3)"
+# --link_by_internal_id versions of the above, which find the nodes by the
+# internal Neo4j ids returned by the node inserts instead of by index lookups
+# (EXPERIMENTAL: not yet run against a live Neo4j server)
+SUBJ_SAMPLE_BY_ID_CYPHER = "UNWIND $objects as o MATCH (n1) WHERE id(n1) = o.subject_id MATCH (n2) WHERE id(n2) = o.sample_id MERGE (n1)<-[:extracted_from]-(n2)"
+FILE_TAG_BY_ID_CYPHER = "UNWIND $objects as o MATCH (n1) WHERE id(n1) = o.file_id MATCH (n2) WHERE id(n2) = o.term MERGE (n2)<-[:has_tag]-(n1)"
+SAMPLE_FILE_BY_ID_CYPHER = "UNWIND $objects as o MATCH (n2) WHERE id(n2) = o.sample_id MATCH (n3) WHERE id(n3) = o.file_id MERGE (n2)<-[d:derived_from{ <PROPS> }]-(n3)"
 
 # track node links/edges to insert
+# (with the fields that hold the ids of the nodes each link connects, and their
+# node types; 'shared_ends' are the ends that are not used to split the links
+# between --insert_workers, see _partition_links)
 NODE_LINKS = { 
-    'subject-sample': { 'cypher': SUBJ_SAMPLE_CYPHER, 'links': [] }, 
-    'file-tag': { 'cypher': FILE_TAG_CYPHER, 'links': [] },
-    'sample-file': { 'cypher': SAMPLE_FILE_CYPHER, 'links': [] },
+    'subject-sample': { 'cypher': SUBJ_SAMPLE_CYPHER, 'by_id_cypher': SUBJ_SAMPLE_BY_ID_CYPHER,
+                        'links': [], 'ends': ('subject_id', 'sample_id'), 'end_types': ('subject', 'sample') }, 
+    'file-tag': { 'cypher': FILE_TAG_CYPHER, 'by_id_cypher': FILE_TAG_BY_ID_CYPHER,
+                  'links': [], 'ends': ('file_id', 'term'), 'end_types': ('file', 'tag'), 'shared_ends': ('term',) },
+    'sample-file': { 'cypher': SAMPLE_FILE_CYPHER, 'by_id_cypher': SAMPLE_FILE_BY_ID_CYPHER,
+                     'links': [], 'ends': ('sample_id', 'file_id'), 'end_types': ('sample', 'file') },
     }
 
+# node type -> property that identifies the node (its unique constraint, and
+# the neo4j-admin import ID column)
+NODE_KEYS = { 'subject': 'id', 'sample': 'id', 'file': 'id', 'tag': 'term' }
+
 # track nodes added by node_type
 NODES_BY_TYPE = {}
 PROPS_BY_TYPE = {}
@@ -60,6 +97,47 @@ PROPS_BY_TYPE = {}
 # whether to dump problem documents/nodes
 DUMP_PROBLEM_DOCS = False
 
+# keyword arguments of the Graph of the Neo4j server being loaded, so that each
+# --insert_workers thread can connect on its own (None = the threads share the
+# Graph they are given)
+NEO4J_SETTINGS = None
+
+# whether the graph is written as neo4j-admin import files (--csv_dir). The
+# import creates every link it is given, so the sample-file links that MERGE
+# would have matched are dropped as they are generated.
+CSV_IMPORT = False
+
+# _BatchSizer that adapts the batch sizes toward --target_commit_seconds (None
+# = every batch holds --batch_size objects)
+BATCH_SIZER = None
+
+# _CommitJournal of the batches committed to Neo4j (--journal_dir)
+JOURNAL = None
+
+# node insert stage (e.g. 'file nodes') -> node key -> internal Neo4j id, as
+# returned by the node inserts (--link_by_internal_id, which is experimental;
+# None = links find their nodes by key)
+INTERNAL_IDS = None
+
+# unique constraints on (node label, property) built before loading
+CONSTRAINT_INDEXES = [('subject', 'id'), ('sample', 'id'), ('file', 'id'), ('token', 'id'),
+                      ('tag', 'term'), ('user', 'username'), ('session', 'id'), ('query', 'url')]
+
+# CouchDB request settings: retries after a 5xx response, timeout or connection
+# error (with exponential backoff starting at HTTP_BACKOFF seconds), request
+# timeout in seconds, and the size of the keep-alive connection pool
+HTTP_RETRIES = 5
+HTTP_BACKOFF = 1.0
+HTTP_TIMEOUT = 300
+HTTP_POOL_SIZE = 1
+
+# shared requests.Session for all CouchDB requests, created on first use
+HTTP_SESSION = None
+HTTP_LOCK = threading.Lock()
+
+# CouchDB request latencies (in seconds) and counts of retried/failed requests
+HTTP_STATS = { 'latencies': [], 'retries': 0, 'failures': 0, 'bytes': 0 }
+
 def _add_type(t):
     if t in NODES_BY_TYPE:
         NODES_BY_TYPE[t] += 1
@@ -86,430 +164,949 @@ def _print_error(message, doc=None):
 
     sys.stderr.flush()
 
-def _all_docs_by_page(db_url, db_login, db_password, cache_dir=None, page_size=10):
+# Return the shared keep-alive session used for all CouchDB requests.
+def _get_http_session():
+    global HTTP_SESSION
+    with HTTP_LOCK:
+        if HTTP_SESSION is None:
+            session = requests.Session()
+            # one pooled connection per concurrent fetch worker
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update({'Accept-Encoding': 'gzip'})
+            HTTP_SESSION = session
+    return HTTP_SESSION
+
+def _couchdb_request(url, params=None, auth=None, stream=False, body=None):
     """
-    Helper function to request documents from CouchDB in batches ("pages") for
-    efficiency, but present them as a stream.
+    GET a CouchDB URL, or POST body to it as JSON if a body is given, using
+    the shared keep-alive session. Requests that time
+    out, fail to connect, or get a 5xx response are retried up to HTTP_RETRIES
+    times with exponential backoff. Returns the last response received, which
+    the caller must still check for a non-200 status. With stream=True the
+    body of a 200 response is left unread, for the caller to iterate over,
+    and only the time to the response headers is recorded.
     """
-    # Tell CouchDB we only want a page worth of documents at a time, and that
-    # we want the document content as well as the metadata
-    view_arguments = {'limit': page_size, 'include_docs': "true"}
-    db_auth = None
-    if db_login is not None:
-        db_auth = ( db_login, db_password )
+    session = _get_http_session()
+    delay = HTTP_BACKOFF
+    attempt = 0
 
-    # Keep track of the last key we've seen
-    last_key = None
+    while True:
+        response = None
+        error = None
+        stime = time.time()
+        try:
+            if body is None:
+                response = session.get(url, params=params, auth=auth, timeout=HTTP_TIMEOUT, stream=stream)
+            else:
+                response = session.post(url, params=params, auth=auth, timeout=HTTP_TIMEOUT, stream=stream, json=body)
+            if response.status_code >= 500:
+                error = "status " + str(response.status_code)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            error = repr(e)
+        etime = time.time()
+
+        with HTTP_LOCK:
+            HTTP_STATS['latencies'].append(etime - stime)
+            if response is not None and not (stream and response.status_code == 200):
+                HTTP_STATS['bytes'] += len(response.content)
+            if error is not None:
+                if attempt < HTTP_RETRIES:
+                    HTTP_STATS['retries'] += 1
+                else:
+                    HTTP_STATS['failures'] += 1
 
-    # Option to create subdirectory to cache data retrieved from CouchDB.
-    # This is intended primarily for debugging/testing purposes.
-    cache_subdir = None
-    if cache_dir is not None:
-        q_url = re.sub('/', '%2F', requests.utils.quote(db_url))
-        # to keep things simple the cache will be page-size-specific
-        cache_subdir = os.path.join(cache_dir, q_url, str(page_size))
-        # create the subdir if it does not exist
-        if not os.path.exists(cache_subdir):
-            os.makedirs(cache_subdir)
+        if error is None or attempt >= HTTP_RETRIES:
+            break
 
-    # retrieve a single page from either the on-disk cache or the CouchDB server
-    def get_page(pagenum, params):
-        page = None
-        cache_page = None
-        # check cache for hit
-        if cache_subdir is not None:
-            cache_page = os.path.join(cache_subdir, ("p%010d" % pagenum) + ".json.gz")
-            if os.path.exists(cache_page):
-                with gzip.open(cache_page, 'rb') as cfile:
-                    page_content = cfile.read()
-                    page = { "status_code": 200, "content": page_content, "source": "cache" }
-
-        if page is None:
-            response = requests.get(db_url + "/_all_docs", params=params, auth=db_auth)
-            page = { "status_code": response.status_code, "content": response.content, "source": "DB" }
-            # write page to cache
-            if (cache_page is not None) and (response.status_code == 200):
-                with gzip.open(cache_page, 'wb') as cfile:
-                    cfile.write(response.content)
-        return page
-
-    pagenum = 1
-
-    # retrieve all CouchDB documents
-    while True:
-        page = get_page(pagenum, params=view_arguments)
-        pagenum += 1
+        _print_error("CouchDB request failed ({0}), retrying in {1:.1f} second(s)".format(error, delay))
+        time.sleep(delay)
+        delay *= 2
+        attempt += 1
 
-        # If there's been an error, stop looping
-        if page['status_code'] != 200:
-            _print_error("Error from DB: " + str(page['content']))
-            sys.exit(1)
+    if response is None:
+        _print_error("Error from DB: giving up after {0} attempt(s): {1}".format(attempt + 1, error))
+        sys.exit(1)
 
-        # Parse the results as JSON. If there's an error, stop looping
-        try:
-            results = json.loads(page['content'], encoding='UTF-8')
-        except:
-            _print_error("Unable to parse JSON: " + str(page['content']))
-            sys.exit(1)
+    return response
 
-        # If there's no more data to read, stop looping
-        if 'rows' not in results or not results['rows']:
-            break
+# Print a summary of the CouchDB request latencies.
+def _print_http_stats():
+    latencies = sorted(HTTP_STATS['latencies'])
+    n_requests = len(latencies)
+    if n_requests == 0:
+        return
+    _print_error("CouchDB requests: {0} ({1} retried, {2} failed), {3:.1f} MB received".format(n_requests, HTTP_STATS['retries'], HTTP_STATS['failures'], HTTP_STATS['bytes'] / 1048576.0))
+    _print_error("CouchDB request latency: mean={0:.3f}s median={1:.3f}s 95th percentile={2:.3f}s max={3:.3f}s total={4:.2f}s".format(
+        sum(latencies) / n_requests, latencies[n_requests // 2], latencies[int(n_requests * 0.95)], latencies[-1], sum(latencies)))
 
-        # Otherwise, keep yielding results
-        for r in results['rows']:
-            last_key = r['key']
-            yield r
+def _key_range_bounds(n_ranges):
+    """
+    Split the 32-hex-digit OSDF document id keyspace into n_ranges contiguous
+    [startkey, endkey) ranges. The first range has no startkey and the last
+    has no endkey, so ids outside the hex keyspace (e.g. design documents)
+    still fall into exactly one range.
+    """
+    bounds = [None]
+    for i in range(1, n_ranges):
+        bounds.append("%08x" % (i * 0x100000000 // n_ranges))
+    bounds.append(None)
+    return list(zip(bounds[:-1], bounds[1:]))
 
-        # Note that CouchDB requires keys to be encoded as JSON
-        view_arguments.update(startkey=json.dumps(last_key), skip=1)
+# size of the pieces in which CouchDB responses (and cached pages) are read
+READ_CHUNK_SIZE = 65536
 
-# All of these _build*_doc functions take in a particular "File" node (which)
-# means anything below the "Prep" nodes and build a document containing all
-# the information along the particular path to get to that node. Each will
-# have a new top of the structure called "File" where directly below this
-# location will contain all the relevant data for that particular node.
-# Everything else even with this level will be all the information contained
-# at prep and above. This will result in a heavily DEnormalized dataset.
-#
-# The arguments are the entire set of nodes and the particular node that is the
-# file representative.
+def _iter_json_rows(chunks, array_key, fields=None, raw=False):
+    """
+    Incrementally parse a JSON object of the form { ..., "<array_key>": [ row,
+    row, ... ], ... } that arrives as an iterable of byte chunks, yielding each
+    row as soon as it has been read in full so that parsing overlaps with the
+    transfer and only the unparsed tail of the body is ever buffered. With
+    raw=True (row, row JSON text) tuples are yielded instead. The other
+    fields of the object (e.g. total_rows, last_seq, or the error of an error
+    response) are stored in the fields dict, if one is given, once the whole
+    body has been read. Raises ValueError if the body is malformed or
+    truncated.
+    """
+    decode = codecs.getincrementaldecoder('utf-8')().decode
+    decoder = json.JSONDecoder()
+    array_start = re.compile(r'"' + array_key + r'"\s*:\s*\[')
+    whitespace = re.compile(r'[\s,]*')
+
+    buf = ""
+    pos = 0
+    header = None
+    in_array = False
+    chunks = iter(chunks)
+    eof = False
+
+    while True:
+        if not in_array and header is None:
+            m = array_start.search(buf)
+            if m is not None:
+                header = buf[:m.start()]
+                pos = m.end()
+                in_array = True
+                continue
+        elif in_array:
+            pos = whitespace.match(buf, pos).end()
+            if pos < len(buf):
+                if buf[pos] == ']':
+                    in_array = False
+                    buf = buf[pos + 1:]
+                    pos = 0
+                    continue
+                try:
+                    row, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    # row continues in the next chunk
+                    if eof:
+                        raise
+                else:
+                    if raw:
+                        yield (row, buf[pos:end])
+                    else:
+                        yield row
+                    pos = end
+                    continue
 
-def _build_16s_raw_seq_set_doc(all_nodes_dict,node):
+            # drop the rows already parsed before reading more
+            buf = buf[pos:]
+            pos = 0
 
-    doc = {}
-    doc['main'] = node['doc']
+        if eof:
+            break
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            buf += decode(b"", True)
+        else:
+            buf += decode(chunk)
 
-    # If this is a pooled sample, build a different object that represents that state
-    if type(doc['main']['linkage']['sequenced_from']) is list and len(set(doc['main']['linkage']['sequenced_from'])) > 1:
-        doc['prep'] = _multi_find_upstream_node(all_nodes_dict['16s_dna_prep'],'16s_dna_prep',doc['main']['linkage']['sequenced_from'])
-        return _multi_collect_sample_through_project(all_nodes_dict,doc)
+    if in_array:
+        raise ValueError("truncated JSON response (in " + array_key + ")")
 
+    if fields is None:
+        return
+    if header is None:
+        # no array at all (e.g. an error response)
+        fields.update(json.loads(buf))
     else:
-        doc['prep'] = _find_upstream_node(all_nodes_dict['16s_dna_prep'],'16s_dna_prep',doc['main']['linkage']['sequenced_from'])
-        return _collect_sample_through_project(all_nodes_dict,doc)
+        # join what came before and after the array into one object
+        head = header.rstrip().rstrip(',')
+        tail = buf.strip()
+        if head.endswith('{') and tail.startswith(','):
+            tail = tail[1:]
+        elif not head.endswith('{') and not tail.startswith(',') and not tail.startswith('}'):
+            tail = ',' + tail
+        fields.update(json.loads(head + tail))
+
+# Return an iterator over the body of a streamed CouchDB response, counting
+# the bytes received.
+def _iter_response_chunks(response):
+    for chunk in response.iter_content(chunk_size=READ_CHUNK_SIZE):
+        with HTTP_LOCK:
+            HTTP_STATS['bytes'] += len(chunk)
+        yield chunk
+
+class _PackedDocCache(object):
+    """
+    On-disk cache of the rows retrieved from CouchDB, independent of the page
+    size and key ranges used to fetch them. Rows are appended, each one
+    zlib-compressed, to a single data file as they arrive. Once a complete
+    fetch has finished a sorted index of (key, offset, length) records is
+    written next to it, which is what marks the cache as usable. Both files are
+    memory-mapped when reading, so any key range is served with a binary search
+    and sequential reads. The database's update sequence from just before the
+    fetch started is kept with them, so that an incremental checkpoint taken
+    from the cache matches the snapshot it holds.
+
+    Index file layout (little-endian): INDEX_MAGIC, the record count (Q), the
+    fixed-size records (INDEX_RECORD: key offset, key length, data offset,
+    data length), then the concatenated UTF-8 keys.
+    """
+    DATA_FILE = "docs.dat"
+    INDEX_FILE = "docs.idx"
+    SEQ_FILE = "update_seq.json"
+    INDEX_MAGIC = b"OSDFIDX1"
+    INDEX_HEADER = struct.Struct("<8sQ")
+    INDEX_RECORD = struct.Struct("<QIQI")
+
+    def __init__(self, cache_subdir):
+        self.data_path = os.path.join(cache_subdir, self.DATA_FILE)
+        self.index_path = os.path.join(cache_subdir, self.INDEX_FILE)
+        self.seq_path = os.path.join(cache_subdir, self.SEQ_FILE)
+        if not os.path.exists(cache_subdir):
+            os.makedirs(cache_subdir)
+        self.lock = threading.Lock()
+        self.data_file = None
+        self.entries = None
 
-def _build_16s_trimmed_seq_set_doc(all_nodes_dict,node):
+    def is_complete(self):
+        return os.path.exists(self.index_path) and os.path.exists(self.data_path)
 
-    doc = {}
-    doc['main'] = node['doc']
-
-    if type(doc['main']['linkage']['computed_from']) is list and len(set(doc['main']['linkage']['computed_from'])) > 1:
-        doc['16s_raw_seq_set'] = _multi_find_upstream_node(all_nodes_dict['16s_raw_seq_set'],'16s_raw_seq_set',doc['main']['linkage']['computed_from'])
-        doc['prep'] = []
-        for x in range(0,len(doc['16s_raw_seq_set'])):
-            doc['prep'] += _multi_find_upstream_node(all_nodes_dict['16s_dna_prep'],'16s_dna_prep',doc['16s_raw_seq_set'][x]['linkage']['sequenced_from'])
-        doc['prep'] = list({v['id']:v for v in doc['prep']}.values()) # uniquifying
-        doc['prep'] = _isolate_relevant_prep_edge(doc)
+    # The update sequence recorded when the cache was written, or None for a
+    # cache written without one.
+    def update_seq(self):
+        if not os.path.exists(self.seq_path):
+            return None
+        with open(self.seq_path) as sfile:
+            return json.load(sfile)
+
+    # Start a new cache, discarding whatever was there.
+    def begin_write(self, update_seq):
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+        with open(self.seq_path, 'w') as sfile:
+            json.dump(update_seq, sfile)
+        self.data_file = open(self.data_path, 'wb')
+        self.entries = []
+
+    # Append one row, given its key and JSON text.
+    def append(self, key, row_text):
+        data = zlib.compress(row_text.encode('utf-8'))
+        with self.lock:
+            self.entries.append((key.encode('utf-8'), self.data_file.tell(), len(data)))
+            self.data_file.write(data)
+
+    # Finish a complete fetch by writing the sorted index.
+    def finish_write(self):
+        self.data_file.close()
+        self.entries.sort()
+        with open(self.index_path + ".tmp", 'wb') as ifile:
+            ifile.write(self.INDEX_HEADER.pack(self.INDEX_MAGIC, len(self.entries)))
+            key_offset = 0
+            for key, data_offset, data_len in self.entries:
+                ifile.write(self.INDEX_RECORD.pack(key_offset, len(key), data_offset, data_len))
+                key_offset += len(key)
+            for key, data_offset, data_len in self.entries:
+                ifile.write(key)
+        os.rename(self.index_path + ".tmp", self.index_path)
+        _print_error("cached {0} documents in {1}".format(len(self.entries), self.data_path))
+        self.entries = None
+
+    # Yield the cached rows whose keys fall in [startkey, endkey), in key order.
+    # Either bound may be None to leave that end of the range open.
+    def iter_rows(self, startkey=None, endkey=None):
+        with open(self.index_path, 'rb') as ifile, open(self.data_path, 'rb') as dfile:
+            index = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, n_records = self.INDEX_HEADER.unpack_from(index, 0)
+            if magic != self.INDEX_MAGIC:
+                _print_error("unrecognized cache index " + self.index_path)
+                sys.exit(1)
+            if n_records == 0:
+                return
+            data = mmap.mmap(dfile.fileno(), 0, access=mmap.ACCESS_READ)
+
+            record_start = self.INDEX_HEADER.size
+            keys_start = record_start + n_records * self.INDEX_RECORD.size
+
+            def record(i):
+                return self.INDEX_RECORD.unpack_from(index, record_start + i * self.INDEX_RECORD.size)
+
+            def key(i):
+                key_offset, key_len, data_offset, data_len = record(i)
+                return index[keys_start + key_offset:keys_start + key_offset + key_len]
+
+            # first record with key >= k
+            def lower_bound(k):
+                lo, hi = 0, n_records
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if key(mid) < k:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                return lo
 
-        if type(doc['prep']) is list:
-            return _multi_collect_sample_through_project(all_nodes_dict,doc)
+            first = 0 if startkey is None else lower_bound(startkey.encode('utf-8'))
+            last = n_records if endkey is None else lower_bound(endkey.encode('utf-8'))
 
-    else:
-        doc['16s_raw_seq_set'] = _find_upstream_node(all_nodes_dict['16s_raw_seq_set'],'16s_raw_seq_set',doc['main']['linkage']['computed_from'])
-        doc['prep'] = _find_upstream_node(all_nodes_dict['16s_dna_prep'],'16s_dna_prep',doc['16s_raw_seq_set']['linkage']['sequenced_from'])
+            for i in range(first, last):
+                key_offset, key_len, data_offset, data_len = record(i)
+                yield json.loads(zlib.decompress(data[data_offset:data_offset + data_len]).decode('utf-8'))
 
-    return _collect_sample_through_project(all_nodes_dict,doc)
+def _all_docs_in_range(db_url, db_auth, cache, page_size, startkey=None, endkey=None):
+    """
+    Page through the documents whose ids fall in [startkey, endkey) and yield
+    them one at a time, parsing each page as it arrives. Either bound may be
+    None to leave that end of the range open. If the connection drops in the
+    middle of a page, the page is requested again starting after the last
+    document yielded. Rows are also appended to cache, if one is given.
+    """
+    # Tell CouchDB we only want a page worth of documents at a time, and that
+    # we want the document content as well as the metadata
+    view_arguments = {'limit': page_size, 'include_docs': "true"}
 
-def _build_abundance_matrix_doc(all_nodes_dict,node):
+    # Note that CouchDB requires keys to be encoded as JSON
+    if startkey is not None:
+        view_arguments['startkey'] = json.dumps(startkey)
+    if endkey is not None:
+        view_arguments.update(endkey=json.dumps(endkey), inclusive_end="false")
 
-    doc = {}
-    which_upstream,which_prep = ("" for i in range(2)) # can be many here
-
-    doc['main'] = node['doc']
-
-    link = _refine_link(doc['main']['linkage']['computed_from'])
-
-    # Notice that this IF precedes a second set of ELSE/IF statements, that is because
-    # if this is an abundance_matrix derived from an abundance_matrix, we still build the
-    # upstream structure in the same manner either way.
-    if link in all_nodes_dict['abundance_matrix']:
-        doc['abundance_matrix'] = _find_upstream_node(all_nodes_dict['abundance_matrix'],'abundance_matrix',link)
-        # We now need to reset the link to be the other abundance_matrix
-        link = _refine_link(doc['abundance_matrix']['linkage']['computed_from'])
-
-    # process the middle pathway
-    if link in all_nodes_dict['16s_trimmed_seq_set']:
-        doc['16s_trimmed_seq_set'] = _find_upstream_node(all_nodes_dict['16s_trimmed_seq_set'],'16s_trimmed_seq_set',link)
-        doc['16s_raw_seq_set'] = _find_upstream_node(all_nodes_dict['16s_raw_seq_set'],'16s_raw_seq_set',doc['16s_trimmed_seq_set']['linkage']['computed_from'])
-        doc['prep'] = _find_upstream_node(all_nodes_dict['16s_dna_prep'],'16s_dna_prep',doc['16s_raw_seq_set']['linkage']['sequenced_from'])
-
-    elif link in all_nodes_dict['viral_seq_set']:
-        doc['viral_seq_set'] = _find_upstream_node(all_nodes_dict['viral_seq_set'],'viral_seq_set',link)
-        doc['wgs_raw_seq_set'] = _find_upstream_node(all_nodes_dict['wgs_raw_seq_set'],'wgs_raw_seq_set',doc['viral_seq_set']['linkage']['computed_from'])
-        doc['prep'] = _find_upstream_node(all_nodes_dict['wgs_dna_prep'],'wgs_dna_prep',doc['wgs_raw_seq_set']['linkage']['sequenced_from'])
-
-    # process the left pathway
-    elif (
-        link in all_nodes_dict['microb_transcriptomics_raw_seq_set']
-        or link in all_nodes_dict['host_transcriptomics_raw_seq_set']
-        or link in all_nodes_dict['wgs_raw_seq_set']
-        or link in all_nodes_dict['host_wgs_raw_seq_set']
-        ):
-        if link in all_nodes_dict['microb_transcriptomics_raw_seq_set']:
-            which_upstream = 'microb_transcriptomics_raw_seq_set'
-        elif link in all_nodes_dict['host_transcriptomics_raw_seq_set']:
-            which_upstream = 'host_transcriptomics_raw_seq_set'
-        elif link in all_nodes_dict['wgs_raw_seq_set']:
-            which_upstream = 'wgs_raw_seq_set'
-        elif link in all_nodes_dict['host_wgs_raw_seq_set']:
-            which_upstream = 'host_wgs_raw_seq_set'
-
-        doc[which_upstream] = _find_upstream_node(all_nodes_dict[which_upstream],which_upstream,link)
-        link = _refine_link(doc[which_upstream]['linkage']['sequenced_from'])
-
-        if link in all_nodes_dict['wgs_dna_prep']:
-            which_prep = 'wgs_dna_prep'
-        elif link in all_nodes_dict['host_seq_prep']:
-            which_prep = 'host_seq_prep'
-        else:
-            print("Made it here, so an WGS/HOST node is missing an upstream ID of {0}.".format(link))
-
-        doc['prep'] = _find_upstream_node(all_nodes_dict[which_prep],which_prep,link)
-
-    # process the right pathway
-    elif (
-        link in all_nodes_dict['proteome']
-        or link in all_nodes_dict['metabolome']
-        or link in all_nodes_dict['lipidome']
-        or link in all_nodes_dict['cytokine']
-        ):
-        if link in all_nodes_dict['proteome']:
-            which_upstream = 'proteome'
-        elif link in all_nodes_dict['metabolome']:
-            which_upstream = 'metabolome'
-        elif link in all_nodes_dict['lipidome']:
-            which_upstream = 'lipidome'
-        elif link in all_nodes_dict['cytokine']:
-            which_upstream = 'cytokine'
-
-        doc[which_upstream] = _find_upstream_node(all_nodes_dict[which_upstream],which_upstream,link)
-        link = _refine_link(doc[which_upstream]['linkage']['derived_from'])
-
-        if link in all_nodes_dict['microb_assay_prep']:
-            which_prep = 'microb_assay_prep'
-        elif link in all_nodes_dict['host_assay_prep']:
-            which_prep = 'host_assay_prep'
-        else:
-            print("Made it here, so an ~ome node is missing an upstream ID of {0}.".format(link))
+    # Keep track of the last key we've seen
+    last_key = None
+    n_retries = 0
 
-        doc['prep'] = _find_upstream_node(all_nodes_dict[which_prep],which_prep,link)
+    # retrieve all CouchDB documents in the range
+    while True:
+        n_rows = 0
 
-    else:
-        # create dummy prep for abundance matrix computed_from a study
-        doc['prep'] = {}
+        try:
+            response = _couchdb_request(db_url + "/_all_docs", params=view_arguments, auth=db_auth, stream=True)
 
-    return _collect_sample_through_project(all_nodes_dict,doc)
+            # If there's been an error, stop looping
+            if response.status_code != 200:
+                _print_error("Error from DB: " + str(response.content))
+                sys.exit(1)
 
-def _build_omes_doc(all_nodes_dict,node):
+            for r, row_text in _iter_json_rows(_iter_response_chunks(response), 'rows', raw=True):
+                last_key = r['key']
+                n_rows += 1
+                if cache is not None:
+                    cache.append(last_key, row_text)
+                yield r
+
+        except (requests.exceptions.RequestException, ValueError) as e:
+            n_retries += 1
+            if n_retries > HTTP_RETRIES:
+                _print_error("Unable to read page from DB: " + repr(e))
+                sys.exit(1)
+            _print_error("Error reading page from DB ({0}), requesting the rest of it again".format(repr(e)))
+            with HTTP_LOCK:
+                HTTP_STATS['retries'] += 1
+            if last_key is not None:
+                view_arguments.update(startkey=json.dumps(last_key), skip=1)
+            continue
 
-    doc = {}
-    which_prep = "" # can be microb or host
+        n_retries = 0
+
+        # If there's no more data to read, stop looping
+        if n_rows == 0:
+            break
 
-    doc['main'] = node['doc']
+        view_arguments.update(startkey=json.dumps(last_key), skip=1)
 
-    link = _refine_link(doc['main']['linkage']['derived_from'])
+# The only document fields used to build the graph; everything else (_rev, acl,
+# ns, ...) is discarded by _normalize_doc anyway.
+FIND_FIELDS = ['_id', 'node_type', 'linkage', 'meta', 'ver']
 
-    if link in all_nodes_dict['microb_assay_prep']:
-        which_prep = 'microb_assay_prep'
-    elif link in all_nodes_dict['host_assay_prep']:
-        which_prep = 'host_assay_prep'
-    else:
-        print("Made it here, so an ~ome node is missing an upstream ID of {0}.".format(link))
+def _find_docs_in_range(db_url, db_auth, cache, page_size, node_types, startkey=None, endkey=None):
+    """
+    Like _all_docs_in_range, but use a Mango query (_find, CouchDB 2.0+) so
+    that the server only sends the documents whose node_type is one of
+    node_types, and only their FIND_FIELDS. _hist documents are excluded by
+    the query too. Rows are yielded in the same form as those of _all_docs.
+    """
+    id_selector = {'$not': {'$regex': '_hist$'}}
+    if startkey is not None:
+        id_selector['$gte'] = startkey
+    if endkey is not None:
+        id_selector['$lt'] = endkey
+    query = {
+        'selector': {'node_type': {'$in': node_types}, '_id': id_selector},
+        'fields': FIND_FIELDS,
+        'limit': page_size
+    }
 
-    doc['prep'] = _find_upstream_node(all_nodes_dict[which_prep],which_prep,link)
+    # rows of the current page already yielded before a failed read
+    n_skip = 0
+    n_retries = 0
 
-    return _collect_sample_through_project(all_nodes_dict,doc)
+    while True:
+        n_rows = 0
+        fields = {}
 
-def _build_wgs_transcriptomics_doc(all_nodes_dict,node):
+        try:
+            response = _couchdb_request(db_url + "/_find", auth=db_auth, stream=True, body=query)
 
-    doc = {}
-    which_prep = "" # can be wgs_dna or host_seq
+            if response.status_code != 200:
+                _print_error("Error from DB: " + str(response.content))
+                sys.exit(1)
 
-    doc['main'] = node['doc']
+            for d, doc_text in _iter_json_rows(_iter_response_chunks(response), 'docs', fields, raw=True):
+                n_rows += 1
+                if n_rows <= n_skip:
+                    continue
+                if cache is not None:
+                    cache.append(d['_id'], doc_text)
+                yield {'id': d['_id'], 'doc': d}
+
+        except (requests.exceptions.RequestException, ValueError) as e:
+            n_retries += 1
+            if n_retries > HTTP_RETRIES:
+                _print_error("Unable to read page from DB: " + repr(e))
+                sys.exit(1)
+            _print_error("Error reading page from DB ({0}), requesting the rest of it again".format(repr(e)))
+            with HTTP_LOCK:
+                HTTP_STATS['retries'] += 1
+            n_skip = max(n_skip, n_rows)
+            continue
 
-    link = _refine_link(doc['main']['linkage']['sequenced_from'])
+        n_retries = 0
+        n_skip = 0
 
-    if link in all_nodes_dict['wgs_dna_prep']:
-        which_prep = 'wgs_dna_prep'
-    elif link in all_nodes_dict['host_seq_prep']:
-        which_prep = 'host_seq_prep'
-    else:
-        print("Made it here, so an WGS/HOST node is missing an upstream ID of {0}.".format(link))
+        # e.g., no index on node_type
+        if 'warning' in fields and 'bookmark' not in query:
+            _print_error("_find: " + fields['warning'])
 
-    doc['prep'] = _find_upstream_node(all_nodes_dict[which_prep],which_prep,link)
+        if n_rows < page_size:
+            break
 
-    return _collect_sample_through_project(all_nodes_dict,doc)
+        query['bookmark'] = fields['bookmark']
 
-def _build_wgs_assembled_or_viral_seq_set_doc(all_nodes_dict,node):
+def _all_docs_by_page(db_url, db_login, db_password, cache_dir=None, page_size=10, fetch_workers=1, node_types=None, changes_state=None):
+    """
+    Helper function to request documents from CouchDB in batches ("pages") for
+    efficiency, but present them as a stream. With fetch_workers > 1 the doc id
+    keyspace is split into that many key ranges, which are paged through
+    concurrently and merged into a single stream (in no particular order.)
+    If a list of node_types is given, only documents of those types (and only
+    the fields that are used) are requested, with _find instead of _all_docs.
+    If changes_state is given, its 'last_seq' is set to the database's update
+    sequence from before the fetch, or from before the cached fetch that is
+    read instead.
+    """
+    db_auth = None
+    if db_login is not None:
+        db_auth = ( db_login, db_password )
 
-    doc = {}
-    which_upstream,which_prep = ("" for i in range(2))
-
-    doc['main'] = node['doc']
-
-    # Assuming that WGS/HOST upstream nodes are never mixed, can identify using
-    # the first link which types the upstream and prep nodes are.
-    link = _refine_link(doc['main']['linkage']['computed_from'])
-
-    if link in all_nodes_dict['wgs_raw_seq_set']:
-        which_upstream = 'wgs_raw_seq_set'
-    elif link in all_nodes_dict['wgs_raw_seq_set_private']:
-        which_upstream = 'wgs_raw_seq_set_private'
-    elif link in all_nodes_dict['host_wgs_raw_seq_set']:
-        which_upstream = 'host_wgs_raw_seq_set'
-
-    doc[which_upstream] = _find_upstream_node(all_nodes_dict[which_upstream],which_upstream,link)
-    link = _refine_link(doc[which_upstream]['linkage']['sequenced_from'])
-    if link in all_nodes_dict['wgs_dna_prep']:
-        which_prep = 'wgs_dna_prep'
-    elif link in all_nodes_dict['host_seq_prep']:
-        which_prep = 'host_seq_prep'
-    else:
-        print("Made it here, so an WGS/HOST node is missing an upstream ID of {0}.".format(link))
+    def fetch_rows(startkey=None, endkey=None):
+        if node_types is None:
+            return _all_docs_in_range(db_url, db_auth, cache, page_size, startkey, endkey)
+        return _find_docs_in_range(db_url, db_auth, cache, page_size, node_types, startkey, endkey)
 
-    if type(doc['main']['linkage']['computed_from']) is list and len(set(doc['main']['linkage']['computed_from'])) > 1:
-        doc[which_upstream] = _multi_find_upstream_node(all_nodes_dict[which_upstream],which_upstream,doc['main']['linkage']['computed_from'])
-        doc['prep'] = []
-        for x in range(0,len(doc[which_upstream])):
-            doc['prep'] += _multi_find_upstream_node(all_nodes_dict[which_prep],which_prep,doc[which_upstream][x]['linkage']['sequenced_from'])
-        doc['prep'] = list({v['id']:v for v in doc['prep']}.values()) # uniquifying
-        doc['prep'] = _isolate_relevant_prep_edge(doc)
-        if type(doc['prep']) is list:
-            return _multi_collect_sample_through_project(all_nodes_dict,doc)
+    # Option to cache the data retrieved from CouchDB on disk. This is intended
+    # primarily for debugging/testing purposes: once a complete copy has been
+    # cached it is used instead of CouchDB, whatever the page size.
+    cache = None
+    if cache_dir is not None:
+        q_url = re.sub('/', '%2F', requests.utils.quote(db_url))
+        # _find results are cached separately, as bare documents
+        if node_types is not None:
+            q_url += "%2F_find"
+        cache = _PackedDocCache(os.path.join(cache_dir, q_url))
+        if cache.is_complete():
+            if changes_state is not None:
+                changes_state['last_seq'] = cache.update_seq()
+                if changes_state['last_seq'] is None:
+                    _print_error("the cache in " + cache.data_path + " has no update sequence to start an incremental checkpoint from; remove it to fetch the documents again")
+                    sys.exit(1)
+            for r in cache.iter_rows():
+                if node_types is not None:
+                    r = {'id': r['_id'], 'doc': r}
+                yield r
+            return
 
-    else:
-        doc['prep'] = _find_upstream_node(all_nodes_dict[which_prep],which_prep,link)
+    # anything changed while the fetch runs will be reread by the next incremental run
+    update_seq = None
+    if cache is not None or changes_state is not None:
+        update_seq = _get_update_seq(db_url, db_login, db_password)
+    if changes_state is not None:
+        changes_state['last_seq'] = update_seq
+    if cache is not None:
+        cache.begin_write(update_seq)
 
-    return _collect_sample_through_project(all_nodes_dict,doc)
+    key_ranges = _key_range_bounds(max(fetch_workers, 1))
 
-def _build_annotation_doc(all_nodes_dict,node):
+    # serial retrieval
+    if len(key_ranges) == 1:
+        for r in fetch_rows():
+            yield r
+        if cache is not None:
+            cache.finish_write()
+        return
 
-    doc = {}
-    which_upstream,which_prep = ("" for i in range(2))
+    # concurrent retrieval: each worker thread pages through its own key range and
+    # hands complete pages to the consumer through a bounded queue
+    pages = queue.Queue(maxsize=len(key_ranges) * 2)
 
-    doc['main'] = node['doc']
+    def fetch_range(startkey, endkey):
+        try:
+            page = []
+            for r in fetch_rows(startkey, endkey):
+                page.append(r)
+                if len(page) == page_size:
+                    pages.put(('page', page))
+                    page = []
+            if page:
+                pages.put(('page', page))
+            pages.put(('done', None))
+        except BaseException as e:
+            pages.put(('error', "{0} (key range {1} - {2})".format(repr(e), startkey, endkey)))
+
+    for startkey, endkey in key_ranges:
+        worker = threading.Thread(target=fetch_range, args=(startkey, endkey))
+        worker.daemon = True
+        worker.start()
+
+    n_running = len(key_ranges)
+    while n_running > 0:
+        status, page = pages.get()
+        if status == 'page':
+            for r in page:
+                yield r
+        elif status == 'done':
+            n_running -= 1
+        else:
+            _print_error("Error retrieving documents from DB: " + page)
+            sys.exit(1)
 
-    link = _refine_link(doc['main']['linkage']['computed_from'])
+    if cache is not None:
+        cache.finish_write()
 
-    if link in all_nodes_dict['viral_seq_set']:
-        which_upstream = 'viral_seq_set'
-    elif link in all_nodes_dict['wgs_assembled_seq_set']:
-        which_upstream = 'wgs_assembled_seq_set'
-    else:
-        _print_error("annotation (id=" + doc['main']['id'] + ") with unexpected upstream node type: ", doc)
+# Return the current update sequence of a CouchDB database.
+def _get_update_seq(db_url, db_login, db_password):
+    db_auth = None
+    if db_login is not None:
+        db_auth = ( db_login, db_password )
 
-        for nt in all_nodes_dict.keys():
-            if link in all_nodes_dict[nt]:
-                _print_error("encountered annotation node with upstream node_type=" + nt)
-                sys.exit(1)
-        _print_error("encountered annotation node with unknown upstream node_type/missing upstream node")
+    response = _couchdb_request(db_url, auth=db_auth)
+    if response.status_code != 200:
+        _print_error("Error from DB: " + str(response.content))
         sys.exit(1)
+    return response.json()['update_seq']
 
-    doc[which_upstream] = _find_upstream_node(all_nodes_dict[which_upstream],which_upstream,link)
-    link = _refine_link(doc[which_upstream]['linkage']['computed_from'])
+def _changes_since(db_url, db_login, db_password, since, page_size, state):
+    """
+    Helper function to request the documents changed since update sequence
+    'since' from the CouchDB _changes feed, in pages of page_size changes, and
+    present them as a stream of rows like those from _all_docs_by_page. Deleted
+    documents are flagged with 'deleted'. The sequence of the last page read
+    is kept in state['last_seq'].
+    """
+    feed_arguments = {'limit': page_size, 'include_docs': "true", 'since': since}
+    db_auth = None
+    if db_login is not None:
+        db_auth = ( db_login, db_password )
 
-    if link in all_nodes_dict['wgs_raw_seq_set']:
-        which_upstream = 'wgs_raw_seq_set'
-    elif link in all_nodes_dict['wgs_raw_seq_set_private']:
-        which_upstream = 'wgs_raw_seq_set_private'
-    elif link in all_nodes_dict['host_wgs_raw_seq_set']:
-        which_upstream = 'host_wgs_raw_seq_set'
+    state['last_seq'] = since
 
-    doc[which_upstream] = _find_upstream_node(all_nodes_dict[which_upstream],which_upstream,link)
-    link = _refine_link(doc[which_upstream]['linkage']['sequenced_from'])
+    while True:
+        response = _couchdb_request(db_url + "/_changes", params=feed_arguments, auth=db_auth, stream=True)
 
-    if link in all_nodes_dict['wgs_dna_prep']:
-        which_prep = 'wgs_dna_prep'
-    elif link in all_nodes_dict['host_seq_prep']:
-        which_prep = 'host_seq_prep'
-    else:
-        print("Made it here, so an WGS/HOST node is missing an upstream ID of {0}.".format(link))
+        # If there's been an error, stop looping
+        if response.status_code != 200:
+            _print_error("Error from DB: " + str(response.content))
+            sys.exit(1)
 
-    doc['prep'] = _find_upstream_node(all_nodes_dict[which_prep],which_prep,link)
+        fields = {}
+        n_results = 0
+        try:
+            for r in _iter_json_rows(_iter_response_chunks(response), 'results', fields):
+                n_results += 1
+                yield r
+        except (requests.exceptions.RequestException, ValueError) as e:
+            _print_error("Unable to read _changes feed: " + repr(e))
+            sys.exit(1)
 
-    return _collect_sample_through_project(all_nodes_dict,doc)
+        # If there's no more data to read, stop looping
+        if n_results == 0:
+            break
 
-def _build_alignment_or_host_variant_call_doc(all_nodes_dict,node):
+        state['last_seq'] = fields['last_seq']
+        feed_arguments.update(since=fields['last_seq'])
 
-    doc = {}
-    which_upstream,which_prep = ("" for i in range(2))
+# files kept in --incremental_dir between runs
+CHECKPOINT_FILE = "checkpoint.json"
+NODE_STORE_FILE = "node_store.v2.pickle.gz"
+
+# Return the CouchDB update sequence recorded by the last run against db_url,
+# or None if there is no usable checkpoint.
+def _load_checkpoint(incremental_dir, db_url):
+    checkpoint_path = os.path.join(incremental_dir, CHECKPOINT_FILE)
+    if not os.path.exists(checkpoint_path) or not os.path.exists(os.path.join(incremental_dir, NODE_STORE_FILE)):
+        return None
 
-    doc['main'] = node['doc']
+    with open(checkpoint_path, 'r') as cfile:
+        checkpoint = json.load(cfile)
 
-    link = _refine_link(doc['main']['linkage']['computed_from'])
+    if checkpoint['db'] != db_url:
+        _print_error("ignoring checkpoint for a different database (" + checkpoint['db'] + ")")
+        return None
+    return checkpoint['seq']
 
-    if link in all_nodes_dict['wgs_assembled_seq_set']:
-        which_upstream = 'wgs_assembled_seq_set'
-        doc[which_upstream] = _find_upstream_node(all_nodes_dict[which_upstream],which_upstream,link)
-        link = _refine_link(doc[which_upstream]['linkage']['computed_from'])
+# Load the dict of nodes (and their doc_keys) saved by the last run.
+def _load_node_store(incremental_dir):
+    stime = time.time()
+    with gzip.open(os.path.join(incremental_dir, NODE_STORE_FILE), 'rb') as sfile:
+        store = pickle.load(sfile)
+    _print_error("loaded saved node store in {0:.2f} second(s)".format(time.time() - stime))
+    return store['nodes'], store['doc_keys']
+
+# Save the dict of nodes and the update sequence it reflects. Each file is
+# written under a temporary name first, and the checkpoint is written last, so
+# an interrupted save leaves the previous checkpoint usable.
+def _save_incremental_state(incremental_dir, db_url, seq, nodes, doc_keys):
+    stime = time.time()
+    if not os.path.exists(incremental_dir):
+        os.makedirs(incremental_dir)
+
+    store_path = os.path.join(incremental_dir, NODE_STORE_FILE)
+    with gzip.open(store_path + ".tmp", 'wb') as sfile:
+        pickle.dump({'nodes': nodes, 'doc_keys': doc_keys}, sfile, pickle.HIGHEST_PROTOCOL)
+    os.rename(store_path + ".tmp", store_path)
+
+    checkpoint_path = os.path.join(incremental_dir, CHECKPOINT_FILE)
+    with open(checkpoint_path + ".tmp", 'w') as cfile:
+        json.dump({'db': db_url, 'seq': seq}, cfile)
+    os.rename(checkpoint_path + ".tmp", checkpoint_path)
+    _print_error("saved node store at update sequence {0} in {1:.2f} second(s)".format(seq, time.time() - stime))
+
+# size of the pieces (byte ranges, or batches of lines for a gzipped dump) in
+# which a --from_dump file is handed to the parsing processes
+DUMP_CHUNK_BYTES = 32 * 1048576
+
+# Parse one line of a CouchDB changes feed dump. Returns None for lines that do
+# not hold a row, such as the first and last lines of a dump of the normal
+# (non-continuous) feed, and raises ValueError for a row that is not valid JSON.
+def _parse_dump_line(line):
+    line = line.strip().rstrip(b',')
+    if not line.startswith(b'{') or line.startswith(b'{"results":'):
+        return None
+    row = json.loads(line.decode('utf-8'))
+    if 'id' not in row or ('doc' not in row and not row.get('deleted')):
+        return None
+    return row
+
+# Parse and clean a list of dump lines. Returns the cleaned rows (and deletion
+# markers) along with the last update sequence seen, if any, and the number of
+# rows that were not valid JSON.
+def _clean_dump_lines(lines):
+    rows = []
+    last_seq = None
+    n_invalid = 0
+    for line in lines:
+        try:
+            row = _parse_dump_line(line)
+        except ValueError:
+            n_invalid += 1
+            continue
+        if row is None:
+            continue
+        if 'seq' in row:
+            last_seq = row['seq']
+        rows.append(row)
+    return _normalize_rows(rows), last_seq, n_invalid
+
+# Parse and clean the lines of an uncompressed dump that start within the byte
+# range [start, end).
+def _clean_dump_range(task):
+    dump_path, start, end = task
+    lines = []
+    with open(dump_path, 'rb') as dfile:
+        # a line that straddles start belongs to the previous range
+        if start > 0:
+            dfile.seek(start - 1)
+            if dfile.read(1) != b'\n':
+                dfile.readline()
+        pos = dfile.tell()
+        while pos < end:
+            line = dfile.readline()
+            if not line:
+                break
+            lines.append(line)
+            pos += len(line)
+    return _clean_dump_lines(lines)
+
+# Read a gzipped dump in batches of about DUMP_CHUNK_BYTES worth of lines.
+def _read_dump_batches(dump_path):
+    with gzip.open(dump_path, 'rb') as dfile:
+        lines = []
+        n_bytes = 0
+        for line in dfile:
+            lines.append(line)
+            n_bytes += len(line)
+            if n_bytes >= DUMP_CHUNK_BYTES:
+                yield lines
+                lines = []
+                n_bytes = 0
+        if lines:
+            yield lines
+
+def _docs_from_dump(dump_path, n_workers, state):
+    """
+    Read a CouchDB changes feed dump (one row per line, as in the
+    couchdb_changesfeed.json dumps used by inspect_metadata.py, optionally
+    gzipped) and present its documents as a stream, in file order. Rows are
+    parsed and normalized with _normalize_doc by a pool of n_workers processes, each
+    working on its own byte range of the file (a gzipped file cannot be split
+    that way, so it is decompressed here and handed out in batches of lines.)
+    A dump that fits in a single piece is parsed here instead, since one
+    piece only ever keeps one process busy. At most two tasks per worker are
+    in flight, so that the file is not read far ahead of a slow consumer.
+    Deleted documents are flagged with 'deleted'. The last update sequence
+    found in the dump is kept in state['last_seq']. Rows that are not valid
+    JSON are skipped, and counted at the end.
+    """
+    with open(dump_path, 'rb') as dfile:
+        gzipped = dfile.read(2) == b'\x1f\x8b'
 
-    if link in all_nodes_dict['wgs_raw_seq_set']:
-        which_upstream = 'wgs_raw_seq_set'
-    elif link in all_nodes_dict['wgs_raw_seq_set_private']:
-        which_upstream = 'wgs_raw_seq_set_private'
-    elif link in all_nodes_dict['host_wgs_raw_seq_set']:
-        which_upstream = 'host_wgs_raw_seq_set'
+    if gzipped:
+        tasks = _read_dump_batches(dump_path)
+        worker_fn = _clean_dump_lines
     else:
-        _print_error("can't find upstream type for " + link)
+        dump_size = os.path.getsize(dump_path)
+        tasks = [(dump_path, start, min(start + DUMP_CHUNK_BYTES, dump_size)) for start in range(0, dump_size, DUMP_CHUNK_BYTES)]
+        worker_fn = _clean_dump_range
+
+    tasks = iter(tasks)
+    head = list(itertools.islice(tasks, 2))
+    tasks = itertools.chain(head, tasks)
+
+    pool = None
+    if n_workers > 1 and len(head) > 1:
+        pool = multiprocessing.Pool(n_workers)
+
+    def results():
+        if pool is None:
+            for task in tasks:
+                yield worker_fn(task)
+            return
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(pool.apply_async(worker_fn, (task,)))
+            if len(pending) > n_workers * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    n_invalid = 0
+    try:
+        for docs, last_seq, n_chunk_invalid in results():
+            if last_seq is not None:
+                state['last_seq'] = last_seq
+            n_invalid += n_chunk_invalid
+            for doc in docs:
+                yield doc
+        if n_invalid > 0:
+            _print_error("WARNING - skipped {0} row(s) of {1} that are not valid JSON".format(n_invalid, dump_path))
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+# Groups of node types that are expected upstream of File nodes.
+WGS_RAW_SEQ_SET_TYPES = ['wgs_raw_seq_set', 'wgs_raw_seq_set_private', 'host_wgs_raw_seq_set']
+RAW_SEQ_SET_TYPES = ['microb_transcriptomics_raw_seq_set', 'host_transcriptomics_raw_seq_set', 'wgs_raw_seq_set', 'host_wgs_raw_seq_set']
+OMES_TYPES = ['proteome', 'metabolome', 'lipidome', 'cytokine']
+SEQ_PREP_TYPES = ['wgs_dna_prep', 'host_seq_prep']
+ASSAY_PREP_TYPES = ['microb_assay_prep', 'host_assay_prep']
+ASSEMBLY_TYPES = ['viral_seq_set', 'wgs_assembled_seq_set']
+ABUNDANCE_MATRIX_SOURCE_TYPES = ['16s_trimmed_seq_set', 'viral_seq_set'] + RAW_SEQ_SET_TYPES + OMES_TYPES + ['study']
+
+# preps are the nodes at which the lineages of file nodes meet
+PREP_NODE_TYPES = ['16s_dna_prep', 'wgs_dna_prep', 'host_seq_prep', 'microb_assay_prep', 'host_assay_prep']
+
+# The OSDF lineage of the "File" nodes (which means anything below the "Prep"
+# nodes.) For each node type, the link to follow upstream, the node types
+# allowed at the other end of it, and how a node pooled from several upstream
+# nodes is handled:
+#
+#   'all'     - keep all of the upstream preps
+#   'isolate' - keep the upstream prep that matches the SRS id of the node (see
+#               _isolate_relevant_prep_edge), or all of them if none does
+#   None      - follow the first link only
+#
+# Pooling is only considered for the links of the File node itself. The chain
+# ends at a prep or, for abundance matrices computed from a whole study, at the
+# study (which gets a dummy prep.) Each node type may appear in a chain once.
+# A File node type without an entry here is not loaded into Neo4j.
+UPSTREAM_RULES = {
+    '16s_raw_seq_set': ('sequenced_from', ['16s_dna_prep'], 'all'),
+    '16s_trimmed_seq_set': ('computed_from', ['16s_raw_seq_set'], 'isolate'),
+    'abundance_matrix': ('computed_from', ['abundance_matrix'] + ABUNDANCE_MATRIX_SOURCE_TYPES, None),
+    'proteome': ('derived_from', ASSAY_PREP_TYPES, None),
+    'metabolome': ('derived_from', ASSAY_PREP_TYPES, None),
+    'lipidome': ('derived_from', ASSAY_PREP_TYPES, None),
+    'cytokine': ('derived_from', ASSAY_PREP_TYPES, None),
+    'wgs_raw_seq_set': ('sequenced_from', SEQ_PREP_TYPES, None),
+    'wgs_raw_seq_set_private': ('sequenced_from', SEQ_PREP_TYPES, None),
+    'host_wgs_raw_seq_set': ('sequenced_from', SEQ_PREP_TYPES, None),
+    'microb_transcriptomics_raw_seq_set': ('sequenced_from', SEQ_PREP_TYPES, None),
+    'host_transcriptomics_raw_seq_set': ('sequenced_from', SEQ_PREP_TYPES, None),
+    'wgs_assembled_seq_set': ('computed_from', WGS_RAW_SEQ_SET_TYPES, 'isolate'),
+    'viral_seq_set': ('computed_from', WGS_RAW_SEQ_SET_TYPES, 'isolate'),
+    'annotation': ('computed_from', ASSEMBLY_TYPES, None),
+    'clustered_seq_set': ('computed_from', ['annotation'], None),
+    # new node types added 10/22/2018
+    'host_epigenetics_raw_seq_set': ('sequenced_from', SEQ_PREP_TYPES, None),
+    'serology': ('derived_from', ASSAY_PREP_TYPES, None),
+    'alignment': ('computed_from', ['wgs_assembled_seq_set'] + WGS_RAW_SEQ_SET_TYPES, None),
+    'proteome_nonpride': ('derived_from', ASSAY_PREP_TYPES, None),
+    'host_variant_call': ('computed_from', ['wgs_assembled_seq_set'] + WGS_RAW_SEQ_SET_TYPES, None)
+}
+
+def _compile_upstream_rules(rules):
+    """
+    Check a table of rules like UPSTREAM_RULES and compile it into the form
+    used by _build_file_doc: a dict of node type -> (link name, next states,
+    pooling), where the next states map each allowed upstream node type either
+    to its own (link name, next states, pooling) tuple or, at the end of a
+    chain, to 'prep' or 'study'. The table is unfolded into one tree of states
+    per node type, so node types that are already in a chain are left out of
+    the states below them. Raises ValueError if a rule allows an upstream node
+    type that has no rule of its own and does not end a chain, or pools nodes
+    that are not (directly or one step) upstream of preps.
+    """
+    def compile_state(node_type, in_chain):
+        link_name, upstream_types, pooled = rules[node_type]
+        if pooled not in ('all', 'isolate', None):
+            raise ValueError("unknown pooling '" + str(pooled) + "' for node type " + node_type)
+
+        next_states = {}
+        for upstream_type in upstream_types:
+            if upstream_type in in_chain:
+                continue
+            if upstream_type in PREP_NODE_TYPES:
+                next_states[upstream_type] = 'prep'
+            elif upstream_type == 'study':
+                next_states[upstream_type] = 'study'
+            elif upstream_type in rules:
+                next_states[upstream_type] = compile_state(upstream_type, in_chain | set([upstream_type]))
+            else:
+                raise ValueError("no upstream rule for node type " + upstream_type + " (upstream of " + node_type + ")")
 
-    doc[which_upstream] = _find_upstream_node(all_nodes_dict[which_upstream],which_upstream,link)
-    link = _refine_link(doc[which_upstream]['linkage']['sequenced_from'])
+            if pooled is not None and next_states[upstream_type] != 'prep':
+                if next_states[upstream_type] == 'study' or [state for state in next_states[upstream_type][1].values() if state != 'prep']:
+                    raise ValueError("can't pool " + node_type + " nodes computed from " + upstream_type)
 
-    if link in all_nodes_dict['wgs_dna_prep']:
-        which_prep = 'wgs_dna_prep'
-    elif link in all_nodes_dict['host_seq_prep']:
-        which_prep = 'host_seq_prep'
-    else:
-        print("Made it here, so an WGS/HOST node is missing an upstream ID of {0}.".format(link))
+        return (link_name, next_states, pooled)
 
-    doc['prep'] = _find_upstream_node(all_nodes_dict[which_prep],which_prep,link)
+    return dict((node_type, compile_state(node_type, set())) for node_type in rules)
 
-    return _collect_sample_through_project(all_nodes_dict,doc)
+COMPILED_UPSTREAM_RULES = _compile_upstream_rules(UPSTREAM_RULES)
 
-def _build_clustered_seq_set_doc(all_nodes_dict,node):
+# _build_file_doc takes in a particular File node and builds a document
+# containing all the information along the particular path to get to that
+# node. The top of the structure, "main", contains the File node itself, and
+# everything else even with this level will be the information contained in
+# the nodes in between, at the prep and above. This will result in a heavily
+# DEnormalized dataset.
+#
+# The arguments are the entire set of nodes and the particular node that is the
+# file representative. Returns None if its lineage is broken (the problems are
+# recorded with _record_upstream_problem.)
+def _build_file_doc(all_nodes_dict,node):
 
     doc = {}
-    which_upstream,which_prep = ("" for i in range(2))
+    doc['main'] = node
+
+    link_name, next_states, pooled = COMPILED_UPSTREAM_RULES[node['node_type']]
 
-    doc['main'] = node['doc']
+    # If this is pooled from several upstream nodes, build a different object that represents that state
+    if pooled is not None:
+        link_ids = node['linkage'][link_name]
+        if type(link_ids) is list and len(set(link_ids)) > 1:
+            return _build_pooled_file_doc(all_nodes_dict,doc,link_ids,next_states,pooled)
 
-    doc['annotation'] = _find_upstream_node(all_nodes_dict['annotation'],'annotation',doc['main']['linkage']['computed_from'])
-    link = _refine_link(doc['annotation']['linkage']['computed_from'])
+    downstream = node
+    while True:
+        link_id = _refine_link(downstream['linkage'][link_name])
+        which_upstream = NODE_TYPE_INDEX.get(link_id)
+        state = next_states.get(which_upstream)
+        if state is None:
+            _record_upstream_problem(downstream,link_id,next_states)
+            return None
+
+        upstream = all_nodes_dict[which_upstream][link_id]
+        if state == 'prep':
+            doc['prep'] = upstream
+            break
+        elif state == 'study':
+            # create dummy prep for abundance matrix computed_from a study
+            doc['prep'] = {}
+            break
 
-    if link in all_nodes_dict['viral_seq_set']:
-        which_upstream = 'viral_seq_set'
-    elif link in all_nodes_dict['wgs_assembled_seq_set']:
-        which_upstream = 'wgs_assembled_seq_set'
+        doc[which_upstream] = upstream
+        link_name, next_states = state[0], state[1]
+        downstream = upstream
 
-    doc[which_upstream] = _find_upstream_node(all_nodes_dict[which_upstream],which_upstream,link)
-    link = _refine_link(doc[which_upstream]['linkage']['computed_from'])
+    return _collect_sample_through_project(all_nodes_dict,doc)
 
-    if link in all_nodes_dict['wgs_raw_seq_set']:
-        which_upstream = 'wgs_raw_seq_set'
-    elif link in all_nodes_dict['wgs_raw_seq_set_private']:
-        which_upstream = 'wgs_raw_seq_set_private'
-    elif link in all_nodes_dict['host_wgs_raw_seq_set']:
-        which_upstream = 'host_wgs_raw_seq_set'
+# Build the doc of a File node pooled from several upstream nodes (link_ids),
+# which are all taken to be of the node type of the first one. Either these
+# are the preps themselves, or their preps are collected.
+def _build_pooled_file_doc(all_nodes_dict,doc,link_ids,next_states,pooled):
 
-    doc[which_upstream] = _find_upstream_node(all_nodes_dict[which_upstream],which_upstream,link)
-    link = _refine_link(doc[which_upstream]['linkage']['sequenced_from'])
+    which_upstream,upstream = _resolve_upstream_node(all_nodes_dict,doc['main'],link_ids,next_states)
+    if upstream is None:
+        return None
 
-    if link in all_nodes_dict['wgs_dna_prep']:
-        which_prep = 'wgs_dna_prep'
-    elif link in all_nodes_dict['host_seq_prep']:
-        which_prep = 'host_seq_prep'
+    if next_states[which_upstream] == 'prep':
+        doc['prep'] = _multi_find_upstream_node(all_nodes_dict[which_upstream],which_upstream,link_ids)
     else:
-        print("Made it here, so an WGS/HOST node is missing an upstream ID of {0}.".format(link))
+        doc[which_upstream] = _multi_find_upstream_node(all_nodes_dict[which_upstream],which_upstream,link_ids)
+        if doc[which_upstream] is None:
+            return None
 
-    doc['prep'] = _find_upstream_node(all_nodes_dict[which_prep],which_prep,link)
+        link_name, prep_states = next_states[which_upstream][0], next_states[which_upstream][1]
+        which_prep,prep = _resolve_upstream_node(all_nodes_dict,upstream,upstream['linkage'][link_name],prep_states)
+        if prep is None:
+            return None
 
-    return _collect_sample_through_project(all_nodes_dict,doc)
+        preps = []
+        for x in range(0,len(doc[which_upstream])):
+            found = _multi_find_upstream_node(all_nodes_dict[which_prep],which_prep,doc[which_upstream][x]['linkage'][link_name])
+            if found is None:
+                return None
+            preps += found
+        doc['prep'] = list({v['id']:v for v in preps}.values()) # uniquifying
+
+    if doc['prep'] is None:
+        return None
+
+    if pooled == 'isolate':
+        doc['prep'] = _isolate_relevant_prep_edge(doc)
+        if type(doc['prep']) is not list:
+            return _collect_sample_through_project(all_nodes_dict,doc)
+
+    return _multi_collect_sample_through_project(all_nodes_dict,doc)
 
 # Function to traverse up from a trimmed seq set or WGS set through the raw
 # edge links and find the singular relevant prep edge. This matches the
 # SRS tag attached to the 'main' node and matches it to the srs_id prop
-# in the prep node.
+# (or tags) in the prep node, using SRS_PREP_INDEX.
 def _isolate_relevant_prep_edge(doc):
     srs_tag = ""
 
@@ -528,23 +1125,16 @@ def _isolate_relevant_prep_edge(doc):
         if 'assembly_name' in doc['main']:
             srs_tag = doc['main']['assembly_name']
 
-    # iterate over all the prep edges til you find the one
-    for prep_edge in doc['prep']: # HMP I has 'srs_id'
-        if 'srs_id' in prep_edge:
-            if prep_edge['srs_id'] == srs_tag:
+    # find the first prep edge with this SRS ID
+    preps_with_srs = None
+    if isinstance(srs_tag, string_types):
+        preps_with_srs = SRS_PREP_INDEX.get(srs_tag)
+    if preps_with_srs is not None:
+        for prep_edge in doc['prep']:
+            field = preps_with_srs.get(prep_edge['id'])
+            if field is not None:
+                SRS_MATCH_COUNTS[field] = SRS_MATCH_COUNTS.get(field, 0) + 1
                 return prep_edge
-        elif 'tags' in prep_edge: # HMP II cases where SRS ID is in a tag
-            for tag in prep_edge['tags']:
-                if tag == srs_tag:
-                    return prep_edge
-        elif 'meta' in prep_edge:
-            if 'srs_id' in prep_edge['meta']:
-                if prep_edge['meta']['srs_id'] == srs_tag:
-                    return prep_edge
-            elif 'tags' in prep_edge['meta']:
-                for tag in prep_edge['meta']['tags']:
-                    if tag == srs_tag:
-                        return prep_edge
 
     subtype = doc['main']['subtype']
     if subtype not in NO_UPSTREAM_SRS:
@@ -562,6 +1152,49 @@ def _isolate_relevant_prep_edge(doc):
 
     return doc['prep'] # if we made it here, could not isolate upstream SRS
 
+def _resolve_upstream_node(all_nodes_dict,doc,link_id,node_types):
+    """
+    Look up the node that a link (from the linkage of doc) points to, which is
+    expected to be of one of node_types, using NODE_TYPE_INDEX. Returns the
+    node type and the node, or (None, None) if there is no such node or it is
+    of an unexpected type, in which case the problem is recorded with
+    _record_upstream_problem.
+    """
+    link_id = _refine_link(link_id)
+    node_type = NODE_TYPE_INDEX.get(link_id)
+    if node_type in node_types:
+        return node_type, all_nodes_dict[node_type][link_id]
+    _record_upstream_problem(doc,link_id,node_types)
+    return None, None
+
+# Record (in UPSTREAM_PROBLEMS) that the node link_id, linked from doc (if
+# known), is missing or is not one of the expected node types. Problems are
+# summarized by _print_upstream_problems.
+def _record_upstream_problem(doc,link_id,expected_types):
+    problem = {
+        'node_type': None if doc is None else doc['node_type'],
+        'id': None if doc is None else doc['id'],
+        'link_id': link_id,
+        'expected': "|".join(sorted(expected_types)),
+        'found': NODE_TYPE_INDEX.get(link_id)
+    }
+    UPSTREAM_PROBLEMS.append(problem)
+    if DUMP_PROBLEM_DOCS:
+        _print_error("upstream node problem: " + json.dumps(problem, sort_keys=True), doc)
+
+# Write a summary of UPSTREAM_PROBLEMS, grouped by node type, expected upstream
+# type(s) and what was found instead.
+def _print_upstream_problems():
+    counts = {}
+    for p in UPSTREAM_PROBLEMS:
+        key = (str(p['node_type']), p['expected'], p['found'] or 'missing')
+        counts[key] = counts.get(key, 0) + 1
+
+    sys.stdout.write("upstream node problems:\n")
+    for key in sorted(counts):
+        sys.stdout.write("  {0} -> {1} (found {2}) : {3}\n".format(key[0], key[1], key[2], str(counts[key])))
+    sys.stdout.write("\n")
+
 # This function takes in the dict of nodes from a particular node type, the name
 # of this type of node, the ID specified by the linkage to isolate the node.
 # It returns the information of the particular upstream node.
@@ -571,9 +1204,9 @@ def _find_upstream_node(node_dict,node_name,link_id):
     link_id = _refine_link(link_id)
 
     if link_id in node_dict:
-        return node_dict[link_id]['doc']
+        return node_dict[link_id]
 
-    print("Made it here, so node type {0} with ID {1} is missing upstream.".format(node_name,link_id))
+    _record_upstream_problem(None,link_id,[node_name])
 
 # This function collects sample-project nodes as these can consistently be
 # retrieved in a similar manner.
@@ -584,10 +1217,15 @@ def _collect_sample_through_project(all_nodes_dict,doc):
         _print_error("prep not found for node of type/subtype = {0}/{1} (id={2})".format(doc['main']['node_type'], doc['main']['subtype'], doc['main']['id']), doc)
         return None
 
+    attributes_added = False
+
     # some abundance matrices are computed_from the study rather than a specific sample/prep
     if doc['main']['node_type'] == 'abundance_matrix' and 'linkage' not in doc['prep']:
         doc['study'] = _find_upstream_node(all_nodes_dict['study'],'study',doc['main']['linkage']['computed_from'])
         doc['project'] = _find_upstream_node(all_nodes_dict['project'],'project',doc['study']['linkage']['part_of'])
+    elif doc['prep']['id'] in LINEAGE:
+        doc['sample'], doc['visit'], doc['subject'], doc['study'], doc['project'] = LINEAGE[doc['prep']['id']]
+        attributes_added = True
     else:
         doc['sample'] = _find_upstream_node(all_nodes_dict['sample'],'sample',doc['prep']['linkage']['prepared_from'])
         doc['visit'] = _find_upstream_node(all_nodes_dict['visit'],'visit',doc['sample']['linkage']['collected_during'])
@@ -598,13 +1236,14 @@ def _collect_sample_through_project(all_nodes_dict,doc):
     # Skip all the dummy data associated with the "Test Project"
     if doc['project']['id'] == '610a4911a5ca67de12cdc1e4b40018e1':
         return None
-    elif 'prep' in doc:
+    elif 'prep' in doc and not attributes_added:
         doc = _append_attribute_data(all_nodes_dict,doc)
     return doc
 
 # This function appends attribute data to the current node doc type.
 # Note this will only occur if there is such data available. Takes
-# in all the nodes and the current doc to update
+# in all the nodes and the current doc to update. The stored nodes are not
+# modified: the doc gets updated copies of them.
 def _append_attribute_data(all_nodes_dict,doc):
 
     attributes = ['sample_attribute','visit_attribute','subject_attribute']
@@ -618,23 +1257,119 @@ def _append_attribute_data(all_nodes_dict,doc):
 
             if type(doc[node_to_add_to]) is list:
                 for x in range(0,len(doc[node_to_add_to])):
-                    if doc[node_to_add_to][x]['id'] in all_nodes_dict[attr]:
-                        for k,v in all_nodes_dict[attr][doc[node_to_add_to][x]['id']]['doc'].items():
-                            if k in meta_to_keep: # only persist new/relevant information
-                                v = _standardize_value(v)
-                                if v is not None:
-                                    doc[node_to_add_to][x][k] = v
+                    doc[node_to_add_to][x] = _add_attribute_data(all_nodes_dict,attr,doc[node_to_add_to][x])
 
             else:
-                if doc[node_to_add_to]['id'] in all_nodes_dict[attr]:
-                    for k,v in all_nodes_dict[attr][doc[node_to_add_to]['id']]['doc'].items():
-                        if k in meta_to_keep:
-                            v = _standardize_value(v)
-                            if v is not None:
-                                doc[node_to_add_to][k] = v
+                doc[node_to_add_to] = _add_attribute_data(all_nodes_dict,attr,doc[node_to_add_to])
 
     return doc
 
+# Return a copy of node with the data of its attribute node (of type attr)
+# added, or node itself if it has no attribute node.
+def _add_attribute_data(all_nodes_dict,attr,node):
+
+    if node['id'] not in all_nodes_dict[attr]:
+        return node
+
+    added = []
+    for k,v in all_nodes_dict[attr][node['id']].items():
+        if k in meta_to_keep: # only persist new/relevant information
+            v = _standardize_value(v)
+            if v is not None:
+                added.append((k,v))
+
+    return node.updated(added)
+
+# the nodes upstream of a prep, in order, and the links that lead to them
+LINEAGE_STEPS = [
+    ('sample', 'prepared_from'),
+    ('visit', 'collected_during'),
+    ('subject', 'by'),
+    ('study', 'participates_in'),
+    ('project', 'part_of')
+]
+
+def _build_lineage_index(all_nodes_dict, node_store=None):
+    """
+    Fill LINEAGE with the sample, visit, subject, study and project nodes
+    upstream of every prep, with the attribute data of the sample, visit and
+    subject appended (each of them once, however many preps share it.) The
+    _collect_sample_through_project functions then look up the lineage of a
+    prep instead of walking it again for every file. Preps with a broken
+    lineage are left out, so that they are still walked (and reported) in
+    the usual way. With a node_store, the nodes with attribute data appended
+    are kept in it rather than in memory.
+    """
+    stime = time.time()
+    with_attributes = {}
+    if node_store is not None:
+        with_attributes = node_store.table(LINEAGE_ATTRIBUTES_TABLE)
+    n_broken = 0
+
+    for prep_type in PREP_NODE_TYPES:
+        for prep_id in all_nodes_dict[prep_type]:
+            node = all_nodes_dict[prep_type][prep_id]
+            lineage = []
+
+            for node_type, link_name in LINEAGE_STEPS:
+                try:
+                    link_id = _refine_link(node['linkage'][link_name])
+                except (KeyError, IndexError):
+                    break
+                if link_id not in all_nodes_dict[node_type]:
+                    break
+                node = all_nodes_dict[node_type][link_id]
+
+                attr = node_type + '_attribute'
+                if attr in all_nodes_dict:
+                    if link_id not in with_attributes:
+                        with_attributes[link_id] = _add_attribute_data(all_nodes_dict,attr,node)
+                    lineage.append(with_attributes[link_id])
+                else:
+                    lineage.append(node)
+
+            if len(lineage) == len(LINEAGE_STEPS):
+                LINEAGE[prep_id] = tuple(lineage)
+            else:
+                n_broken += 1
+
+    _print_error("built lineage index for {0} preps ({1} incomplete) in {2:.2f} second(s)".format(len(LINEAGE), n_broken, time.time() - stime))
+
+# Return the field of a prep node that holds its SRS ID(s) and the values in
+# that field: HMP I preps have an 'srs_id', HMP II preps have their SRS ID in
+# their tags (in either case possibly still under 'meta'.) Only the first of
+# these fields that is present is used.
+def _prep_srs_ids(prep):
+    if 'srs_id' in prep:
+        return 'srs_id', [prep['srs_id']]
+    elif 'tags' in prep:
+        return 'tags', prep['tags']
+    elif 'meta' in prep:
+        if 'srs_id' in prep['meta']:
+            return 'meta.srs_id', [prep['meta']['srs_id']]
+        elif 'tags' in prep['meta']:
+            return 'meta.tags', prep['meta']['tags']
+    return None, []
+
+def _build_srs_prep_index(all_nodes_dict):
+    """
+    Fill SRS_PREP_INDEX with the preps of each SRS ID (see _prep_srs_ids), so
+    that _isolate_relevant_prep_edge can find the prep of a file pooled from
+    several preps with one lookup instead of searching each of them.
+    """
+    stime = time.time()
+    n_preps = 0
+
+    for prep_type in PREP_NODE_TYPES:
+        for prep_id in all_nodes_dict[prep_type]:
+            field, srs_ids = _prep_srs_ids(all_nodes_dict[prep_type][prep_id])
+            for srs_id in srs_ids:
+                if isinstance(srs_id, string_types):
+                    SRS_PREP_INDEX.setdefault(srs_id, {})[prep_id] = field
+            n_preps += 1
+
+    _print_error("built SRS id index of {0} preps ({1} SRS ids) in {2:.2f} second(s)".format(n_preps, len(SRS_PREP_INDEX), time.time() - stime))
+
 # Function to test a value for type and return a consistent data type across
 # various attr values. Already have purged null values, so simply pass along
 # bools/ints and make sure any strings aren't in the null set defined by
@@ -662,12 +1397,14 @@ def _multi_find_upstream_node(node_dict,node_name,link_ids):
 
     for link_id in link_list:
         if link_id in node_dict:
-            upstream_node_list.append(node_dict[link_id]['doc'])
+            upstream_node_list.append(node_dict[link_id])
 
     if len(upstream_node_list) == len(link_list):
         return upstream_node_list
     else:
-        print("Made it here, so node type {0} doesn't have multiple upstream nodes as expected.".format(node_name))
+        for link_id in link_list:
+            if link_id not in node_dict:
+                _record_upstream_problem(None,link_id,[node_name])
 
 # Similar to _collect_sample_through_project() except this works with many
 # upstream nodes.
@@ -682,6 +1419,11 @@ def _multi_collect_sample_through_project(all_nodes_dict,doc):
     # Maintain positions via list indices for each prep -> project path
     for x in range(0,len(doc['prep'])):
 
+        if doc['prep'][x]['id'] in LINEAGE:
+            for nt, node in zip(init_nodes, LINEAGE[doc['prep'][x]['id']]):
+                doc[nt].append(node)
+            continue
+
         doc['sample'].append(_find_upstream_node(all_nodes_dict['sample'],'sample',doc['prep'][x]['linkage']['prepared_from']))
         new_idx = (len(doc['sample'])-1) # occassionally this will be offset from prep if there's multiple downstream of prep
         doc['visit'].append(_find_upstream_node(all_nodes_dict['visit'],'visit',doc['sample'][new_idx]['linkage']['collected_during']))
@@ -746,10 +1488,7 @@ def _mod_body_site(val):
 # Add dependent File node attributes based on node_type_mapping
 def _add_dependent_file_attributes(doc,file_info):
 
-    # convert file_info props to dict
-    fip = {}
-    for p in file_info['props']:
-        fip[p['key']] = p['value']
+    fip = file_info['props']
 
     node_type = doc['main']['node_type']
     node_type2 = fip['node_type']
@@ -798,26 +1537,72 @@ def _add_dependent_file_attributes(doc,file_info):
                 # check parent assay to determine whether organism_type should be 'host' or 'bacterial'
                 prep_type = doc['prep']['node_type']
                 if prep_type == 'host_assay_prep':
-                    props_added.append({'key': key, 'value': 'host'})
+                    props_added.append((key, 'host'))
                 else:
                     _print_error("unrecognized prep type encountered: " + prep_type)
                     sys.exit(1)
             else:
                 _print_error("unknown _key value of " + res[key]['_key'] + " in node_type_mapping")
         else:
-            props_added.append({'key': key, 'value': res[key]})
+            props_added.append((key, res[key]))
 
     file_info['props'].extend(props_added)
-    props_added_str = ", ".join([p['key'] + ":" + p['value'] for p in props_added])
+    props_added_str = ", ".join([k + ":" + v for k, v in props_added])
     _add_type_props(subtype, props_added_str)
 
+class _PropRecord(dict):
+    """
+    The properties of a node or link, as a flat key -> value dict, from
+    _traverse_document through to _do_cypher_insert. sig is the sorted,
+    "||"-joined list of keys by which _do_cypher_insert groups objects into
+    a single UNWIND query; it is computed when the record is built and
+    shared by all records with the same keys (in the same order.) Records
+    that may be cached are not modified once built; extend() is only used
+    on a file's own properties.
+    """
+    __slots__ = ('sig',)
+
+    # tuple of keys -> signature
+    SIGS = {}
+
+    def __init__(self, items=()):
+        dict.__init__(self, items)
+        self.sig = _PropRecord._sig(tuple(self))
+
+    @staticmethod
+    def _sig(keys):
+        sig = _PropRecord.SIGS.get(keys)
+        if sig is None:
+            sig = "||".join(sorted(keys))
+            _PropRecord.SIGS[keys] = sig
+        return sig
+
+    def extend(self, items):
+        self.update(items)
+        self.sig = _PropRecord._sig(tuple(self))
+
+# node types whose flattened properties are cached by _traverse_document,
+# since they are shared by many files
+TRAVERSE_CACHED_NODES = ('sample', 'visit', 'subject', 'study', 'project', 'prep')
+# (focal node, node id) -> (node, what _traverse_document returned for it),
+# least recently used first
+TRAVERSE_CACHE = collections.OrderedDict()
+# most entries kept in TRAVERSE_CACHE (--node_cache_size; None = no limit)
+TRAVERSE_CACHE_SIZE = None
+# focal node -> [cache hits, cache misses, of which invalidated]
+TRAVERSE_CACHE_STATS = {}
+
 # Function to traverse the nested JSON documents from CouchDB and return
 # a flattened set of properties specific to the particular node. The index
 # value indicates whether or not this node has multiple upstream nodes.
+# For the TRAVERSE_CACHED_NODES the result is cached (up to
+# TRAVERSE_CACHE_SIZE of them, least recently used first out), and reused as
+# long as the node is unchanged (attribute data may have been added to a copy
+# of it), so it must not be modified.
 def _traverse_document(doc,focal_node,index):
 
     key_prefix = "" # for nodes embedded into other nodes, use this prefix to prepend their keys like project_name
-    props = [] # list of all the properties to be added
+    props = [] # list of all the (key, value) properties to be added
     tags = [] # list of tags to be attached to the ID
     doc_id = "" # keep track of the ID for this particular doc.
     relevant_doc = "" # potentially reformat if being passed a doc with a list
@@ -826,19 +1611,32 @@ def _traverse_document(doc,focal_node,index):
         key_prefix = "{0}_".format(focal_node)
 
     if focal_node not in doc:
-        return {'id':doc_id,'tag_list':tags,'prop_str':"",'props':props}
+        return {'id':doc_id,'tag_list':tags,'prop_str':"",'props':_PropRecord()}
 
     if index == '':
         relevant_doc = doc[focal_node]
     else:
         relevant_doc = doc[focal_node][index]
 
+    cache_key = None
+    if focal_node in TRAVERSE_CACHED_NODES and 'id' in relevant_doc:
+        cache_key = (focal_node, relevant_doc['id'])
+        stats = TRAVERSE_CACHE_STATS.setdefault(focal_node, [0, 0, 0])
+        cached = TRAVERSE_CACHE.get(cache_key)
+        if cached is not None:
+            if cached[0] is relevant_doc or cached[0] == relevant_doc:
+                stats[0] += 1
+                TRAVERSE_CACHE.move_to_end(cache_key)
+                return cached[1]
+            stats[2] += 1
+        stats[1] += 1
+
     for key,val in relevant_doc.items():
         if key == 'linkage' or not val: # document itself contains all linkage info already
             continue
 
         if isinstance(val, int) or isinstance(val, float):
-            props.append({'key': '{0}{1}'.format(key_prefix,key), 'value': val })
+            props.append(('{0}{1}'.format(key_prefix,key), val))
         elif isinstance(val, list): # lists should be urls, contacts, and tags
             for j in range(0,len(val)):
 
@@ -852,53 +1650,67 @@ def _traverse_document(doc,focal_node,index):
                             email = vals
                             break
                     if email:
-                        props.append({'key': '{0}contact'.format(key_prefix), 'value': '{0}'.format(email) })
+                        props.append(('{0}contact'.format(key_prefix), '{0}'.format(email)))
                         break
                     else:
-                        props.append({'key': '{0}contact'.format(key_prefix), 'value': '{0}'.format(val[j]) })
+                        props.append(('{0}contact'.format(key_prefix), '{0}'.format(val[j])))
                         break
 
                 else:
                     endpoint = val[j].split(':')[0]
-                    props.append({'key': '{0}{1}'.format(key_prefix,endpoint), 'value': '{0}'.format(val[j]) })
+                    props.append(('{0}{1}'.format(key_prefix,endpoint), '{0}'.format(val[j])))
         else:
             val = _mod_body_site(val)
-            props.append({'key': '{0}{1}'.format(key_prefix,key), 'value': '{0}'.format(val) })
+            props.append(('{0}{1}'.format(key_prefix,key), '{0}'.format(val)))
 
         if key == "id":
             doc_id = val
 
     if focal_node == 'main': # missing file formats will default to text files (only true so far for lipidome)
         format_present = False
-        for p in props:
-            if p['key'] == 'format':
+        for key, val in props:
+            if key == 'format':
                 format_present = True
                 break
 
         if not format_present:
-            props.append({'key': 'format', 'value': 'Text' })
+            props.append(('format', 'Text'))
 
     # remove empty properties and apply rewrites
     new_props = []
     new_prop_strs = []
-    for prop in props:
-        if (prop['key'] is None or prop['key'] == ""):
+    for key, val in props:
+        if (key is None or key == ""):
             continue
 
         # change syntax for file format and node_type
-        if focal_node == 'main' and prop['key'] == 'format':
+        if focal_node == 'main' and key == 'format':
             for v1,v2 in file_format_dict.items():
-                if prop['value'] == v1:
-                    prop['value'] = v2
+                if val == v1:
+                    val = v2
                     break
 
-        new_props.append(prop)
-        new_prop_strs.append('`{0}`:{1}'.format(prop['key'], prop['value']))
+        new_props.append((key, val))
+        new_prop_strs.append('`{0}`:{1}'.format(key, val))
 
-    props = new_props
+    props = _PropRecord(new_props)
     props_str = (',').join(new_prop_strs)
 
-    return {'id':doc_id,'tag_list':tags,'prop_str':props_str,'props':props}
+    info = {'id':doc_id,'tag_list':tags,'prop_str':props_str,'props':props}
+    if cache_key is not None:
+        TRAVERSE_CACHE[cache_key] = (relevant_doc, info)
+        TRAVERSE_CACHE.move_to_end(cache_key)
+        if TRAVERSE_CACHE_SIZE is not None and len(TRAVERSE_CACHE) > TRAVERSE_CACHE_SIZE:
+            TRAVERSE_CACHE.popitem(last=False)
+    return info
+
+# Write the hit rates of the _traverse_document cache.
+def _print_traverse_cache_stats():
+    for focal_node in TRAVERSE_CACHED_NODES:
+        if focal_node in TRAVERSE_CACHE_STATS:
+            hits, misses, invalidated = TRAVERSE_CACHE_STATS[focal_node]
+            pct = 100.0 * hits / max(hits + misses, 1)
+            _print_error("traversal cache: {0} {1} hits, {2} misses ({3} invalidated), {4:.1f}% hits".format(focal_node, hits, misses, invalidated, pct))
 
 def _add_unique_tags(th, tl):
     if isinstance(tl, string_types):
@@ -925,20 +1737,16 @@ def _generate_cypher(doc,index):
     sample_info = _traverse_document(doc,'sample',index)
     visit_info = _traverse_document(doc,'visit',index)
     study_info = _traverse_document(doc,'study',index)
-    sample_props = sample_info['props']
-    sample_props.extend(visit_info['props'])
-    sample_props.extend(study_info['props'])
     if sample_info['id'] not in NODE_IDS:
         NODE_IDS[sample_info['id']] = True
+        sample_props = _PropRecord(itertools.chain(sample_info['props'].items(), visit_info['props'].items(), study_info['props'].items()))
         NODES['sample'].append({'_props': sample_props})
 
     subject_info = _traverse_document(doc,'subject',index)
     project_info = _traverse_document(doc,'project',index)
-    subject_props = subject_info['props']
-    subject_props.extend(project_info['props'])
-    props = "{0},{1}".format(subject_info['prop_str'],project_info['prop_str'])
     if subject_info['id'] not in NODE_IDS:
         NODE_IDS[subject_info['id']] = True
+        subject_props = _PropRecord(itertools.chain(subject_info['props'].items(), project_info['props'].items()))
         NODES['subject'].append({'_props': subject_props})
 
     prep_info = _traverse_document(doc,'prep',index)
@@ -954,26 +1762,23 @@ def _generate_cypher(doc,index):
     # sample(id) <-[:derived_from]-(n3) file(id) -> derived_from has associated properties
     lkey = ":".join([sample_info['id'], file_info['id']])
 
-    # checking uniqueness of sample-file links is expensive because the link properties (minus 'id') must be examined:
+    # the uniqueness of sample-file links depends on the link properties (minus 'id'):
     if args.check_sample_file_uniqueness:
-        prop_list = sorted(x for x in prep_info['props'] if x['key'] != 'id')
-        pp = pprint.PrettyPrinter(indent=2)
-        props_str = pp.pformat(prop_list)
-
-        if lkey in UNIQUE_LINKS:
-            # dict of sorted PrettyPrinted properties seen thus far
-            props_d = UNIQUE_LINKS[lkey]
-
-            # link is an exact duplicate
-            if props_str in props_d:
-                _print_error("INFO - duplicate link with lkey=" + lkey + " and identical properties")
-            else:
-                props_d[props_str] = True
+        props_hash = _link_props_hash(prep_info['props'])
+        if SAMPLE_FILE_CHECKS is not None:
+            SAMPLE_FILE_CHECKS.append((lkey, props_hash))
         else:
-            UNIQUE_LINKS[lkey] = { props_str: True }
+            _check_sample_file_link(lkey, props_hash)
 
     sample_file_link = { 'sample_id': sample_info['id'], 'file_id': file_info['id'], '_props': prep_info['props'] }
-    NODE_LINKS['sample-file']['links'].append(sample_file_link)
+    # links are created by neo4j-admin import, so skip those that MERGE would have matched
+    if CSV_IMPORT:
+        plkey = _sample_file_link_key(sample_file_link)
+        if plkey not in UNIQUE_LINKS:
+            NODE_LINKS['sample-file']['links'].append(sample_file_link)
+            UNIQUE_LINKS[plkey] = True
+    else:
+        NODE_LINKS['sample-file']['links'].append(sample_file_link)
 
     # flatten lists of lists, uniquifying as we go
     _add_unique_tags(all_tags, file_info['tag_list'])
@@ -1003,10 +1808,54 @@ def _generate_cypher(doc,index):
             # add tag if it hasn't already been seen
             if tag not in TAGS:
                 TAGS[tag] = tag_link
-                NODES['tag'].append({'_props': [{'key': 'term', 'value': tag }]})
+                NODES['tag'].append({'_props': _PropRecord([('term', tag)])})
 
     return cypher
 
+# Key of a sample-file link in UNIQUE_LINKS (with --csv_dir.) The link
+# properties are those of the prep, so links from the same prep to the same
+# sample and file are identical.
+def _sample_file_link_key(link):
+    return ":".join([link['sample_id'], link['file_id'], link['_props'].get('id', '')])
+
+# SHA-1 digest of the properties of a link other than 'id', independent of
+# their order. Unlike hash(), it does not depend on the process' hash seed, and
+# two different sets of properties are not taken for the same one.
+def _link_props_hash(props):
+    items = sorted((item for item in props.items() if item[0] != 'id'), key=lambda item: item[0])
+    return hashlib.sha1(repr(items).encode('utf-8')).digest()
+
+# Record a sample-file link with key lkey and properties digest props_hash in
+# SAMPLE_FILE_PROPS, and count it if there already was a link with that key.
+def _check_sample_file_link(lkey, props_hash):
+    seen = SAMPLE_FILE_PROPS.get(lkey)
+    if seen is None:
+        SAMPLE_FILE_PROPS[lkey] = props_hash
+        return
+    if isinstance(seen, set):
+        identical = props_hash in seen
+        seen.add(props_hash)
+    else:
+        identical = props_hash == seen
+        if not identical:
+            SAMPLE_FILE_PROPS[lkey] = set([seen, props_hash])
+
+    if identical:
+        SAMPLE_FILE_DUPLICATES['identical'] = SAMPLE_FILE_DUPLICATES.get('identical', 0) + 1
+        if DUMP_PROBLEM_DOCS:
+            _print_error("INFO - duplicate link with lkey=" + lkey + " and identical properties")
+    else:
+        SAMPLE_FILE_DUPLICATES['different'] = SAMPLE_FILE_DUPLICATES.get('different', 0) + 1
+        if DUMP_PROBLEM_DOCS:
+            _print_error("INFO - duplicate link with lkey=" + lkey + " and different properties")
+
+# Write the counts of duplicate sample-file links found by --check_sample_file_uniqueness.
+def _print_sample_file_duplicates():
+    sys.stdout.write("duplicate sample-file links ({0} distinct):\n".format(len(SAMPLE_FILE_PROPS)))
+    sys.stdout.write("  identical properties : {0}\n".format(SAMPLE_FILE_DUPLICATES.get('identical', 0)))
+    sys.stdout.write("  different properties : {0}\n".format(SAMPLE_FILE_DUPLICATES.get('different', 0)))
+    sys.stdout.write("\n")
+
 # Function to insert into Neo4j. Takes in Neo4j connection and a document.
 def _generate_cypher_statements(doc):
 
@@ -1025,66 +1874,769 @@ def _generate_cypher_statements(doc):
     else:
         return ""
 
-# Takes a dictionary from the OSDF doc and builds a list of the keys that are
-# irrelevant.
-def _delete_keys_from_dict(doc_dict):
-    delete_us = []
-
-    for key,val in doc_dict.items():
-        if not val or not key:
-            delete_us.append(key)
+# Yield the node type and id of every File node to build, in the order of the
+# dict of nodes (and report the File node types that are skipped.)
+def _file_node_keys(nodes):
+    for key in nodes:
 
-        # Unfortunately... have to check for keys comprised of blank spaces
-        if len(key.replace(' ','')) == 0:
-            delete_us.append(key)
+        if key in file_nodes:
 
-    for empty in delete_us:
-        del doc_dict[empty]
+            if key in COMPILED_UPSTREAM_RULES:
+                for id in nodes[key]:
+                    if id not in ignore:
+                        yield (key, id)
 
-    return doc_dict
+            elif not re.search(r'_prep$', key):
+                _print_error("skipping {0} File nodes of type {1}".format(len(nodes[key]), key))
 
-# Insert an element (n) into a dict (d) of lists indexed by key (k)
-def _add_to_group(d, n, k):
-    if k in d:
-        d[k].append(n)
+# Build the doc of each File node in file_keys and add its nodes, links and
+# tags to NODES, NODE_LINKS and TAGS (from where an _InsertPipeline, if given,
+# collects them every PIPELINE_COLLECT_FILES File nodes.)
+def _generate_file_cypher(nodes, file_keys, pipeline=None):
+    n_files = 0
+    for node_type, node_id in file_keys:
+        _generate_cypher_statements(_build_file_doc(nodes, nodes[node_type][node_id]))
+        n_files += 1
+        if pipeline is not None and n_files % PIPELINE_COLLECT_FILES == 0:
+            pipeline.collect()
+
+# number of File nodes handed to a --generate_workers process at a time
+GENERATE_CHUNK_SIZE = 5000
+
+# the dict of nodes, File node keys and node store that the forked
+# _generate_file_range workers read (see _generate_in_pool)
+GENERATE_STATE = {}
+
+def _generate_in_pool(nodes, file_keys, n_workers, node_store=None, pipeline=None):
+    """
+    Parallel version of _generate_file_cypher. Forks n_workers processes,
+    which share the dict of nodes copy-on-write, and hands each of them chunks
+    of GENERATE_CHUNK_SIZE File nodes at a time. The partial NODES, NODE_LINKS,
+    TAGS (etc.) of each chunk are merged back in the order of file_keys and
+    deduplicated as they would have been in a serial run, so the result is the
+    same. An _InsertPipeline, if given, collects them after each chunk.
+    """
+    if node_store is not None:
+        node_store.flush()
+    GENERATE_STATE['nodes'] = nodes
+    GENERATE_STATE['file_keys'] = file_keys
+    GENERATE_STATE['node_store'] = node_store
+
+    chunks = [(start, min(start + GENERATE_CHUNK_SIZE, len(file_keys))) for start in range(0, len(file_keys), GENERATE_CHUNK_SIZE)]
+    pool = multiprocessing.get_context("fork").Pool(n_workers, _init_generate_worker)
+    try:
+        for partial in pool.imap(_generate_file_range, chunks):
+            _merge_generated(partial)
+            if pipeline is not None:
+                pipeline.collect()
+    finally:
+        pool.terminate()
+        GENERATE_STATE.clear()
+
+# Each forked worker needs a connection of its own to the --node_store file.
+def _init_generate_worker():
+    if GENERATE_STATE['node_store'] is not None:
+        GENERATE_STATE['node_store'].reopen()
+
+# Build the File nodes in file_keys[start:end] (in a worker forked by
+# _generate_in_pool) and return what was generated for them.
+def _generate_file_range(bounds):
+    global SAMPLE_FILE_CHECKS
+    _reset_generated()
+    SAMPLE_FILE_CHECKS = []
+    start, end = bounds
+    _generate_file_cypher(GENERATE_STATE['nodes'], GENERATE_STATE['file_keys'][start:end])
+
+    partial = {
+        'nodes': NODES,
+        'links': dict((link_type, NODE_LINKS[link_type]['links']) for link_type in NODE_LINKS),
+        'tags': TAGS,
+        'nodes_by_type': NODES_BY_TYPE,
+        'props_by_type': PROPS_BY_TYPE,
+        'no_upstream_srs': NO_UPSTREAM_SRS,
+        'srs_match_counts': SRS_MATCH_COUNTS,
+        'traverse_cache_stats': TRAVERSE_CACHE_STATS,
+        'upstream_problems': UPSTREAM_PROBLEMS,
+        'sample_file_checks': SAMPLE_FILE_CHECKS
+    }
+    return partial
+
+# Empty everything that _generate_cypher adds to.
+def _reset_generated():
+    for node_type in NODES:
+        del NODES[node_type][:]
+    for link_type in NODE_LINKS:
+        del NODE_LINKS[link_type]['links'][:]
+    del UPSTREAM_PROBLEMS[:]
+    for d in [TAGS, UNIQUE_LINKS, SAMPLE_FILE_PROPS, SAMPLE_FILE_DUPLICATES, NODE_IDS, NODES_BY_TYPE, PROPS_BY_TYPE, NO_UPSTREAM_SRS, SRS_MATCH_COUNTS, TRAVERSE_CACHE_STATS]:
+        d.clear()
+
+# Merge the nodes, links, tags and counts generated by a _generate_file_range
+# worker into the global ones, skipping those already seen.
+def _merge_generated(partial):
+    for node_type in ['file', 'sample', 'subject']:
+        for node in partial['nodes'][node_type]:
+            node_id = node['_props'].get('id')
+            if node_id not in NODE_IDS:
+                NODE_IDS[node_id] = True
+                NODES[node_type].append(node)
+
+    # each new tag was added to both TAGS and NODES['tag']
+    for tag, node in zip(partial['tags'], partial['nodes']['tag']):
+        if tag not in TAGS:
+            TAGS[tag] = partial['tags'][tag]
+            NODES['tag'].append(node)
+
+    for link in partial['links']['subject-sample']:
+        lkey = ":".join([link['subject_id'], link['sample_id']])
+        if lkey not in UNIQUE_LINKS:
+            NODE_LINKS['subject-sample']['links'].append(link)
+            UNIQUE_LINKS[lkey] = True
+
+    for link in partial['links']['file-tag']:
+        tlkey = ":".join([link['file_id'], link['term']])
+        if tlkey not in UNIQUE_LINKS:
+            NODE_LINKS['file-tag']['links'].append(link)
+            UNIQUE_LINKS[tlkey] = True
+
+    if CSV_IMPORT:
+        for link in partial['links']['sample-file']:
+            plkey = _sample_file_link_key(link)
+            if plkey not in UNIQUE_LINKS:
+                NODE_LINKS['sample-file']['links'].append(link)
+                UNIQUE_LINKS[plkey] = True
     else:
-        d[k] = [n]
-    
-# Concatenate the properties of a node/edge to determine its signature.
-def _get_properties_sig(node):
-    return "||".join(sorted([p['key'] for p in node]))
+        NODE_LINKS['sample-file']['links'].extend(partial['links']['sample-file'])
+
+    # the worker only listed its sample-file links, so that all of them are
+    # counted here, in the order of a serial run
+    for lkey, props_hash in partial['sample_file_checks']:
+        _check_sample_file_link(lkey, props_hash)
+
+    for t, count in partial['nodes_by_type'].items():
+        NODES_BY_TYPE[t] = NODES_BY_TYPE.get(t, 0) + count
+    for t, pbt in partial['props_by_type'].items():
+        for pstr, count in pbt.items():
+            PROPS_BY_TYPE.setdefault(t, {})
+            PROPS_BY_TYPE[t][pstr] = PROPS_BY_TYPE[t].get(pstr, 0) + count
+    for subtype, ids in partial['no_upstream_srs'].items():
+        NO_UPSTREAM_SRS.setdefault(subtype, {}).update(ids)
+    for field, count in partial['srs_match_counts'].items():
+        SRS_MATCH_COUNTS[field] = SRS_MATCH_COUNTS.get(field, 0) + count
+    for focal_node, counts in partial['traverse_cache_stats'].items():
+        stats = TRAVERSE_CACHE_STATS.setdefault(focal_node, [0, 0, 0])
+        for i in range(0, len(counts)):
+            stats[i] += counts[i]
+    UPSTREAM_PROBLEMS.extend(partial['upstream_problems'])
+
+# Top-level document fields that are never loaded.
+DROPPED_DOC_KEYS = frozenset(['_id', '_rev', 'acl', 'ns'])
+
+# Sections of 'meta' whose blank (all-space) keys are dropped before flattening.
+CLEANED_META_SECTIONS = frozenset(['mixs', 'mimarks'])
+
+def _normalize_doc(row):
+    """
+    Normalize a CouchDB row (as returned by _all_docs or _changes with
+    include_docs=true) into the {'id': ..., 'doc': ...} form used to build the
+    graph, in a single pass over the document. Fields with empty values or
+    blank keys are dropped, the 'meta' section is flattened into the document
+    (up to three levels deep, with the keys_to_keep subsections prefixed),
+    private files get a placeholder URL and old '_attr' node types are renamed
+    to '_attribute'. Returns None for documents that should not be loaded at
+    all. The row's linkage and meta sections may be modified in place.
+    """
+    doc_id = row['id']
 
-# Generic Cypher insert function that makes use of UNWIND to perform fast
-# batch inserts (with batch size set by args.batch_size.) 
-#
-# cy - Cypher Graph
-# insert_cypher - Cypher UNWIND query to insert data. It may contain the string "<PROPS>".
-# obj_list - List of objects (nodes or links/edges) to insert. This is a list of dicts 
-#   that defines the attributes/fields referenced in insert_cypher. If insert_cypher 
-#   contains the string "<PROPS>" then each dict must have a '_props' field mapping to
-#   a list of { 'key': property_key, 'value': property_value }.
-# obj_type - Type of object ('node' or 'link') to be inserted. Used only to print a 
-#   status message.
-#
-# When the insert_cypher contains the string "<PARAMS>" the function will 
-# substitute in the actual parameter list based on the '_params' defined by
-# each object in obj_list. Note that the objects need not all define the 
-# same '_params': the fuction automatically groups the objects so that those
-# with the same parameter signature are inserted together (allowing the use 
-# of a single Cypher query for each such group of objects.) This significantly
-# improves the speed at which inserts can be processed.
-#
-def _do_cypher_insert(cy, insert_cypher, obj_list, obj_type):
-    stime = time.time()
+    # Assume we don't want design documents, since they're likely to be
+    # already stored elsewhere (e.g. in version control)
+    if doc_id.startswith("_design") or doc_id.endswith("_hist"):
+        return None
+
+    doc = {}
+    meta = None
+
+    for key, val in row['doc'].items():
+        if key in DROPPED_DOC_KEYS:
+            continue
+        if key == 'linkage' and 'subset_of' in val:
+            del val['subset_of']
+        if not val or not key.strip(' '):
+            continue
+        if key == 'meta':
+            meta = val
+        else:
+            doc[key] = val
+
+    # Now move meta values a step outward and make them a base property instead of nested
+    if meta is not None:
+
+        # Private nodes should have some mock URL data in them
+        if 'urls' in meta:
+            if len(meta['urls']) == 1 and meta['urls'][0] == "":
+                meta['urls'][0] = 'Private:Private Data ({0})'.format(doc_id)
+
+        for key, val in meta.items():
+            if not val or not key.strip(' '):
+                continue
+
+            if not isinstance(val, dict):
+                doc[key] = val
+                continue
+
+            cleaned = key in CLEANED_META_SECTIONS
+            for ke, va in val.items():
+                if cleaned and (not va or not ke.strip(' ')):
+                    continue
+
+                if isinstance(va, dict):
+                    for k, v in va.items():
+                        if k and v:
+                            if ke in keys_to_keep:
+                                doc["{}_{}".format(ke, k)] = v
+                            else:
+                                doc[k] = v
+
+                elif ke and va:
+                    doc[ke] = va
+
+    doc['id'] = doc_id
+
+    # Fix the old syntax to make sure it reads 'attribute' and not just 'attr'
+    if doc['node_type'].endswith("_attr"):
+        doc['node_type'] = "{0}ibute".format(doc['node_type'])
+
+    return { 'id': doc_id, 'doc': doc }
+
+# Normalize a list of rows, passing deletions (from the _changes feed) through.
+def _normalize_rows(rows):
+    normalized = []
+    for row in rows:
+        if row.get('deleted'):
+            normalized.append({ 'id': row['id'], 'deleted': True })
+            continue
+        row = _normalize_doc(row)
+        if row is not None:
+            normalized.append(row)
+    return normalized
+
+# number of rows below which _normalize_in_pool normalizes them inline: the
+# pool takes about 0.07 s to start, a tenth of the time it takes to normalize
+# this many rows inline (about 6.7 us each, on the synthetic corpus)
+NORMALIZE_POOL_MIN_DOCS = 100000
+
+def _normalize_in_pool(rows, n_workers, page_size):
+    """
+    Normalize a stream of rows with _normalize_doc in a pool of n_workers
+    processes, page_size rows at a time, and present the results as a stream
+    in the original order. Pages are submitted from the caller's thread, so
+    that an error in the rows' source is raised there, and at most two pages
+    per worker are in flight. A stream of fewer than NORMALIZE_POOL_MIN_DOCS
+    rows is normalized inline.
+    """
+    rows = iter(rows)
+    head = list(itertools.islice(rows, NORMALIZE_POOL_MIN_DOCS))
+    if len(head) < NORMALIZE_POOL_MIN_DOCS:
+        for r in _normalize_rows(head):
+            yield r
+        return
+    rows = itertools.chain(head, rows)
+
+    pool = multiprocessing.Pool(n_workers)
+    pending = collections.deque()
+
+    def pages():
+        page = []
+        for r in rows:
+            page.append(r)
+            if len(page) == page_size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    try:
+        for page in pages():
+            pending.append(pool.apply_async(_normalize_rows, (page,)))
+            if len(pending) > n_workers * 2:
+                for r in pending.popleft().get():
+                    yield r
+        while pending:
+            for r in pending.popleft().get():
+                yield r
+    finally:
+        pool.terminate()
+
+# The node types loaded from CouchDB, i.e., the keys of the dict of nodes.
+NODE_TYPES = [
+    'project',
+    'study',
+    'subject',
+    'subject_attribute',
+    'visit',
+    'visit_attribute',
+    'sample',
+    'sample_attribute',
+    'wgs_dna_prep',
+    'host_seq_prep',
+    'wgs_raw_seq_set',
+    'wgs_raw_seq_set_private',
+    'host_wgs_raw_seq_set',
+    'microb_transcriptomics_raw_seq_set',
+    'host_transcriptomics_raw_seq_set',
+    'wgs_assembled_seq_set',
+    'viral_seq_set',
+    'annotation',
+    'clustered_seq_set',
+    '16s_dna_prep',
+    '16s_raw_seq_set',
+    '16s_trimmed_seq_set',
+    'microb_assay_prep',
+    'host_assay_prep',
+    'proteome',
+    'metabolome',
+    'lipidome',
+    'cytokine',
+    'abundance_matrix',
+
+    # new node types added 10/22/2018
+    'reference_genome_project_catalog_entry',
+    'host_epigenetics_raw_seq_set',
+    'serology',
+    'metagenomic_project_catalog_entry',
+    'alignment',
+    'proteome_nonpride',
+    'host_variant_call'
+]
+
+# strings up to this length are interned in _NodeRecords (longer ones, such as
+# URLs and descriptions, are rarely repeated)
+INTERN_MAX_LEN = 64
+
+class _NodeRecord(tuple):
+    """
+    Compact, immutable stand-in for the dict of a normalized document, as kept
+    in the dict of nodes for the whole run. A record is a single tuple: a
+    key -> position dict, shared by all records with the same fields (in the
+    same order), followed by the values. Keys and short string values are
+    interned, so that ids, linkage targets and repeated values (study names,
+    formats, ...) are stored once. Supports the read-only parts of the dict
+    interface used by _build_file_doc; updated() returns a copy
+    with fields added or replaced (see _append_attribute_data.)
+    """
+    __slots__ = ()
+
+    # tuple of keys -> shared key -> position dict
+    LAYOUTS = {}
+
+    def __new__(cls, items):
+        keys = []
+        values = []
+        for k, v in items:
+            keys.append(sys.intern(k))
+            values.append(_compact_value(v))
+        return tuple.__new__(cls, [_NodeRecord._layout(tuple(keys))] + values)
+
+    @staticmethod
+    def _layout(keys):
+        fields = _NodeRecord.LAYOUTS.get(keys)
+        if fields is None:
+            fields = dict((k, i + 1) for i, k in enumerate(keys))
+            _NodeRecord.LAYOUTS[keys] = fields
+        return fields
+
+    def __getnewargs__(self):
+        return (self.items(),)
+
+    def __getitem__(self, key):
+        return tuple.__getitem__(self, tuple.__getitem__(self, 0)[key])
+
+    def __contains__(self, key):
+        return key in tuple.__getitem__(self, 0)
+
+    def __iter__(self):
+        return iter(tuple.__getitem__(self, 0))
+
+    def __len__(self):
+        return tuple.__len__(self) - 1
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def get(self, key, default=None):
+        fields = tuple.__getitem__(self, 0)
+        if key in fields:
+            return tuple.__getitem__(self, fields[key])
+        return default
+
+    def keys(self):
+        return list(tuple.__getitem__(self, 0))
+
+    def items(self):
+        return list(zip(tuple.__getitem__(self, 0), tuple.__getitem__(self, slice(1, None))))
+
+    def updated(self, items):
+        new_items = self.items()
+        fields = tuple.__getitem__(self, 0)
+        for k, v in items:
+            if k in fields:
+                new_items[fields[k] - 1] = (k, v)
+            else:
+                new_items.append((k, v))
+        return _NodeRecord(new_items)
+
+# Return value with its short strings interned, recursing into lists and
+# turning nested dicts (e.g., linkage) into _NodeRecords.
+def _compact_value(value):
+    if isinstance(value, str):
+        if len(value) <= INTERN_MAX_LEN:
+            return sys.intern(value)
+    elif isinstance(value, list):
+        return [_compact_value(v) for v in value]
+    elif isinstance(value, dict):
+        return _NodeRecord(value.items())
+    return value
+
+# default number of records kept in memory in front of a --node_store file
+NODE_CACHE_SIZE = 100000
+
+# tables of a --node_store file that hold NODE_TYPE_INDEX, LINEAGE and the
+# nodes with attribute data appended while LINEAGE is built (not node types)
+NODE_TYPE_INDEX_TABLE = "_node_type_index"
+LINEAGE_TABLE = "_lineage"
+LINEAGE_ATTRIBUTES_TABLE = "_lineage_attributes"
+
+# number of writes to a --node_store file that are buffered before they are
+# written in one go
+NODE_STORE_WRITE_BATCH = 10000
+
+class _DiskNodeStore(object):
+    """
+    sqlite3-backed store of _NodeRecords keyed by (node_type, id), for corpora
+    that do not fit in memory. table(node_type) returns a dict-like view of one
+    node type that can stand in for the per-type dicts in the dict of nodes;
+    NODE_TYPE_INDEX and LINEAGE are kept in tables of their own as well.
+    Reads go through an LRU cache of cache_size records (which also remembers
+    ids that are not present, since links to missing nodes are probed for
+    every file below them), and writes are buffered and written in batches.
+    """
+    def __init__(self, path, cache_size=NODE_CACHE_SIZE):
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        self.conn = sqlite3.connect(path)
+        # the file is scratch space, rebuilt on every run
+        self.conn.execute("PRAGMA journal_mode=OFF")
+        self.conn.execute("PRAGMA synchronous=OFF")
+        self.conn.execute("CREATE TABLE nodes (node_type TEXT NOT NULL, id TEXT NOT NULL, record BLOB NOT NULL, PRIMARY KEY (node_type, id)) WITHOUT ROWID")
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        # (node_type, id) -> record, or None for a deletion
+        self.pending = {}
+        self.n_reads = 0
+        self.n_cache_hits = 0
+
+    def table(self, node_type):
+        return _DiskNodeTable(self, node_type)
+
+    # open a new connection to the file in a forked process (the inherited
+    # one is kept, but never used or closed in that process)
+    def reopen(self):
+        self.inherited_conn = self.conn
+        self.conn = sqlite3.connect(self.path)
+
+    def get(self, node_type, node_id):
+        key = (node_type, node_id)
+        self.n_reads += 1
+        if key in self.pending:
+            self.n_cache_hits += 1
+            return self.pending[key]
+        if key in self.cache:
+            self.n_cache_hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        record = None
+        row = self.conn.execute("SELECT record FROM nodes WHERE node_type=? AND id=?", key).fetchone()
+        if row is not None:
+            record = pickle.loads(row[0])
+        self.cache[key] = record
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return record
+
+    def put(self, node_type, node_id, record):
+        key = (node_type, node_id)
+        self.cache.pop(key, None)
+        self.pending[key] = record
+        if len(self.pending) >= NODE_STORE_WRITE_BATCH:
+            self.flush()
+
+    def flush(self):
+        puts = [(k[0], k[1], pickle.dumps(r, pickle.HIGHEST_PROTOCOL)) for k, r in self.pending.items() if r is not None]
+        deletes = [k for k, r in self.pending.items() if r is None]
+        self.conn.executemany("INSERT OR REPLACE INTO nodes (node_type, id, record) VALUES (?, ?, ?)", puts)
+        self.conn.executemany("DELETE FROM nodes WHERE node_type=? AND id=?", deletes)
+        self.conn.commit()
+        self.pending = {}
+
+    def iter_ids(self, node_type):
+        self.flush()
+        for row in self.conn.execute("SELECT id FROM nodes WHERE node_type=?", (node_type,)):
+            yield row[0]
+
+    def count(self, node_type):
+        self.flush()
+        return self.conn.execute("SELECT COUNT(*) FROM nodes WHERE node_type=?", (node_type,)).fetchone()[0]
+
+    def print_stats(self):
+        pct = 0.0
+        if self.n_reads > 0:
+            pct = 100.0 * self.n_cache_hits / self.n_reads
+        _print_error("node store: {0} reads, {1:.1f}% from the cache of {2} records".format(self.n_reads, pct, self.cache_size))
+
+    # close and remove the store
+    def close(self):
+        self.conn.close()
+        os.remove(self.path)
+
+# One node type of a _DiskNodeStore, with the dict interface used on the per-type
+# dicts in the dict of nodes.
+class _DiskNodeTable(object):
+    def __init__(self, store, node_type):
+        self.store = store
+        self.node_type = node_type
+
+    def __contains__(self, node_id):
+        return self.store.get(self.node_type, node_id) is not None
+
+    def __getitem__(self, node_id):
+        record = self.store.get(self.node_type, node_id)
+        if record is None:
+            raise KeyError(node_id)
+        return record
+
+    def get(self, node_id, default=None):
+        record = self.store.get(self.node_type, node_id)
+        if record is None:
+            return default
+        return record
+
+    def pop(self, node_id, default=None):
+        record = self.store.get(self.node_type, node_id)
+        if record is None:
+            return default
+        self.store.put(self.node_type, node_id, None)
+        return record
+
+    def __setitem__(self, node_id, record):
+        self.store.put(self.node_type, node_id, record)
+
+    def __delitem__(self, node_id):
+        self.store.put(self.node_type, node_id, None)
+
+    def __iter__(self):
+        return self.store.iter_ids(self.node_type)
+
+    def __len__(self):
+        return self.store.count(self.node_type)
+
+# Add a cleaned row to the dict of nodes, keyed by node type and id, or count
+# it in node_skip_counts if its node type is not loaded. Each document is kept
+# as a _NodeRecord; attribute documents only keep the fields that
+# _append_attribute_data copies (those in meta_to_keep) and their id. When doc_keys is given
+# it records where each document id was stored, so that a later incremental
+# update can replace or remove it.
+def _add_doc_to_nodes(nodes, doc, node_skip_counts, doc_keys=None):
+
+    # an updated document may have moved (e.g., new associated_with link)
+    if doc_keys is not None:
+        _remove_doc_from_nodes(nodes, doc['id'], doc_keys)
+
+    # Build a giant list of each node type
+    if doc['doc']['node_type'] in nodes:
+
+        # Also, for these nodes, assign their ID to be the same as the
+        # sample/visit/subject they associate with for easy lookups.
+        # The data will also be subset to the 'meta' section as that is
+        # where the interesting information lies in the attribute nodes.
+        node_key = doc['id']
+        if doc['doc']['node_type'].endswith("attribute"):
+            if len(doc['doc']['linkage']['associated_with']) > 0: # get around test uploads
+                node_key = doc['doc']['linkage']['associated_with'][0]
+            else:
+                return
+
+            record = _NodeRecord((k, v) for k, v in doc['doc'].items() if k == 'id' or k in meta_to_keep)
+        else:
+            record = _NodeRecord(doc['doc'].items())
+        node_key = sys.intern(node_key)
+
+        nodes[doc['doc']['node_type']][node_key] = record
+        if node_key == doc['id']:
+            NODE_TYPE_INDEX[node_key] = doc['doc']['node_type']
+        if doc_keys is not None:
+            doc_keys[doc['id']] = (doc['doc']['node_type'], node_key)
+
+    else:
+        node_type = doc['doc']['node_type']
+        if node_type in node_skip_counts:
+            node_skip_counts[node_type] += 1
+        else:
+            node_skip_counts[node_type] = 1
+
+# Remove a previously stored document from the dict of nodes, using the
+# locations recorded by _add_doc_to_nodes.
+def _remove_doc_from_nodes(nodes, doc_id, doc_keys):
+    if doc_id not in doc_keys:
+        return
+    node_type, node_key = doc_keys.pop(doc_id)
+    # attribute nodes share keys, so only remove the entry if it is still this doc
+    if node_key in nodes[node_type] and nodes[node_type][node_key]['id'] == doc_id:
+        del nodes[node_type][node_key]
+    if node_key == doc_id:
+        NODE_TYPE_INDEX.pop(doc_id, None)
+
+# Fill NODE_TYPE_INDEX from a dict of nodes (e.g., one loaded by
+# _load_node_store.)
+def _index_node_types(nodes):
+    for node_type in nodes:
+        if not node_type.endswith("attribute"):
+            for node_id in nodes[node_type]:
+                NODE_TYPE_INDEX[node_id] = node_type
+
+# Insert an element (n) into a dict (d) of lists indexed by key (k)
+def _add_to_group(d, n, k):
+    if k in d:
+        d[k].append(n)
+    else:
+        d[k] = [n]
+    
+# Substitute the properties with signature sig into insert_cypher.
+def _props_cypher(insert_cypher, sig):
+    props_cypher = ", ".join(["`" + p + "`: o.`" + p + "`" for p in sig.split("||")])
+    return re.sub(r'<PROPS>', props_cypher, insert_cypher)
+
+# Create the list of dicts to pass to the Neo4j driver: nodes are passed
+# their _PropRecord as is, links get a copy with the node ids added.
+def _driver_objects(o_list):
+    new_o_list = []
+    for obj in o_list:
+        if len(obj) == 1 and '_props' in obj:
+            new_o_list.append(obj['_props'])
+            continue
+        new_obj = {}
+        for k in obj:
+            if k == '_props':
+                new_obj.update(obj['_props'])
+            else:
+                new_obj[k] = obj[k]
+        new_o_list.append(new_obj)
+    return new_o_list
+
+# smallest and largest batch sizes that --target_commit_seconds may settle on
+ADAPTIVE_MIN_BATCH_SIZE = 100
+ADAPTIVE_MAX_BATCH_SIZE = 200000
+
+# commit times within this fraction of --target_commit_seconds leave the batch
+# size as it is, so that it settles instead of following every slow commit
+ADAPTIVE_TOLERANCE = 0.1
+
+class _BatchSizer(object):
+    """
+    Adaptive batch sizes (--target_commit_seconds.) Each (node or link type,
+    property signature) starts at the --batch_size, and after each commit of
+    a full batch its size is scaled by the target commit time over the
+    measured one: at most doubled or halved per commit (so that one slow
+    commit does not throw it off) and kept between ADAPTIVE_MIN_BATCH_SIZE
+    and ADAPTIVE_MAX_BATCH_SIZE. Batches cut short by the end of a group of
+    objects are timed but not used to adapt, since the fixed cost of their
+    transaction would make them look slow.
+    """
+    def __init__(self, batch_size, target_seconds):
+        self.batch_size = batch_size
+        self.target_seconds = target_seconds
+        # (type, signature) -> [batch size, batches, objects, seconds]
+        self.sizes = {}
+        # committed from the --insert_workers and --pipeline threads
+        self.lock = threading.Lock()
+
+    def size(self, obj_type, sig):
+        with self.lock:
+            if (obj_type, sig) in self.sizes:
+                return self.sizes[(obj_type, sig)][0]
+            return self.batch_size
+
+    def record(self, obj_type, sig, n_objs, elapsed):
+        with self.lock:
+            if (obj_type, sig) not in self.sizes:
+                self.sizes[(obj_type, sig)] = [self.batch_size, 0, 0, 0.0]
+            stats = self.sizes[(obj_type, sig)]
+            stats[1] += 1
+            stats[2] += n_objs
+            stats[3] += elapsed
+            if n_objs < stats[0] or abs(elapsed - self.target_seconds) <= self.target_seconds * ADAPTIVE_TOLERANCE:
+                return
+            scale = min(max(self.target_seconds / max(elapsed, 0.001), 0.5), 2.0)
+            stats[0] = min(max(int(n_objs * scale), ADAPTIVE_MIN_BATCH_SIZE), ADAPTIVE_MAX_BATCH_SIZE)
+
+    # Log the batch size that each property signature of obj_type settled on,
+    # largest first. Signatures that fit in a single batch are only counted.
+    def print_sizes(self, obj_type):
+        keys = [k for k in self.sizes if k[0] == obj_type]
+        n_single = 0
+        for key in sorted(keys, key=lambda k: (-self.sizes[k][2], k)):
+            size, n_batches, n_objs, elapsed = self.sizes[key]
+            if n_batches == 1 and size == self.batch_size:
+                n_single += 1
+                continue
+            n_props = len(key[1].split('||')) if key[1] else 0
+            _print_error("  {0} with {1} properties: batch size {2} after {3} batch(es), {4:.3f} second(s)/batch, {5:.0f}/s".format(obj_type, n_props, size, n_batches, elapsed / n_batches, n_objs / max(elapsed, 0.001)))
+        if n_single > 0:
+            _print_error("  {0}: {1} other property signature(s) committed in a single batch".format(obj_type, n_single))
+
+# Commit one batch of driver objects in a transaction of its own and return how
+# long it took, which --target_commit_seconds uses to size the next batch of
+# the same obj_type and property signature. Batches from _cypher_batches
+# (those with a start offset) are recorded in the --journal_dir as pending
+# before the commit and as committed after it, and the internal ids returned
+# by node inserts are kept for --link_by_internal_id (experimental: reading
+# the ids before the commit has only been run against a stand-in graph.)
+def _commit_batch(cy, ins_cypher, o_slice, obj_type, sig, part=0, start=None):
+    if JOURNAL is not None and start is not None:
+        JOURNAL.record(obj_type, part, sig, start, len(o_slice), True)
+    b_stime = time.time()
+    tx = cy.begin()
+    result = tx.run(ins_cypher, { 'objects': o_slice })
+    node_ids = None
+    if INTERNAL_IDS is not None and obj_type in INTERNAL_IDS:
+        node_ids = [(record['key'], record['node_id']) for record in result]
+    tx.commit()
+    elapsed = time.time() - b_stime
+    if node_ids is not None:
+        INTERNAL_IDS[obj_type].update(node_ids)
+    if BATCH_SIZER is not None:
+        BATCH_SIZER.record(obj_type, sig, len(o_slice), elapsed)
+    if JOURNAL is not None and start is not None:
+        JOURNAL.record(obj_type, part, sig, start, len(o_slice))
+    return elapsed
+
+# Group the objects in obj_list by property signature and yield the Cypher
+# query, property signature, offset (in the objects with that signature) and
+# driver objects of each batch of (at most) args.batch_size of them, or of the
+# size BATCH_SIZER has settled on for obj_type and the signature so far.
+# Objects that the JOURNAL records as committed (under obj_type and the
+# --insert_workers partition part) are skipped, and the batches it records as
+# pending are yielded as they were, so that MERGE matches whatever of them the
+# previous run did commit.
+def _cypher_batches(insert_cypher, obj_list, obj_type, part=0):
     sig_to_objs = {}
 
     # case 1: there are properties associated with the new nodes or links, 
     # indicated by the presence of "<PROPS>" in the cypher query
     if re.search(r'<PROPS>', insert_cypher):
         for obj in obj_list:
-            props = obj['_props']
-            sig = _get_properties_sig(props)
-            _add_to_group(sig_to_objs, obj, sig)
+            _add_to_group(sig_to_objs, obj, obj['_props'].sig)
     
     # case 2: there are no properties associated with the new nodes or links
     else:
@@ -1096,53 +2648,743 @@ def _do_cypher_insert(cy, insert_cypher, obj_list, obj_type):
         n_objs = len(o_list)
 
         # create cypher query by substituting in the actual property list
-        props_cypher = ", ".join(["`" + p + "`: o.`" + p + "`" for p in sig.split("||")])
-        ins_cypher = re.sub(r'<PROPS>', props_cypher, insert_cypher)
-
-        # create list of dicts to pass to Neo4J driver
-        # note that creating a new list is significantly faster than trying to reuse
-        # the existing one due to the overhead of the existing _props list.
-        new_o_list = []
-        for obj in o_list:
-            new_obj = {}
-            for k in obj:
-                if k == '_props':
-                    for p in obj['_props']:
-                        new_obj[p['key']] = p['value']
-                else:
-                    new_obj[k] = obj[k]
-            new_o_list.append(new_obj)
-
-        # do batched inserts with batch size = args.batch_size
-        for start in range(0, n_objs, args.batch_size):
-            b_stime = time.time()
-            stop = start + args.batch_size
-            if stop > n_objs:
-                stop = n_objs
-            tx = cy.begin()
-            o_slice = new_o_list[start:stop]
-            tx.run(ins_cypher, { 'objects': o_slice })
-            tx.commit()
-            b_etime = time.time()
+        ins_cypher = _props_cypher(insert_cypher, sig)
+
+        new_o_list = _driver_objects(o_list)
+
+        # (start, end, pending) offsets journaled by a previous run
+        journaled = []
+        if JOURNAL is not None:
+            journaled = JOURNAL.journaled_ranges(obj_type, part, sig)
+
+        # batches of size args.batch_size (or BATCH_SIZER's)
+        start = 0
+        i = 0
+        while start < n_objs:
+            while i < len(journaled) and journaled[i][0] <= start:
+                j_start, j_end, pending = journaled[i]
+                if pending and j_end > start:
+                    yield ins_cypher, sig, start, new_o_list[start:j_end]
+                start = max(start, j_end)
+                i += 1
+            if start >= n_objs:
+                break
+            size = args.batch_size if BATCH_SIZER is None else BATCH_SIZER.size(obj_type, sig)
+            end = min(start + size, n_objs)
+            if i < len(journaled):
+                end = min(end, journaled[i][0])
+            yield ins_cypher, sig, start, new_o_list[start:end]
+            start = end
+
+class _SharedBatches(object):
+    """
+    The batches of one _cypher_batches generator, taken one at a time by
+    several --insert_workers threads.
+    """
+    def __init__(self, batches):
+        self.batches = batches
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.lock:
+            return next(self.batches)
+
+    next = __next__
+
+# Split links into (at most) n_workers lists such that no node is an endpoint
+# of links in two of them, so that concurrent transactions never lock the same
+# nodes: links are grouped into connected components by their endpoint ids
+# (the fields named by link_ends), and the components are handed out, largest
+# first, to the worker with the fewest links so far.
+#
+# The ends in shared_ends are left out of the components. A tag is linked to
+# files all over the graph, so with the tag end in them nearly all file-tag
+# links fall into one component and the stage gets a single worker. Instead
+# they are split by file alone, and each list is sorted by its shared ends,
+# so that every transaction locks the shared nodes in the same order and two
+# workers can wait on each other's tag but never deadlock. The tag nodes
+# themselves are MERGEd once each, by the tag node stage before any link.
+def _partition_links(links, link_ends, n_workers, shared_ends=()):
+    parent = {}
+    link_ends = [field for field in link_ends if field not in shared_ends]
+
+    def find(end):
+        root = end
+        while parent[root] != root:
+            root = parent[root]
+        while parent[end] != root:
+            parent[end], end = root, parent[end]
+        return root
+
+    for link in links:
+        roots = []
+        for field in link_ends:
+            end = (field, link[field])
+            if end not in parent:
+                parent[end] = end
+            roots.append(find(end))
+        for root in roots[1:]:
+            parent[root] = roots[0]
+
+    components = {}
+    for link in links:
+        _add_to_group(components, link, find((link_ends[0], link[link_ends[0]])))
+
+    partitions = [[] for i in range(0, n_workers)]
+    loads = [(0, i) for i in range(0, n_workers)]
+    for component in sorted(components.values(), key=len, reverse=True):
+        load, i = heapq.heappop(loads)
+        partitions[i].extend(component)
+        heapq.heappush(loads, (load + len(component), i))
+    if shared_ends:
+        for partition in partitions:
+            partition.sort(key=lambda link: tuple(link[field] for field in shared_ends))
+    return [p for p in partitions if p]
+
+# A Graph of its own for an --insert_workers thread, rather than sharing cy
+# (and its connection) with the other threads.
+def _worker_graph(cy):
+    if NEO4J_SETTINGS is None:
+        return cy
+    return Graph(**NEO4J_SETTINGS)
+
+# Commit the batches of each of worker_batches (an iterable of the batches
+# yielded by _cypher_batches per worker, and the partition they belong to) in
+# a thread of its own, each with a Graph and transactions of its own, and
+# report the throughput of each worker.
+def _commit_in_parallel(cy, worker_batches, obj_type):
+    # worker -> [objects, batches, seconds]
+    stats = [[0, 0, 0.0] for batches in worker_batches]
+    errors = []
+
+    def commit_batches(i):
+        try:
+            worker_cy = _worker_graph(cy)
+            batches, part = worker_batches[i]
+            for ins_cypher, sig, start, o_slice in batches:
+                elapsed = _commit_batch(worker_cy, ins_cypher, o_slice, obj_type, sig, part, start)
+                stats[i][0] += len(o_slice)
+                stats[i][1] += 1
+                stats[i][2] += elapsed
+        except BaseException as e:
+            errors.append(repr(e))
+
+    workers = []
+    for i in range(0, len(worker_batches)):
+        worker = threading.Thread(target=commit_batches, args=(i,))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+
+    if errors:
+        _print_error("Error inserting into Neo4j: " + errors[0])
+        sys.exit(1)
+    for i in range(0, len(stats)):
+        n_objs, n_batches, elapsed = stats[i]
+        _print_error("  insert worker {0}: {1} {2} in {3} batch(es), {4:.2f} second(s), {5:.0f}/s".format(i, n_objs, obj_type, n_batches, elapsed, n_objs / max(elapsed, 0.001)))
+
+# Generic Cypher insert function that makes use of UNWIND to perform fast
+# batch inserts (with batch size set by args.batch_size, or adapted toward
+# --target_commit_seconds.) 
+#
+# cy - Cypher Graph
+# insert_cypher - Cypher UNWIND query to insert data. It may contain the string "<PROPS>".
+# obj_list - List of objects (nodes or links/edges) to insert. This is a list of dicts 
+#   that defines the attributes/fields referenced in insert_cypher. If insert_cypher 
+#   contains the string "<PROPS>" then each dict must have a '_props' field mapping to
+#   a _PropRecord.
+# obj_type - Type of object ('node' or 'link') to be inserted. Used only to print a 
+#   status message.
+# link_ends - For links, the fields of each link that hold the ids of the nodes it
+#   connects. Used to partition the links between --insert_workers.
+# shared_ends - The link_ends that are left out of the partitioning (see
+#   _partition_links.)
+#
+# When the insert_cypher contains the string "<PARAMS>" the function will 
+# substitute in the actual parameter list based on the '_params' defined by
+# each object in obj_list. Note that the objects need not all define the 
+# same '_params': the fuction automatically groups the objects so that those
+# with the same parameter signature are inserted together (allowing the use 
+# of a single Cypher query for each such group of objects.) This significantly
+# improves the speed at which inserts can be processed.
+#
+def _do_cypher_insert(cy, insert_cypher, obj_list, obj_type, link_ends=None, shared_ends=()):
+    stime = time.time()
+    if JOURNAL is not None and JOURNAL.n_committed(obj_type) > 0:
+        _print_error("skipping {0} {1} committed by the previous run".format(JOURNAL.n_committed(obj_type), obj_type))
+    if JOURNAL is not None and JOURNAL.n_pending(obj_type) > 0:
+        _print_error("merging {0} {1} that the previous run may have committed".format(JOURNAL.n_pending(obj_type), obj_type))
+
+    # with --insert_workers, batches are committed concurrently
+    if args.insert_workers > 1:
+        if link_ends is None:
+            # node ids are unique (see _build_constraint_index), so node batches never conflict
+            batches = _SharedBatches(_cypher_batches(insert_cypher, obj_list, obj_type, 0))
+            worker_batches = [(batches, 0)] * args.insert_workers
+        else:
+            # the partitions only depend on the links and --insert_workers, both kept by --journal_dir
+            partitions = _partition_links(obj_list, link_ends, args.insert_workers, shared_ends)
+            worker_batches = [(_cypher_batches(insert_cypher, partitions[i], obj_type, i), i) for i in range(0, len(partitions))]
+        _commit_in_parallel(cy, worker_batches, obj_type)
+
+    else:
+        for ins_cypher, sig, start, o_slice in _cypher_batches(insert_cypher, obj_list, obj_type, 0):
+            elapsed = _commit_batch(cy, ins_cypher, o_slice, obj_type, sig, 0, start)
 # uncomment for batch-level timing info:
-#            _print_error("commit() done, insert took {0:.02f} second(s)".format(b_etime - b_stime))
+#            _print_error("commit() done, insert took {0:.02f} second(s)".format(elapsed))
 
     etime = time.time()
     _print_error("inserted {0} {1} in {2:.2f} second(s)".format(len(obj_list), obj_type, etime-stime))
+    if BATCH_SIZER is not None:
+        BATCH_SIZER.print_sizes(obj_type)
+
+# Cypher query to insert nodes of type node_type with properties (returning
+# the key and internal id of each node for --link_by_internal_id.)
+def _node_insert_cypher(node_type):
+    cypher = "UNWIND $objects as o MERGE (n:" + node_type + "{ <PROPS> })"
+    if INTERNAL_IDS is not None:
+        cypher += " RETURN o.`" + NODE_KEYS[node_type] + "` AS key, id(n) AS node_id"
+    return cypher
+
+# Cypher query to insert links of type link_type.
+def _link_insert_cypher(link_type):
+    by_id = 'by_id_' if INTERNAL_IDS is not None else ''
+    return NODE_LINKS[link_type][by_id + 'cypher']
+
+# Add the internal ids of the node_type nodes with the given keys to
+# INTERNAL_IDS, looking them up in batches of args.batch_size. Keys with no
+# node get None.
+def _lookup_internal_ids(cy, node_type, keys):
+    stime = time.time()
+    node_ids = INTERNAL_IDS[node_type + " nodes"]
+    cypher = "UNWIND $keys as k MATCH (n:" + node_type + "{`" + NODE_KEYS[node_type] + "`: k}) RETURN k AS key, id(n) AS node_id"
+    for start in range(0, len(keys), args.batch_size):
+        k_slice = keys[start:start + args.batch_size]
+        for key in k_slice:
+            node_ids[key] = None
+        for record in cy.run(cypher, { 'keys': k_slice }):
+            node_ids[record['key']] = record['node_id']
+    _print_error("looked up the internal ids of {0} {1} nodes in {2:.2f} second(s)".format(len(keys), node_type, time.time() - stime))
+
+# Return copies of the links in l_list (of type link_type) with the node keys
+# in their ends replaced by the internal ids of the nodes (--link_by_internal_id.)
+# The ids of nodes that no insert of this run returned, such as those committed
+# before a --resume, are looked up first. Links to nodes that do not exist get
+# a null id, which, like their key, matches no node; so the links keep their
+# offsets in the --journal_dir.
+def _links_by_internal_id(cy, link_type, l_list):
+    ends = list(zip(NODE_LINKS[link_type]['ends'], NODE_LINKS[link_type]['end_types']))
+    for field, node_type in ends:
+        node_ids = INTERNAL_IDS[node_type + " nodes"]
+        missing = set(link[field] for link in l_list if link[field] not in node_ids)
+        if missing:
+            _lookup_internal_ids(cy, node_type, sorted(missing))
+
+    new_l_list = []
+    for link in l_list:
+        new_link = dict(link)
+        for field, node_type in ends:
+            new_link[field] = INTERNAL_IDS[node_type + " nodes"][link[field]]
+        new_l_list.append(new_link)
+    return new_l_list
 
 # Use generic Cypher insert function to insert new nodes with properties.
 def _insert_nodes(cy, node_type):
-    insert_cypher =  "UNWIND $objects as o MERGE (n:" + node_type + "{ <PROPS> })"
+    insert_cypher = _node_insert_cypher(node_type)
     node_list = NODES[node_type]
     _do_cypher_insert(cy, insert_cypher, node_list, node_type + " nodes")
 
 # Use generic Cypher insert function to insert new links/edges, either with or without properties.
 def _insert_links(cy, link_type):
     links = NODE_LINKS[link_type]
-    l_cypher = links['cypher']
+    l_cypher = _link_insert_cypher(link_type)
     l_list = links['links']
-    _do_cypher_insert(cy, l_cypher, l_list, link_type + " links")
-    
+    if INTERNAL_IDS is not None:
+        l_list = _links_by_internal_id(cy, link_type, l_list)
+    _do_cypher_insert(cy, l_cypher, l_list, link_type + " links", links['ends'], links.get('shared_ends', ()))
+
+# order in which the node and link types are inserted (this order appears to
+# yield the best performance)
+NODE_INSERT_ORDER = ['subject', 'sample', 'file', 'tag']
+LINK_INSERT_ORDER = ['file-tag', 'subject-sample', 'sample-file']
+
+# maximum number of batches waiting for the --pipeline committer thread
+PIPELINE_QUEUE_SIZE = 4
+
+# number of File nodes generated between collections of the new nodes and
+# links by the --pipeline
+PIPELINE_COLLECT_FILES = 100
+
+class _InsertPipeline(object):
+    """
+    Commits the nodes and links to Neo4j while they are still being
+    generated (--pipeline.) collect() moves what _generate_cypher has added
+    to NODES and NODE_LINKS into a buffer per node/link type and property
+    signature, and queues each buffer as a batch once it holds batch_size
+    objects (or the size BATCH_SIZER has settled on.) A committer thread runs the batches in the order they were
+    queued. All node buffers are flushed before a batch of links is queued,
+    so the nodes that links connect are always committed before the links.
+    The queue holds at most queue_size batches: generation blocks while
+    Neo4j falls behind, which bounds memory. (Only the ids in NODE_IDS,
+    UNIQUE_LINKS and TAGS, used to skip duplicates, are kept for the whole
+    run.)
+    """
+    def __init__(self, cy, batch_size, queue_size):
+        self.cy = cy
+        self.batch_size = batch_size
+        self.batches = queue.Queue(maxsize=queue_size)
+        # node/link type -> property signature -> objects
+        self.buffers = dict((t, {}) for t in NODE_INSERT_ORDER + LINK_INSERT_ORDER)
+        # node/link type -> objects collected
+        self.n_collected = dict((t, 0) for t in self.buffers)
+        # node/link type -> [objects committed, batches, seconds], kept by the committer
+        self.stats = dict((t, [0, 0, 0.0]) for t in self.buffers)
+        # node/link type -> the name _do_cypher_insert reports it under
+        self.stage_names = dict((t, t + (" links" if t in NODE_LINKS else " nodes")) for t in self.buffers)
+        self.wait_time = 0.0
+        self.error = None
+        # started with the first batch, after any --generate_workers processes are forked
+        self.thread = None
+
+    def collect(self):
+        for node_type in NODE_INSERT_ORDER:
+            self._add(node_type, NODES[node_type])
+            del NODES[node_type][:]
+        for link_type in LINK_INSERT_ORDER:
+            self._add(link_type, NODE_LINKS[link_type]['links'])
+            del NODE_LINKS[link_type]['links'][:]
+
+    def _add(self, obj_type, objs):
+        buffers = self.buffers[obj_type]
+        is_link = obj_type in NODE_LINKS
+        for obj in objs:
+            sig = obj['_props'].sig if '_props' in obj else ''
+            if sig in buffers:
+                buffers[sig].append(obj)
+            else:
+                buffers[sig] = [obj]
+            if len(buffers[sig]) >= self._batch_size(obj_type, sig):
+                if is_link:
+                    self._flush_nodes()
+                self._put(obj_type, sig, buffers.pop(sig))
+        self.n_collected[obj_type] += len(objs)
+
+    def _batch_size(self, obj_type, sig):
+        if BATCH_SIZER is None:
+            return self.batch_size
+        return BATCH_SIZER.size(self.stage_names[obj_type], sig)
+
+    def _flush(self, obj_type):
+        buffers = self.buffers[obj_type]
+        for sig in sorted(buffers):
+            self._put(obj_type, sig, buffers[sig])
+        buffers.clear()
+
+    def _flush_nodes(self):
+        for node_type in NODE_INSERT_ORDER:
+            self._flush(node_type)
+
+    def _put(self, obj_type, sig, objs):
+        self._check_error()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._commit_batches)
+            self.thread.daemon = True
+            self.thread.start()
+        if obj_type in NODE_LINKS:
+            cypher = _link_insert_cypher(obj_type)
+        else:
+            cypher = _node_insert_cypher(obj_type)
+        if '<PROPS>' in cypher:
+            cypher = _props_cypher(cypher, sig)
+        stime = time.time()
+        self.batches.put((obj_type, sig, cypher, objs))
+        self.wait_time += time.time() - stime
+
+    def _commit_batches(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                return
+            # after an error keep emptying the queue, so that generation doesn't block
+            if self.error is not None:
+                continue
+            obj_type, sig, cypher, objs = batch
+            try:
+                elapsed = _commit_batch(self.cy, cypher, _driver_objects(objs), self.stage_names[obj_type], sig)
+                stats = self.stats[obj_type]
+                stats[0] += len(objs)
+                stats[1] += 1
+                stats[2] += elapsed
+            except BaseException as e:
+                self.error = repr(e)
+
+    def _check_error(self):
+        if self.error is not None:
+            _print_error("Error inserting into Neo4j: " + self.error)
+            sys.exit(1)
+
+    # Queue what is left in the buffers and wait for all of it to be committed.
+    def finish(self):
+        self.collect()
+        self._flush_nodes()
+        for link_type in LINK_INSERT_ORDER:
+            self._flush(link_type)
+        if self.thread is not None:
+            self.batches.put(None)
+            self.thread.join()
+        self._check_error()
+        for obj_type in NODE_INSERT_ORDER + LINK_INSERT_ORDER:
+            n_objs, n_batches, elapsed = self.stats[obj_type]
+            kind = "links" if obj_type in NODE_LINKS else "nodes"
+            _print_error("inserted {0} {1} {2} in {3} batch(es), {4:.2f} second(s) of commits".format(n_objs, obj_type, kind, n_batches, elapsed))
+            if BATCH_SIZER is not None:
+                BATCH_SIZER.print_sizes(self.stage_names[obj_type])
+        _print_error("generation waited {0:.2f} second(s) for Neo4j commits".format(self.wait_time))
+
+# files kept in --journal_dir
+JOURNAL_SNAPSHOT_FILE = "graph.pickle.gz"
+JOURNAL_FILE = "journal.jsonl"
+
+class _CommitJournal(object):
+    """
+    Journal of the batches committed to Neo4j (--journal_dir), so that a
+    --resume run can skip them. Each batch is appended as a line of JSON
+    with its insert stage, the --insert_workers partition it belongs to, its
+    property signature, and its offset and length in the objects with that
+    signature (as _cypher_batches groups them): once as pending before its
+    transaction is committed, and again once the commit has returned. A
+    batch left pending may or may not have been committed (for instance if
+    the connection dropped before the commit was acknowledged), so --resume
+    inserts it again; the inserts MERGE, so the nodes and links it did
+    commit are matched rather than duplicated. The steps
+    after the inserts that must not be repeated are journaled by name.
+    """
+    def __init__(self, journal_dir, resume):
+        self.path = os.path.join(journal_dir, JOURNAL_FILE)
+        # (stage, partition, signature) -> sorted [(start, end)]
+        self.committed = {}
+        # (stage, partition, signature) -> sorted [(start, end)] of batches never journaled as committed
+        self.pending = {}
+        self.steps = set()
+        if resume and os.path.exists(self.path):
+            # the last line may have been cut short by the failure: cut it off,
+            # so that the entries appended by this run start on a line of their own
+            with open(self.path, 'rb+') as jfile:
+                data = jfile.read()
+                end = data.rfind(b'\n') + 1
+                if end < len(data):
+                    jfile.truncate(end)
+            pending = {}
+            for line in data[:end].decode('utf-8').splitlines():
+                entry = json.loads(line)
+                if 'step' in entry:
+                    self.steps.add(entry['step'])
+                elif entry.get('pending'):
+                    _add_to_group(pending, (entry['start'], entry['start'] + entry['count']), (entry['stage'], entry['part'], entry['sig']))
+                else:
+                    _add_to_group(self.committed, (entry['start'], entry['start'] + entry['count']), (entry['stage'], entry['part'], entry['sig']))
+            for key in pending:
+                done = set(self.committed.get(key, []))
+                ranges = sorted(set(r for r in pending[key] if r not in done))
+                if ranges:
+                    self.pending[key] = ranges
+            for ranges in self.committed.values():
+                ranges.sort()
+        self.jfile = open(self.path, 'a' if resume else 'w')
+        # written from the --insert_workers threads
+        self.lock = threading.Lock()
+
+    # Sorted (start, end, pending) offsets of the journaled batches.
+    def journaled_ranges(self, stage, part, sig):
+        key = (stage, part, sig)
+        ranges = [(start, end, False) for start, end in self.committed.get(key, [])]
+        ranges.extend((start, end, True) for start, end in self.pending.get(key, []))
+        return sorted(ranges)
+
+    def n_committed(self, stage):
+        return self._count(self.committed, stage)
+
+    def n_pending(self, stage):
+        return self._count(self.pending, stage)
+
+    def _count(self, ranges, stage):
+        n_objs = 0
+        for key in ranges:
+            if key[0] == stage:
+                n_objs += sum(end - start for start, end in ranges[key])
+        return n_objs
+
+    def step_done(self, step):
+        return step in self.steps
+
+    def record(self, stage, part, sig, start, count, pending=False):
+        entry = { 'stage': stage, 'part': part, 'sig': sig, 'start': start, 'count': count }
+        if pending:
+            entry['pending'] = True
+        self._write(entry)
+
+    def record_step(self, step):
+        self._write({ 'step': step })
+
+    def _write(self, entry):
+        with self.lock:
+            self.jfile.write(json.dumps(entry, sort_keys=True) + "\n")
+            self.jfile.flush()
+            os.fsync(self.jfile.fileno())
+
+# Save the generated nodes and links, and the options that decide how they are
+# split into batches and inserted, to journal_dir and start a new journal.
+# The old snapshot is removed first, so that an interrupted save never leaves
+# a snapshot with the journal of another one.
+def _save_graph_snapshot(journal_dir):
+    stime = time.time()
+    if not os.path.exists(journal_dir):
+        os.makedirs(journal_dir)
+
+    snapshot_path = os.path.join(journal_dir, JOURNAL_SNAPSHOT_FILE)
+    if os.path.exists(snapshot_path):
+        os.remove(snapshot_path)
+    journal = _CommitJournal(journal_dir, False)
+    links = dict((link_type, NODE_LINKS[link_type]['links']) for link_type in NODE_LINKS)
+    with gzip.open(snapshot_path + ".tmp", 'wb') as sfile:
+        pickle.dump({'nodes': NODES, 'links': links, 'insert_workers': args.insert_workers}, sfile, pickle.HIGHEST_PROTOCOL)
+    os.rename(snapshot_path + ".tmp", snapshot_path)
+    _print_error("saved snapshot of the generated nodes and links in {0:.2f} second(s)".format(time.time() - stime))
+    return journal
+
+# Load the nodes and links saved by _save_graph_snapshot into NODES and
+# NODE_LINKS. Returns the snapshot, with the options it was generated with.
+def _load_graph_snapshot(journal_dir):
+    stime = time.time()
+    snapshot_path = os.path.join(journal_dir, JOURNAL_SNAPSHOT_FILE)
+    if not os.path.exists(snapshot_path):
+        _print_error("no snapshot to resume from in " + journal_dir)
+        sys.exit(1)
+
+    with gzip.open(snapshot_path, 'rb') as sfile:
+        snapshot = pickle.load(sfile)
+    for node_type in NODES:
+        NODES[node_type][:] = snapshot['nodes'][node_type]
+    for link_type in NODE_LINKS:
+        NODE_LINKS[link_type]['links'][:] = snapshot['links'][link_type]
+    _print_error("loaded snapshot of the generated nodes and links in {0:.2f} second(s)".format(time.time() - stime))
+    return snapshot
+
+# Insert the generated nodes and links, or wait for the --pipeline to finish
+# committing them.
+def _insert_graph(cy, pipeline=None):
+    if pipeline is not None:
+        # wait for the remaining nodes and links to be committed
+        pipeline.finish()
+        return
+
+    # insert nodes (in NODE_INSERT_ORDER):
+    _insert_nodes(cy, 'subject')
+    _insert_nodes(cy, 'sample')
+    _insert_nodes(cy, 'file')
+    _insert_nodes(cy, 'tag')
+
+    neo4j_ver = ".".join([str(x) for x in cy.database.kernel_version])
+    # 3.4.5-specific workaround
+    if neo4j_ver == "3.4.5":
+        # these theoretically superfluous index statements appear to be critical 
+        # for fast loading in 3.4.5 but slow down loading in 3.4.10:
+        _build_all_indexes('file',cy)
+        _build_constraint_index('tag','term',cy)
+
+    # insert tag links
+    _insert_links(cy, 'file-tag')
+    # insert subject-sample links
+    _insert_links(cy, 'subject-sample')
+    # insert sample-file links
+    _insert_links(cy, 'sample-file')
+
+# Run one of the steps of _update_graph, unless the JOURNAL records it as done
+# by the run being resumed.
+def _journaled_step(step, cy, cypher_list):
+    if JOURNAL is not None and JOURNAL.step_done(step):
+        _print_error("skipping {0} update, done by the previous run".format(step))
+        return
+    stime = time.time()
+    for cypher in cypher_list:
+        cy.run(cypher)
+    if JOURNAL is not None:
+        JOURNAL.record_step(step)
+    _print_error("updated {0} in {1:.2f} second(s)".format(step, time.time() - stime))
+
+# Rewrite some of the inserted values for the portal and index the subject and
+# sample properties.
+def _update_graph(cy):
+    # Here set some better syntax for the portal and override the original OSDF values
+    _journaled_step("study full names", cy, ['MATCH (n:sample) SET n.study_full_name=n.study_name'])
+    _journaled_step("study names", cy, ['MATCH (n:sample) WHERE n.study_name="{0}" SET n.study_name="{1}"'.format(old,new) for old, new in study_name_dict.items()])
+    _journaled_step("project name", cy, ["MATCH (PSS:subject) WHERE PSS.project_name = 'iHMP' SET PSS.project_name = 'Integrative Human Microbiome Project'"])
+
+    # Now build indexes on each unique property found in this newest data set
+    _build_all_indexes('subject',cy)
+    _build_all_indexes('sample',cy)
+
+# link type -> relationship type, and the link fields that hold the ids of
+# the start and end nodes of the relationship, with their node types
+CSV_LINK_TYPES = {
+    'subject-sample': ('extracted_from', ('sample_id', 'sample'), ('subject_id', 'subject')),
+    'file-tag': ('has_tag', ('file_id', 'file'), ('term', 'tag')),
+    'sample-file': ('derived_from', ('file_id', 'file'), ('sample_id', 'sample')),
+    }
+
+# Python type of a property value -> neo4j-admin import type (default string)
+CSV_TYPES = { bool: 'boolean', int: 'long', float: 'double' }
+
+# neo4j-admin import representation of a property value (the csv module
+# writes everything else as str() does)
+def _csv_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return value
+
+# The properties of a node as loaded, with the rewrites that a Cypher load
+# applies after inserting (see the end of __main__) already made.
+def _csv_node_props(node_type, props):
+    if node_type == 'sample' and 'study_name' in props:
+        props = dict(props)
+        props['study_full_name'] = props['study_name']
+        for old, new in study_name_dict.items():
+            if props['study_name'] == old:
+                props['study_name'] = new
+    elif node_type == 'subject' and props.get('project_name') == 'iHMP':
+        props = dict(props)
+        props['project_name'] = 'Integrative Human Microbiome Project'
+    return props
+
+# Sort key for the (keys, types) groups of _ImportCSVWriter (types don't sort.)
+def _csv_group_order(group):
+    keys, types = group
+    return (keys, [CSV_TYPES.get(t, 'string') for t in types])
+
+class _ImportCSVWriter(object):
+    """
+    Writes nodes and relationships as neo4j-admin import CSV files (for
+    --csv_dir.) Each group of nodes or relationships with the same label or
+    type, properties and property types gets a header file, with the type of
+    each property, and a data file. import.args lists them as arguments to
+    neo4j-admin import (run from csv_dir, e.g. neo4j-admin import --f
+    import.args.)
+    """
+    def __init__(self, csv_dir):
+        self.csv_dir = csv_dir
+        if not os.path.isdir(csv_dir):
+            os.makedirs(csv_dir)
+        self.import_args = ["--multiline-fields=true"]
+
+    # Write rows (dicts of properties) that all have the properties in keys,
+    # of the types in types. id_columns maps a property key or link field to
+    # its neo4j-admin import column type, such as ID(sample) or START_ID(file).
+    def _write_group(self, arg, name, keys, types, rows, id_columns):
+        types = [CSV_TYPES.get(t, 'string') for t in types]
+        header = []
+        for key, value_type in zip(keys, types):
+            if key in id_columns:
+                if key.startswith(':'):
+                    header.append(id_columns[key])
+                else:
+                    header.append("{0}:{1}".format(key, id_columns[key]))
+            else:
+                header.append("{0}:{1}".format(key, value_type))
+        header_file = "{0}_header.csv".format(name)
+        data_file = "{0}.csv".format(name)
+        with open(os.path.join(self.csv_dir, header_file), 'w', newline='') as hfile:
+            csv.writer(hfile).writerow(header)
+        with open(os.path.join(self.csv_dir, data_file), 'w', newline='') as dfile:
+            writer = csv.writer(dfile)
+            if 'boolean' in types:
+                for row in rows:
+                    writer.writerow([_csv_value(row[key]) for key in keys])
+            else:
+                for row in rows:
+                    writer.writerow([row[key] for key in keys])
+        # the --option=value form neo4j-admin's own usage shows, unquoted: the
+        # file names hold no spaces, commas or quotes, so the --f file needs no
+        # quoting that neo4j-admin would have to strip
+        self.import_args.append("{0}={1},{2}".format(arg, header_file, data_file))
+
+    # Group dicts of properties by keys and (Python) property types.
+    @staticmethod
+    def _group(rows):
+        groups = {}
+        for row in rows:
+            keys = tuple(sorted(row))
+            types = tuple([type(row[key]) for key in keys])
+            _add_to_group(groups, row, (keys, types))
+        return groups
+
+    # Write the nodes of type node_type and return the property keys seen.
+    def write_nodes(self, node_type, nodes):
+        id_key = NODE_KEYS[node_type]
+        groups = self._group(_csv_node_props(node_type, node['_props']) for node in nodes)
+        all_keys = set()
+        for n, (keys, types) in enumerate(sorted(groups, key=_csv_group_order)):
+            self._write_group("--nodes:" + node_type, "{0}_{1}".format(node_type, n), keys, types, groups[(keys, types)],
+                              { id_key: "ID({0})".format(node_type) })
+            all_keys.update(keys)
+        _print_error("wrote {0} {1} nodes in {2} file(s)".format(len(nodes), node_type, len(groups)))
+        return all_keys
+
+    # Write the links of type link_type whose nodes are in node_ids (type -> ids.)
+    def write_links(self, link_type, links, node_ids):
+        rel_type, (start_field, start_type), (end_field, end_type) = CSV_LINK_TYPES[link_type]
+        rows = []
+        n_skipped = 0
+        for link in links:
+            if link[start_field] not in node_ids[start_type] or link[end_field] not in node_ids[end_type]:
+                # a Cypher load would not have matched both nodes either
+                n_skipped += 1
+                continue
+            row = dict(link.get('_props', ()))
+            row[':START_ID'] = link[start_field]
+            row[':END_ID'] = link[end_field]
+            rows.append(row)
+        groups = self._group(rows)
+        for n, (keys, types) in enumerate(sorted(groups, key=_csv_group_order)):
+            self._write_group("--relationships:" + rel_type, "{0}_{1}".format(rel_type, n), keys, types, groups[(keys, types)],
+                              { ':START_ID': ":START_ID({0})".format(start_type), ':END_ID': ":END_ID({0})".format(end_type) })
+        _print_error("wrote {0} {1} links in {2} file(s), skipped {3} without both nodes".format(len(rows), link_type, len(groups), n_skipped))
+
+    # Write import.args, and post_import.cypher with the constraints and
+    # indexes to create once the imported database is running.
+    def finish(self, index_keys):
+        with open(os.path.join(self.csv_dir, "import.args"), 'w') as afile:
+            afile.write("\n".join(self.import_args) + "\n")
+        with open(os.path.join(self.csv_dir, "post_import.cypher"), 'w') as cfile:
+            for node, prop in CONSTRAINT_INDEXES:
+                cfile.write("CREATE CONSTRAINT ON (x:{0}) ASSERT x.{1} IS UNIQUE;\n".format(node, prop))
+            for node in sorted(index_keys):
+                for prop in sorted(index_keys[node]):
+                    if prop != 'id':
+                        cfile.write("CREATE INDEX ON :{0}(`{1}`);\n".format(node, prop))
+
+# Write NODES and NODE_LINKS as neo4j-admin import CSV files in csv_dir.
+def _write_import_csvs(csv_dir):
+    stime = time.time()
+    writer = _ImportCSVWriter(csv_dir)
+    node_ids = {}
+    index_keys = {}
+    for node_type in NODE_INSERT_ORDER:
+        keys = writer.write_nodes(node_type, NODES[node_type])
+        id_key = NODE_KEYS[node_type]
+        node_ids[node_type] = set(node['_props'][id_key] for node in NODES[node_type] if id_key in node['_props'])
+        # as _build_all_indexes does after a Cypher load
+        if node_type in ['subject', 'sample']:
+            index_keys[node_type] = keys
+    for link_type in LINK_INSERT_ORDER:
+        writer.write_links(link_type, NODE_LINKS[link_type]['links'], node_ids)
+    writer.finish(index_keys)
+    _print_error("wrote neo4j-admin import files to {0} in {1:.2f} second(s)".format(csv_dir, time.time() - stime))
+
 if __name__ == '__main__':
 
     # Set up an ArgumentParser to read the command-line
@@ -1153,6 +3395,14 @@ if __name__ == '__main__':
         '--db', type=str,
         help="The CouchDB database URL from which to load data")
 
+    parser.add_argument(
+        '--from_dump', type=str, required=False,
+        help="Load from a CouchDB changes feed dump (one JSON row per line, optionally gzipped) instead of from --db. With --incremental_dir, --db should name the database the dump was taken from.")
+
+    parser.add_argument(
+        '--dump_workers', type=int, default=multiprocessing.cpu_count(),
+        help="How many processes to use to parse and clean the --from_dump file. A file of less than {0} MB is parsed in a single process.".format(DUMP_CHUNK_BYTES // 1048576))
+
     parser.add_argument(
         '--couchdb_login', type=str,
         help="The CouchDB login/username.")
@@ -1163,12 +3413,48 @@ if __name__ == '__main__':
 
     parser.add_argument(
         '--cache_dir', type=str, required=False,
-        help="Directory in which to cache/find pages downloaded from CouchDB (optional - used for testing).")
+        help="Directory in which to cache/find documents downloaded from CouchDB (optional - used for testing).")
 
     parser.add_argument(
         "--page_size", type=int, default=1000,
         help="How many documents to request from CouchDB in each batch.")
 
+    parser.add_argument(
+        "--fetch_workers", type=int, default=1,
+        help="How many CouchDB key ranges to page through concurrently (1 = serial retrieval.)")
+
+    parser.add_argument(
+        "--use_find", dest="use_find", action="store_true",
+        help="Request only the node types and document fields that are loaded, using a CouchDB (2.0 or later) _find query instead of _all_docs. Creating a CouchDB index on node_type speeds this up.")
+
+    parser.add_argument(
+        "--normalize_workers", type=int, default=1,
+        help="How many processes to use to normalize the documents retrieved from CouchDB, a page at a time (1 = normalize them inline.) Databases of fewer than {0} documents are always normalized inline. On the synthetic benchmark corpus, pickling the documents to and from the processes costs more than normalizing them inline.".format(NORMALIZE_POOL_MIN_DOCS))
+
+    parser.add_argument(
+        "--generate_workers", type=int, default=1,
+        help="How many processes to build the File node docs and their Neo4j nodes and links with, after all the documents have been read (1 = build them in the main process.)")
+
+    parser.add_argument(
+        "--http_retries", type=int, default=HTTP_RETRIES,
+        help="How many times to retry a CouchDB request after a timeout, connection error or 5xx response.")
+
+    parser.add_argument(
+        "--http_timeout", type=float, default=HTTP_TIMEOUT,
+        help="Timeout in seconds for each CouchDB request.")
+
+    parser.add_argument(
+        "--incremental_dir", type=str, required=False,
+        help="Directory in which to keep a checkpoint and the node store between runs. If a checkpoint is present only the documents changed since then are read (from the CouchDB _changes feed.)")
+
+    parser.add_argument(
+        "--node_store", type=str, required=False,
+        help="Keep the documents read from CouchDB, and the node type and lineage indexes built from them, in this (scratch) sqlite3 file instead of in memory, for databases too large to load into memory. Cannot be combined with --incremental_dir.")
+
+    parser.add_argument(
+        "--node_cache_size", type=int, default=NODE_CACHE_SIZE,
+        help="How many documents to cache in memory in front of the --node_store file, and how many flattened upstream nodes (samples, visits, subjects, studies, projects and preps) to keep cached while the File nodes are built.")
+
     parser.add_argument(
         "--neo4j_host", type=str, default="localhost",
         help="The Neo4j server hostname")
@@ -1189,27 +3475,105 @@ if __name__ == '__main__':
         "--batch_size", type=int, default=5000,
         help="The batch size for Cypher statements to be committed")
 
+    parser.add_argument(
+        "--target_commit_seconds", type=float, required=False,
+        help="Adapt the batch size of each node label and link type (and property signature) so that each commit takes about this many seconds, starting from --batch_size, and log the sizes they settle on. By default every batch holds --batch_size objects.")
+
+    parser.add_argument(
+        "--csv_dir", type=str, required=False,
+        help="Instead of loading into Neo4j, write the nodes and links to this directory as neo4j-admin import CSV files, with an import.args file of neo4j-admin import arguments and a post_import.cypher file of constraints and indexes to create afterwards. No Neo4j server is used.")
+
+    parser.add_argument(
+        "--insert_workers", type=int, default=1,
+        help="How many batches of nodes or links to commit concurrently, each on its own transaction (1 = one batch at a time.) Links are split so that no two workers link the same nodes. Does not apply to --pipeline.")
+
+    parser.add_argument(
+        "--pipeline", dest="pipeline", action="store_true",
+        help="Commit nodes and links to Neo4j from a separate thread while the rest are still being built, instead of building all of them first. The Neo4j 3.4.5 file index workaround is not applied.")
+
+    parser.add_argument(
+        "--link_by_internal_id", dest="link_by_internal_id", action="store_true",
+        help="EXPERIMENTAL, not yet run against a live Neo4j server: have the node inserts return the internal Neo4j id of each node, and find the nodes of each link by these ids instead of by an index lookup of their id properties. Off by default. Cannot be combined with --csv_dir or --pipeline.")
+
+    parser.add_argument(
+        "--journal_dir", type=str, required=False,
+        help="Directory in which to save a snapshot of the generated nodes and links before inserting them, and a journal of the batches committed to Neo4j, so that a failed insert can be continued with --resume. Cannot be combined with --csv_dir or --pipeline.")
+
+    parser.add_argument(
+        "--resume", dest="resume", action="store_true",
+        help="Continue the load journaled in --journal_dir: skip reading CouchDB and building the nodes and links, and commit only the batches that the journal does not record.")
+
+    parser.add_argument(
+        "--pipeline_queue_size", type=int, default=PIPELINE_QUEUE_SIZE,
+        help="How many batches of --batch_size nodes or links may wait to be committed before --pipeline pauses building them.")
+
     parser.add_argument(
         "--check_sample_file_uniqueness", dest="check_sample_file_uniqueness", action="store_true",
-        help="Check sample-file links for uniqueness. Slower because the properties must be checked.")
+        help="Check sample-file links for uniqueness (by a digest of their properties) and report how many duplicates were found.")
 
     parser.add_argument(
         "--dump_problem_docs", dest="dump_problem_docs", action="store_true",
         help="Whether to dump/log problematic documents (e.g., those with no upstream SRA SRSxxxxx sample id, missing prep, or unexpected upstream node type.)")
 
     args = parser.parse_args()
+    if args.incremental_dir is not None and args.db is None:
+        _print_error("--incremental_dir requires --db (with --from_dump, the database the dump was taken from)")
+        sys.exit(1)
+    if args.node_store is not None and args.incremental_dir is not None:
+        _print_error("--node_store cannot be combined with --incremental_dir")
+        sys.exit(1)
+    if args.csv_dir is not None and args.pipeline:
+        _print_error("--csv_dir cannot be combined with --pipeline")
+        sys.exit(1)
+    if args.journal_dir is not None and (args.csv_dir is not None or args.pipeline):
+        _print_error("--journal_dir cannot be combined with --csv_dir or --pipeline")
+        sys.exit(1)
+    if args.link_by_internal_id and (args.csv_dir is not None or args.pipeline):
+        _print_error("--link_by_internal_id cannot be combined with --csv_dir or --pipeline")
+        sys.exit(1)
+    if args.resume and args.journal_dir is None:
+        _print_error("--resume requires --journal_dir")
+        sys.exit(1)
+    if args.target_commit_seconds is not None and args.target_commit_seconds <= 0:
+        _print_error("--target_commit_seconds must be greater than 0")
+        sys.exit(1)
     DUMP_PROBLEM_DOCS = args.dump_problem_docs
-
-    cy = Graph(host = args.neo4j_host, password = args.neo4j_password, bolt_port = args.bolt_port, http_port = args.http_port) 
-
-    _build_constraint_index('subject','id',cy)
-    _build_constraint_index('sample','id',cy)
-    _build_constraint_index('file','id',cy)
-    _build_constraint_index('token','id',cy)
-    _build_constraint_index('tag','term',cy)
-    _build_constraint_index('user','username',cy)
-    _build_constraint_index('session','id',cy)
-    _build_constraint_index('query','url',cy)
+    TRAVERSE_CACHE_SIZE = args.node_cache_size
+    CSV_IMPORT = args.csv_dir is not None
+    if args.link_by_internal_id:
+        _print_error("warning: --link_by_internal_id is experimental and has not been run against a live Neo4j server")
+        INTERNAL_IDS = dict((node_type + " nodes", {}) for node_type in NODE_INSERT_ORDER)
+    if args.target_commit_seconds is not None:
+        BATCH_SIZER = _BatchSizer(args.batch_size, args.target_commit_seconds)
+    HTTP_RETRIES = args.http_retries
+    HTTP_TIMEOUT = args.http_timeout
+    HTTP_POOL_SIZE = max(args.fetch_workers, 1)
+
+    # --resume inserts the nodes and links of the journaled run the way it would have
+    snapshot = None
+    if args.resume:
+        snapshot = _load_graph_snapshot(args.journal_dir)
+        if args.insert_workers != snapshot['insert_workers']:
+            _print_error("resuming with --insert_workers {0}, as the journaled run".format(snapshot['insert_workers']))
+            args.insert_workers = snapshot['insert_workers']
+
+    # with --csv_dir the constraints are in post_import.cypher instead
+    cy = None
+    if args.csv_dir is None:
+        NEO4J_SETTINGS = { 'host': args.neo4j_host, 'password': args.neo4j_password, 'bolt_port': args.bolt_port, 'http_port': args.http_port }
+        cy = Graph(**NEO4J_SETTINGS)
+
+        for node, prop in CONSTRAINT_INDEXES:
+            _build_constraint_index(node,prop,cy)
+
+    # skip the fetch and generation, and the batches and steps journaled as done
+    if snapshot is not None:
+        start_time = time.time()
+        JOURNAL = _CommitJournal(args.journal_dir, True)
+        _insert_graph(cy)
+        _update_graph(cy)
+        _print_error("Done! resumed load in {0} seconds!\n".format(time.time() - start_time))
+        sys.exit(0)
 
     # Now just loop through and create documents. I like counters, so there's
     # one to tell me how much has been done. I also like timers, so there's one
@@ -1219,149 +3583,74 @@ if __name__ == '__main__':
 
     # Dictionaries for each nodes where it goes like {project{id{couch_db_doc}}} so that
     # it is fast to look up IDs when traversing upstream.
-    nodes = {
-        'project': {},
-        'study': {},
-        'subject': {},
-        'subject_attribute': {},
-        'visit': {},
-        'visit_attribute': {},
-        'sample': {},
-        'sample_attribute': {},
-        'wgs_dna_prep': {},
-        'host_seq_prep': {},
-        'wgs_raw_seq_set': {},
-        'wgs_raw_seq_set_private': {},
-        'host_wgs_raw_seq_set': {},
-        'microb_transcriptomics_raw_seq_set': {},
-        'host_transcriptomics_raw_seq_set': {},
-        'wgs_assembled_seq_set': {},
-        'viral_seq_set': {},
-        'annotation': {},
-        'clustered_seq_set': {},
-        '16s_dna_prep': {},
-        '16s_raw_seq_set': {},
-        '16s_trimmed_seq_set': {},
-        'microb_assay_prep': {},
-        'host_assay_prep': {},
-        'proteome': {},
-        'metabolome': {},
-        'lipidome': {},
-        'cytokine': {},
-        'abundance_matrix': {},
-
-        # new node types added 10/22/2018
-        'reference_genome_project_catalog_entry' : {},
-        'host_epigenetics_raw_seq_set' : {},
-        'serology' : {},
-        'metagenomic_project_catalog_entry' : {},
-        'alignment' : {},
-        'proteome_nonpride': {},
-        'host_variant_call': {}
-    }
+    nodes = dict((node_type, {}) for node_type in NODE_TYPES)
+
+    # optionally keep the nodes on disk instead
+    node_store = None
+    if args.node_store is not None:
+        node_store = _DiskNodeStore(args.node_store, args.node_cache_size)
+        nodes = dict((node_type, node_store.table(node_type)) for node_type in nodes)
+        # and so are the indexes over all of them
+        NODE_TYPE_INDEX = node_store.table(NODE_TYPE_INDEX_TABLE)
+        LINEAGE = node_store.table(LINEAGE_TABLE)
 
     # count skipped nodes and print a summary at the end
     node_skip_counts = {}
 
-    for doc in _all_docs_by_page(args.db, args.couchdb_login, args.couchdb_password, args.cache_dir, args.page_size):
-        # Assume we don't want design documents, since they're likely to be
-        # already stored elsewhere (e.g. in version control)
-        if doc['id'].startswith("_design"):
-            continue
-        elif doc['id'].endswith("_hist"):
+    # document id -> (node type, key in nodes), kept for incremental updates
+    doc_keys = None
+    changes_state = None
+    doc_source = None
+    docs_cleaned = False
+
+    if args.from_dump is not None:
+        # a dump is always loaded in full, but it can start a new incremental checkpoint
+        changes_state = { 'last_seq': None }
+        doc_source = _docs_from_dump(args.from_dump, args.dump_workers, changes_state)
+        docs_cleaned = True
+        # a dump may hold several revisions of a document, and its deletion
+        doc_keys = {}
+
+    elif args.incremental_dir is not None:
+        since = _load_checkpoint(args.incremental_dir, args.db)
+        if since is not None:
+            stored_nodes, doc_keys = _load_node_store(args.incremental_dir)
+            for node_type in stored_nodes:
+                if node_type in nodes:
+                    nodes[node_type] = stored_nodes[node_type]
+            _index_node_types(nodes)
+            changes_state = {}
+            doc_source = _changes_since(args.db, args.couchdb_login, args.couchdb_password, since, args.page_size, changes_state)
+            _print_error("reading changes since update sequence {0}".format(since))
+        else:
+            doc_keys = {}
+            # set by _all_docs_by_page, from the cache if one is read
+            changes_state = {}
+
+    if doc_source is None:
+        find_node_types = None
+        if args.use_find:
+            # the node types that are loaded, as stored in CouchDB (attribute nodes may still use the old '_attr' suffix)
+            find_node_types = sorted(list(nodes.keys()) + [t[:-len("ibute")] for t in nodes if t.endswith("_attribute")])
+        doc_source = _all_docs_by_page(args.db, args.couchdb_login, args.couchdb_password, args.cache_dir, args.page_size, args.fetch_workers, find_node_types, changes_state)
+
+    if not docs_cleaned and args.normalize_workers > 1:
+        doc_source = _normalize_in_pool(doc_source, args.normalize_workers, args.page_size)
+        docs_cleaned = True
+
+    for doc in doc_source:
+        # only the _changes feed (or a dump of it) reports deletions
+        if doc.get('deleted'):
+            if doc_keys is not None:
+                _remove_doc_from_nodes(nodes, doc['id'], doc_keys)
             continue
 
-        # Clean up the document a bit. We don't need everything stored in
-        # CouchDB for this instance.
-        if 'value' in doc:
-            del doc['value']
-        if 'key' in doc:
-            del doc['key']
-        if '_id' in doc['doc']:
-            del doc['doc']['_id']
-        if '_rev' in doc['doc']:
-            del doc['doc']['_rev']
-        if 'acl' in doc['doc']:
-            del doc['doc']['acl']
-        if 'ns' in doc['doc']:
-            del doc['doc']['ns']
-        if 'subset_of' in doc['doc']['linkage']:
-            del doc['doc']['linkage']['subset_of']
-
-        # Clean up all these empty values
-        doc['doc'] = _delete_keys_from_dict(doc['doc'])
-        if 'meta' in doc['doc']:
-
-            # Private nodes should have some mock URL data in them
-            if 'urls' in doc['doc']['meta']:
-                if len(doc['doc']['meta']['urls'])==1 and doc['doc']['meta']['urls'][0]== "":
-                    doc['doc']['meta']['urls'][0] = 'Private:Private Data ({0})'.format(doc['id'])
-
-            doc['doc']['meta'] = _delete_keys_from_dict(doc['doc']['meta'])
-
-            if 'mixs' in doc['doc']['meta']:
-                doc['doc']['meta']['mixs'] = _delete_keys_from_dict(doc['doc']['meta']['mixs'])
-
-            if 'mimarks' in doc['doc']['meta']:
-                doc['doc']['meta']['mimarks'] = _delete_keys_from_dict(doc['doc']['meta']['mimarks'])
-
-        # At this point we should have purged the document of all properties
-        # that have no value attached to them.
-
-        # Now move meta values a step outward and make them a base property instead of nested
-        if 'meta' in doc['doc']:
-
-            for key,val in doc['doc']['meta'].items():
-
-                if isinstance(val,dict): # if a nested dict, extract
-
-                    for ke,va in doc['doc']['meta'][key].items():
-
-                        if isinstance(va,dict):
-
-                            for k,v in doc['doc']['meta'][key][ke].items():
-
-                                if k and v:
-                                    if ke in keys_to_keep:
-                                        doc['doc']["{}_{}".format(ke,k)] = v
-                                    else:
-                                        doc['doc'][k] = v
-
-                        else:
-                            if ke and va:
-                                doc['doc'][ke] = va
-
-                else:
-                    if key and val:
-                        doc['doc'][key] = val
-
-            del doc['doc']['meta']
-
-        doc['doc']['id'] = doc['id'] # move everything into 'doc' key
-
-        # Fix the old syntax to make sure it reads 'attribute' and not just 'attr'
-        if doc['doc']['node_type'].endswith("_attr"):
-            doc['doc']['node_type'] = "{0}ibute".format(doc['doc']['node_type'])
-
-        # Build a giant list of each node type
-        if doc['doc']['node_type'] in nodes:
-
-            # Also, for these nodes, assign their ID to be the same as the
-            # sample/visit/subject they associate with for easy lookups.
-            # The data will also be subset to the 'meta' section as that is
-            # where the interesting information lies in the attribute nodes.
-            if doc['doc']['node_type'].endswith("attribute"):
-                if len(doc['doc']['linkage']['associated_with']) > 0: # get around test uploads
-                    nodes[doc['doc']['node_type']][doc['doc']['linkage']['associated_with'][0]] = doc
-            else:
-                nodes[doc['doc']['node_type']][doc['id']] = doc
+        if not docs_cleaned:
+            doc = _normalize_doc(doc)
+            if doc is None:
+                continue
 
-        else:
-            node_type = doc['doc']['node_type']
-            if node_type in node_skip_counts:
-                node_skip_counts[node_type] += 1
-            else:
-                node_skip_counts[node_type] = 1
+        _add_doc_to_nodes(nodes, doc, node_skip_counts, doc_keys)
 
         # no-op ?
         key = counter
@@ -1371,8 +3660,17 @@ if __name__ == '__main__':
             sys.stderr.write(str(counter) + '\r')
             sys.stderr.flush()
 
-    # build a list of all Cypher statements to build the entire DB
-    cypher_statements = []
+    _print_http_stats()
+
+    # save the node store before _append_attribute_data starts modifying it
+    if args.incremental_dir is not None:
+        if changes_state['last_seq'] is None:
+            _print_error("no update sequence found in " + args.from_dump + ", not saving an incremental checkpoint")
+        else:
+            _save_incremental_state(args.incremental_dir, args.db, changes_state['last_seq'], nodes, doc_keys)
+
+    _build_lineage_index(nodes, node_store)
+    _build_srs_prep_index(nodes)
 
     sys.stdout.write("skipped node counts:\n")
     for node_type in node_skip_counts:
@@ -1380,62 +3678,29 @@ if __name__ == '__main__':
         sys.stdout.write("  {0} : {1}\n".format(node_type, str(count)))
     sys.stdout.write("\n")
 
-    for key in nodes:
-
-        if key in file_nodes:
-            
-            if key == "16s_raw_seq_set":
-                for id in nodes[key]:
-                    if id not in ignore:
-                        cypher_statements += _generate_cypher_statements(_build_16s_raw_seq_set_doc(nodes, nodes[key][id]))
-
-            elif key == "16s_trimmed_seq_set":
-                for id in nodes[key]:
-                    if id not in ignore:
-                        cypher_statements += _generate_cypher_statements(_build_16s_trimmed_seq_set_doc(nodes, nodes[key][id]))
+    # with --pipeline, nodes and links are committed as they are built
+    pipeline = None
+    if args.pipeline:
+        pipeline = _InsertPipeline(cy, args.batch_size, args.pipeline_queue_size)
 
-            elif key.endswith("ome") or key == "cytokine" or key == "proteome_nonpride" or key == "serology":
-                for id in nodes[key]:
-                    if id not in ignore:
-                        cypher_statements += _generate_cypher_statements(_build_omes_doc(nodes, nodes[key][id]))
-
-            elif key == "abundance_matrix":
-                for id in nodes[key]:
-                    if id not in ignore:
-                        cypher_statements += _generate_cypher_statements(_build_abundance_matrix_doc(nodes, nodes[key][id]))
-
-            elif (
-                key == "wgs_raw_seq_set" or key == "wgs_raw_seq_set_private"
-                or key == "host_wgs_raw_seq_set" or key == "host_transcriptomics_raw_seq_set"
-                or key == "microb_transcriptomics_raw_seq_set"
-                or key == "host_epigenetics_raw_seq_set"
-                ):
-                for id in nodes[key]:
-                    if id not in ignore:
-                        cypher_statements += _generate_cypher_statements(_build_wgs_transcriptomics_doc(nodes, nodes[key][id]))
-
-            elif key == "wgs_assembled_seq_set" or key == "viral_seq_set":
-                for id in nodes[key]:
-                    if id not in ignore:
-                        cypher_statements += _generate_cypher_statements(_build_wgs_assembled_or_viral_seq_set_doc(nodes, nodes[key][id]))
-
-            elif key == "annotation":
-                for id in nodes[key]:
-                    if id not in ignore:
-                        cypher_statements += _generate_cypher_statements(_build_annotation_doc(nodes, nodes[key][id]))
-
-            elif key == "clustered_seq_set":
-                for id in nodes[key]:
-                    if id not in ignore:
-                        cypher_statements += _generate_cypher_statements(_build_clustered_seq_set_doc(nodes, nodes[key][id]))
-
-            elif key == "alignment" or key == "host_variant_call":
-                for id in nodes[key]:
-                    if id not in ignore:
-                        cypher_statements += _generate_cypher_statements(_build_alignment_or_host_variant_call_doc(nodes, nodes[key][id]))
-                
-            elif not re.search(r'_prep$', key):
-                _print_error("skipping {0} File nodes of type {1}".format(len(nodes[key]), key))
+    # build the nodes, links and tags of every File node to build the entire DB
+    stime = time.time()
+    if args.generate_workers > 1:
+        file_keys = list(_file_node_keys(nodes))
+        _generate_in_pool(nodes, file_keys, args.generate_workers, node_store, pipeline)
+    else:
+        _generate_file_cypher(nodes, _file_node_keys(nodes), pipeline)
+    n_file_nodes = len(NODES['file'])
+    if pipeline is not None:
+        pipeline.collect()
+        n_file_nodes = pipeline.n_collected['file']
+    _print_error("built {0} file nodes in {1:.2f} second(s)".format(n_file_nodes, time.time() - stime))
+    _print_traverse_cache_stats()
+    TRAVERSE_CACHE.clear()
+
+    if node_store is not None:
+        node_store.print_stats()
+        node_store.close()
 
     # report nodes without upstream SRS ids
     sys.stdout.write("nodes without upstream SRS ids:\n")
@@ -1444,6 +3709,16 @@ if __name__ == '__main__':
         sys.stdout.write("  {0} : {1}\n".format(subtype, str(count)))
     sys.stdout.write("\n")
 
+    sys.stdout.write("upstream SRS ids found by prep field:\n")
+    for field in sorted(SRS_MATCH_COUNTS):
+        sys.stdout.write("  {0} : {1}\n".format(field, str(SRS_MATCH_COUNTS[field])))
+    sys.stdout.write("\n")
+
+    _print_upstream_problems()
+
+    if args.check_sample_file_uniqueness:
+        _print_sample_file_duplicates()
+
     # node counts by type
     print("node counts by type/subtype:")
     for t in sorted(NODES_BY_TYPE):
@@ -1454,44 +3729,15 @@ if __name__ == '__main__':
                 print(" " + str(pbt[p]) + " - " + p)
     sys.stdout.write("\n")
 
-    # insert nodes (this order appears to yield the best performance):
-    _insert_nodes(cy, 'subject')
-    _insert_nodes(cy, 'sample')
-    _insert_nodes(cy, 'file')
-    _insert_nodes(cy, 'tag')
-
-    neo4j_ver = ".".join([str(x) for x in cy.database.kernel_version])
-    # 3.4.5-specific workaround
-    if neo4j_ver == "3.4.5":
-        # these theoretically superfluous index statements appear to be critical 
-        # for fast loading in 3.4.5 but slow down loading in 3.4.10:
-        _build_all_indexes('file',cy)
-        _build_constraint_index('tag','term',cy)
-
-    # insert tag links
-    _insert_links(cy, 'file-tag')
-    # insert subject-sample links
-    _insert_links(cy, 'subject-sample')
-    # insert sample-file links
-    _insert_links(cy, 'sample-file')
-        
-    # Here set some better syntax for the portal and override the original OSDF values
-    stime = time.time()
-    cy.run('MATCH (n:sample) SET n.study_full_name=n.study_name')
-    _print_error("updated study full names in {0:.2f} second(s)".format(time.time() - stime))
-
-    stime = time.time()
-    for old, new in study_name_dict.items():
-        cy.run('MATCH (n:sample) WHERE n.study_name="{0}" SET n.study_name="{1}"'.format(old,new))
-    _print_error("updated study names in {0:.2f} second(s)".format(time.time() - stime))
-
-    stime = time.time()
-    cy.run("MATCH (PSS:subject) WHERE PSS.project_name = 'iHMP' SET PSS.project_name = 'Integrative Human Microbiome Project'")
-    _print_error("updated project name in {0:.2f} second(s)".format(time.time() - stime))
-
-    # Now build indexes on each unique property found in this newest data set
-    _build_all_indexes('subject',cy)
-    _build_all_indexes('sample',cy)
+    if args.csv_dir is not None:
+        # the study and project name rewrites below are applied as the nodes are written
+        _write_import_csvs(args.csv_dir)
+    else:
+        # with --journal_dir a failed insert can be continued with --resume
+        if args.journal_dir is not None:
+            JOURNAL = _save_graph_snapshot(args.journal_dir)
+        _insert_graph(cy, pipeline)
+        _update_graph(cy)
 
     # A little final message
     _print_error("Done! converted {0} CouchDB documents in {1} seconds!\n".format(counter, time.time() - start_time))